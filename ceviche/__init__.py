@@ -4,7 +4,7 @@ name = "ceviche"
 __version__ = '0.1.1'
 
 from .fdtd import fdtd
-from .fdfd import fdfd_ez, fdfd_hz
+from .fdfd import fdfd_ez, fdfd_hz, kerr_nonlinearity
 from .jacobians import jacobian
 
 from . import viz
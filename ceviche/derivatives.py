@@ -8,6 +8,7 @@ from .constants import *
 This file contains functions related to performing derivative operations used in the simulation tools.
 -  The FDTD method requires autograd-compatible curl operations, which are performed using numpy.roll
 -  The FDFD method requires sparse derivative matrices, with PML added, which are constructed here.
+-  Matrix-free FDFD applies the same derivatives as stencils on the grid (see `apply_derivative`).
 """
 
 
@@ -124,6 +125,36 @@ def make_Dyb(dL, shape, bloch_y=0.0):
     return Dyb
 
 
+""" Stencils (matrix-free versions of the derivative matrices) """
+
+def apply_derivative(component, dir, F, dL, bloch=0.0):
+    """ Applies the derivative matrix from `createDws(component, dir, ...)` to the field F on the 2D grid, without building it.
+        The transposes are D_xf^T = -D_xb and D_xb^T = -D_xf with the opposite bloch phase (same for y).
+    """
+
+    axis = 0 if component == 'x' else 1
+
+    # special case, a 1D problem (the derivative matrix is the identity)
+    if F.shape[axis] == 1:
+        return F
+
+    # index of the last (forward) or first (backward) row along the axis, where the bloch phase comes in
+    edge = [slice(None), slice(None)]
+    phasor = np.exp(1j * bloch)
+    if dir == 'f':
+        shifted = np.roll(F, shift=-1, axis=axis).astype(np.complex128)
+        edge[axis] = -1
+        shifted[tuple(edge)] *= phasor
+        return (shifted - F) / dL
+    elif dir == 'b':
+        shifted = np.roll(F, shift=1, axis=axis).astype(np.complex128)
+        edge[axis] = 0
+        shifted[tuple(edge)] *= np.conj(phasor)
+        return (F - shifted) / dL
+    else:
+        raise ValueError("direction {} not recognized".format(dir))
+
+
 """ PML Functions """
 
 def create_S_matrices(omega, shape, npml, dL):
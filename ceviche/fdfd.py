@@ -1,28 +1,34 @@
+import numpy as np
 import autograd.numpy as npa
 import scipy.sparse as sp
+import scipy.sparse.linalg as spl
 
 from .constants import *
-from .primitives import sp_solve, sp_mult, spsp_mult
-from .derivatives import compute_derivative_matrices
-from .utils import get_entries_indices
+from .primitives import sp_solve, sp_solve_batch, sp_solve_nl, sp_mult, make_diag_sandwich, sp_diag_sandwich
+from .solvers import solver_settings, solve_linear
+from .derivatives import compute_derivative_matrices, create_S_matrices, apply_derivative
+from .utils import get_entries_indices, get_value
 
 # notataion is similar to that used in: http://www.jpier.org/PIERB/pierb36/11.11092006.pdf
 
 class fdfd():
     """ Base class for FDFD simulation """
 
-    def __init__(self, omega, dL, eps_r, npml, bloch_phases=None):
+    def __init__(self, omega, dL, eps_r, npml, bloch_phases=None, solver_settings=None):
         """ initialize with a given structure and source
                 omega: angular frequency (rad/s)
                 dL: grid cell size (m)
                 eps_r: array containing relative permittivity
                 npml: list of number of PML grid cells in [x, y]
                 bloch_{x,y} phase difference across {x,y} boundaries for bloch periodic boundary conditions (default = 0 = periodic)
+                solver_settings: dict of settings for the linear solves of this simulation, for example {'backend': 'iterative'}
+                                 (see `solver_settings` in ceviche.solvers, by default the global settings are used)
         """
 
         self.omega = omega
         self.dL = dL
         self.npml = npml
+        self.solver_settings = solver_settings if solver_settings is not None else {}
 
         self._setup_bloch_phases(bloch_phases)
 
@@ -53,11 +59,29 @@ class fdfd():
         """ This method takes the system matrix and source and returns the x, y, and z field components """
         raise NotImplementedError("need to implement function to solve for field components")
 
+    def _solve_many_fn(self, eps_vec, entries_a, indices_a, source_vecs):
+        """ This method takes the system matrix and a (N, num_sources) block of sources and returns a list of (x, y, z) field components """
+        raise NotImplementedError("need to implement function to solve for field components of many sources")
+
+    def _make_symmetrizer(self):
+        """ This method returns a vector t such that diag(t) A is complex symmetric, or None if there isn't one """
+        return None
+
+    def _apply_A(self, eps_vec, F, trans='N'):
+        """ This method applies the system matrix A (trans='N') or A^T (trans='T') to the field F on the grid, without assembling A """
+        raise NotImplementedError("need to implement a matrix-free _apply_A() method")
+
+    def _z_to_xy(self, eps_vec, Fz_vec):
+        """ This method returns the x and y field components from the solved z component """
+        raise NotImplementedError("need to implement function to get the x and y field components")
+
     """ You call this to function to solve for the electromagnetic fields """
 
     def solve(self, source_z):
         """ Outward facing function (what gets called by user) that takes a source grid and returns the field components """
 
+        self._update_derivatives()
+
         # flatten the permittivity and source grid
         source_vec = self._grid_to_vec(source_z)
         eps_vec = self._grid_to_vec(self.eps_r)
@@ -66,7 +90,8 @@ class fdfd():
         entries_a, indices_a = self._make_A(eps_vec)
 
         # solve field componets usng A and the source
-        Fx_vec, Fy_vec, Fz_vec = self._solve_fn(eps_vec, entries_a, indices_a, source_vec)
+        with solver_settings(**self._get_solver_settings()):
+            Fx_vec, Fy_vec, Fz_vec = self._solve_fn(eps_vec, entries_a, indices_a, source_vec)
 
         # put all field components into a tuple, convert to grid shape and return them all
         Fx = self._vec_to_grid(Fx_vec)
@@ -75,8 +100,71 @@ class fdfd():
 
         return Fx, Fy, Fz
 
+    def solve_many(self, sources_z):
+        """ Like `solve()`, but for a list of source grids, which are all solved using one factorization of the system matrix.
+            Returns the field components, each stacked into an array of shape (len(sources_z), Nx, Ny)
+        """
+
+        self._update_derivatives()
+
+        # flatten the permittivity and put the flattened sources into the columns of a matrix
+        source_vecs = npa.stack([self._grid_to_vec(source_z) for source_z in sources_z], axis=1)
+        eps_vec = self._grid_to_vec(self.eps_r)
+
+        # create the A matrix for this polarization
+        entries_a, indices_a = self._make_A(eps_vec)
+
+        # solve field components for all of the sources at once
+        with solver_settings(**self._get_solver_settings()):
+            field_vecs = self._solve_many_fn(eps_vec, entries_a, indices_a, source_vecs)
+
+        # convert each field component to grid shape and stack them along the first axis
+        Fx = npa.stack([self._vec_to_grid(Fx_vec) for Fx_vec, _, _ in field_vecs])
+        Fy = npa.stack([self._vec_to_grid(Fy_vec) for _, Fy_vec, _ in field_vecs])
+        Fz = npa.stack([self._vec_to_grid(Fz_vec) for _, _, Fz_vec in field_vecs])
+
+        return Fx, Fy, Fz
+
+    def make_operator(self, eps_r=None):
+        """ Returns the system matrix A as a scipy LinearOperator, applied with stencils on the grid instead of being assembled.
+            It works with the iterative methods of ceviche.solvers (e.g. `solve_linear(A, b, iterative_method='gmres')`), and
+            needs no memory beyond a few fields.  By default, A is made with the current `eps_r`.
+        """
+        self._update_derivatives()
+        eps_vec = self._grid_to_vec(self.eps_r if eps_r is None else eps_r)
+        shape = tuple(self.shape)
+
+        def matvec(x):
+            return self._apply_A(eps_vec, np.reshape(x, shape)).ravel()
+
+        def rmatvec(x):
+            # scipy's rmatvec is the conjugate transpose
+            return np.conj(self._apply_A(eps_vec, np.conj(np.reshape(x, shape)), trans='T')).ravel()
+
+        return spl.LinearOperator((self.N, self.N), matvec=matvec, rmatvec=rmatvec, dtype=np.complex128)
+
+    def solve_matrix_free(self, source_z, iterative_method='gmres_100', preconditioner=None):
+        """ Solves for the fields like `solve`, but with an iterative method on the matrix-free operator (see `make_operator`).
+            This skips the assembly of A, but isn't differentiable.  `preconditioner` is a function of the operator (see `make_preconditioner` in ceviche.solvers).
+        """
+
+        self._update_derivatives()
+        eps_vec = self._grid_to_vec(self.eps_r)
+        b_vec = 1j * self.omega * self._grid_to_vec(source_z)
+        with solver_settings(**self._get_solver_settings()):
+            Fz_vec = solve_linear(self.make_operator(), b_vec, iterative_method=iterative_method, preconditioner=preconditioner)
+        Fx_vec, Fy_vec = self._z_to_xy(eps_vec, Fz_vec)
+
+        return self._vec_to_grid(Fx_vec), self._vec_to_grid(Fy_vec), self._vec_to_grid(Fz_vec)
+
     """ Utility functions for FDFD object """
 
+    def _get_solver_settings(self):
+        """ Settings of the linear solves of this simulation, the grid shape is for the 'multigrid' solver backend """
+        settings = {'grid_shape': tuple(self.shape)}
+        settings.update(self.solver_settings)
+        return settings
+
     def _setup_derivatives(self):
         """ Makes the sparse derivative matrices and does some processing for ease of use """
 
@@ -98,6 +186,45 @@ class fdfd():
         self.sp_mult_Dyf = lambda vec: sp_mult(self.entries_Dyf, self.indices_Dyf, vec)
         self.sp_mult_Dyb = lambda vec: sp_mult(self.entries_Dyb, self.indices_Dyb, vec)
 
+        # stores the PML stretching matrices and the row scaling that makes the system matrix symmetric
+        self.Sxf, self.Sxb, self.Syf, self.Syb = create_S_matrices(self.omega, self.shape, self.npml, self.dL)
+        self.sym_vec = self._make_symmetrizer()
+
+        # the PML stretching on the grid, for the matrix-free operator
+        self.s_grids = {name: S.diagonal().reshape(self.shape) for name, S in zip(('xf', 'xb', 'yf', 'yb'), (self.Sxf, self.Sxb, self.Syf, self.Syb))}
+
+        # what the derivatives were made for, see `_update_derivatives`
+        self.derivatives_key = self._derivatives_key()
+
+    def _derivatives_key(self):
+        """ The attributes that the derivative matrices (and everything precomputed from them) depend on """
+        return (self.omega, self.dL, tuple(self.npml), self.bloch_x, self.bloch_y, tuple(self.shape))
+
+    def _update_derivatives(self):
+        """ Remakes the derivative matrices if omega, dL, the PML, the bloch phases or the grid shape changed since they were made """
+        if self._derivatives_key() != self.derivatives_key:
+            self._setup_derivatives()
+
+    def _apply_D(self, name, F, trans='N'):
+        """ Applies the derivative matrix with PML `name` (one of 'xf', 'xb', 'yf', 'yb', e.g. Dxf) or its transpose to the grid F """
+        component, dir = name
+        bloch = self.bloch_x if component == 'x' else self.bloch_y
+        if trans == 'N':
+            return self.s_grids[name] * apply_derivative(component, dir, F, self.dL, bloch=bloch)
+        # (S D)^T = D^T S, where D_f^T = -D_b and D_b^T = -D_f with the opposite bloch phase
+        other_dir = 'b' if dir == 'f' else 'f'
+        return -apply_derivative(component, other_dir, self.s_grids[name] * F, self.dL, bloch=-bloch)
+
+    def _symmetrize(self, entries_a, indices_a, b):
+        """ Scales the rows of the system A x = b by `sym_vec` so that A is complex symmetric, which the solvers exploit.
+            The PML makes A non-symmetric, but only through a diagonal factor on the left of each derivative product.
+        """
+        if self.sym_vec is None:
+            return entries_a, b
+        rows = get_value(indices_a)[0]   # the indices may come out of spsp_mult as a box
+        sym_vec = self.sym_vec if b.ndim == 1 else self.sym_vec[:, None]
+        return entries_a * self.sym_vec[rows], sym_vec * b
+
     def _setup_bloch_phases(self, bloch_phases):
         """ Saves the x y and z bloch phases based on list of them 'bloch_phases' """
 
@@ -166,36 +293,100 @@ class fdfd():
 class fdfd_ez(fdfd):
     """ FDFD class for linear Ez polarization """
 
-    def __init__(self, omega, dL, eps_r, npml, bloch_phases=None):
-        super().__init__(omega, dL, eps_r, npml, bloch_phases=bloch_phases)
+    def __init__(self, omega, dL, eps_r, npml, bloch_phases=None, solver_settings=None):
+        super().__init__(omega, dL, eps_r, npml, bloch_phases=bloch_phases, solver_settings=solver_settings)
 
-    def _make_A(self, eps_vec):
+    def _setup_derivatives(self):
+        super()._setup_derivatives()
 
+        # the curl curl part of A doesn't depend on eps, so it's made once here and `_make_A` only puts the diagonal in front of it
         C = - 1 / MU_0 * self.Dxf.dot(self.Dxb) \
             - 1 / MU_0 * self.Dyf.dot(self.Dyb)
-        entries_c, indices_c = get_entries_indices(C)
+        self.entries_c, indices_c = get_entries_indices(C)
 
         # indices into the diagonal of a sparse matrix
-        entries_diag = - EPSILON_0 * self.omega**2 * eps_vec
         indices_diag = npa.vstack((npa.arange(self.N), npa.arange(self.N)))
+        self.indices_a = npa.hstack((indices_diag, indices_c))
 
-        entries_a = npa.hstack((entries_diag, entries_c))
-        indices_a = npa.hstack((indices_diag, indices_c))
+    def _make_A(self, eps_vec):
 
-        return entries_a, indices_a
+        entries_diag = - EPSILON_0 * self.omega**2 * eps_vec
+        entries_a = npa.hstack((entries_diag, self.entries_c))
+
+        return entries_a, self.indices_a
+
+    def _make_symmetrizer(self):
+        # A = -1/mu0 (Sxf Dxf Sxb Dxb + Syf Dyf Syb Dyb) - omega^2 eps0 eps, where each Dxf Sxb Dxb is symmetric
+        if self.bloch_x != 0 or self.bloch_y != 0:
+            return None
+        return 1 / (self.Sxf.diagonal() * self.Syf.diagonal())
+
+    def _apply_A(self, eps_vec, F, trans='N'):
+        # A = -1/mu0 (Dxf Dxb + Dyf Dyb) - omega^2 eps0 eps, so A^T = -1/mu0 (Dxb^T Dxf^T + Dyb^T Dyf^T) - omega^2 eps0 eps
+        order = (('xf', 'xb'), ('yf', 'yb')) if trans == 'N' else (('xb', 'xf'), ('yb', 'yf'))
+        curl_curl = sum(self._apply_D(outer, self._apply_D(inner, F, trans), trans) for outer, inner in order)
+        return - 1 / MU_0 * curl_curl - EPSILON_0 * self.omega**2 * self._vec_to_grid(eps_vec) * F
+
+    def _z_to_xy(self, eps_vec, Ez_vec):
+        return self._Ez_to_Hx_Hy(Ez_vec)
 
     def _solve_fn(self, eps_vec, entries_a, indices_a, Jz_vec):
 
         b_vec = 1j * self.omega * Jz_vec
+        entries_a, b_vec = self._symmetrize(entries_a, indices_a, b_vec)
         Ez_vec = sp_solve(entries_a, indices_a, b_vec)
         Hx_vec, Hy_vec = self._Ez_to_Hx_Hy(Ez_vec)
         return Hx_vec, Hy_vec, Ez_vec
 
+    def _solve_many_fn(self, eps_vec, entries_a, indices_a, Jz_vecs):
+
+        b_vecs = 1j * self.omega * Jz_vecs
+        entries_a, b_vecs = self._symmetrize(entries_a, indices_a, b_vecs)
+        Ez_vecs = sp_solve_batch(entries_a, indices_a, b_vecs)
+
+        field_vecs = []
+        for i in range(Ez_vecs.shape[1]):
+            Ez_vec = Ez_vecs[:, i]
+            Hx_vec, Hy_vec = self._Ez_to_Hx_Hy(Ez_vec)
+            field_vecs.append((Hx_vec, Hy_vec, Ez_vec))
+        return field_vecs
+
+    def solve_nl(self, source_z, eps_nl, method='newton'):
+        """ Solves for the fields in a nonlinear material, whose permittivity `eps_nl(eps_r, Ez)` depends on the field (e.g. `kerr_nonlinearity`).
+            Like `solve`, this is differentiable with respect to eps_r and the source.  `method` is 'newton' or 'picard' (see `sp_solve_nl`).
+        """
+
+        self._update_derivatives()
+
+        source_vec = self._grid_to_vec(source_z)
+        eps_vec = self._grid_to_vec(self.eps_r)
+        _, indices_a = self._make_A(eps_vec)
+
+        def fn_nl(eps_vec, Ez_vec):
+            # entries of A with the permittivity at the field Ez
+            eps_grid = eps_nl(self._vec_to_grid(eps_vec), self._vec_to_grid(Ez_vec))
+            entries_a, _ = self._make_A(self._grid_to_vec(eps_grid))
+            return entries_a
+
+        b_vec = 1j * self.omega * source_vec
+        with solver_settings(**self._get_solver_settings()):
+            Ez_vec = sp_solve_nl(eps_vec, indices_a, b_vec, fn_nl, method=method)
+        Hx_vec, Hy_vec = self._Ez_to_Hx_Hy(Ez_vec)
+
+        return self._vec_to_grid(Hx_vec), self._vec_to_grid(Hy_vec), self._vec_to_grid(Ez_vec)
+
 class fdfd_hz(fdfd):
     """ FDFD class for linear Ez polarization """
 
-    def __init__(self, omega, dL, eps_r, npml, bloch_phases=None):
-        super().__init__(omega, dL, eps_r, npml, bloch_phases=bloch_phases)
+    def __init__(self, omega, dL, eps_r, npml, bloch_phases=None, solver_settings=None):
+        super().__init__(omega, dL, eps_r, npml, bloch_phases=bloch_phases, solver_settings=solver_settings)
+
+    def _setup_derivatives(self):
+        super()._setup_derivatives()
+
+        # precomputes the products of the derivative entries in Dxb eps_yy^-1 Dxf and Dyb eps_xx^-1 Dyf, which only change with eps
+        self.indices_sandwich_x, self.sandwich_x = make_diag_sandwich(self.entries_Dxb, self.indices_Dxb, self.entries_Dxf, self.indices_Dxf, self.N)
+        self.indices_sandwich_y, self.sandwich_y = make_diag_sandwich(self.entries_Dyb, self.indices_Dyb, self.entries_Dyf, self.indices_Dyf, self.N)
 
     def _grid_average_2d(self, eps_vec):
 
@@ -216,11 +407,9 @@ class fdfd_hz(fdfd):
 
         indices_diag = npa.vstack((npa.arange(self.N), npa.arange(self.N)))
 
-        entries_DxEpsy,   indices_DxEpsy   = spsp_mult(self.entries_Dxb, self.indices_Dxb, eps_vec_yy_inv, indices_diag, self.N)
-        entires_DxEpsyDx, indices_DxEpsyDx = spsp_mult(entries_DxEpsy, indices_DxEpsy, self.entries_Dxf, self.indices_Dxf, self.N)
-
-        entries_DyEpsx,   indices_DyEpsx   = spsp_mult(self.entries_Dyb, self.indices_Dyb, eps_vec_xx_inv, indices_diag, self.N)
-        entires_DyEpsxDy, indices_DyEpsxDy = spsp_mult(entries_DyEpsx, indices_DyEpsx, self.entries_Dyf, self.indices_Dyf, self.N)
+        entires_DxEpsyDx = sp_diag_sandwich(eps_vec_yy_inv, self.sandwich_x)
+        entires_DyEpsxDy = sp_diag_sandwich(eps_vec_xx_inv, self.sandwich_y)
+        indices_DxEpsyDx, indices_DyEpsxDy = self.indices_sandwich_x, self.indices_sandwich_y
 
         entries_d = 1 / EPSILON_0 * npa.hstack((entires_DxEpsyDx, entires_DyEpsxDy))
         indices_d = npa.hstack((indices_DxEpsyDx, indices_DyEpsxDy))
@@ -232,9 +421,31 @@ class fdfd_hz(fdfd):
 
         return entries_a, indices_a
 
+    def _make_symmetrizer(self):
+        # A = 1/eps0 (Sxb Dxb eps_yy^-1 Sxf Dxf + Syb Dyb eps_xx^-1 Syf Dyf) + omega^2 mu0, where each Dxb eps^-1 Sxf Dxf is symmetric
+        if self.bloch_x != 0 or self.bloch_y != 0:
+            return None
+        return 1 / (self.Sxb.diagonal() * self.Syb.diagonal())
+
+    def _apply_A(self, eps_vec, F, trans='N'):
+        # A = 1/eps0 (Dxb eps_yy^-1 Dxf + Dyb eps_xx^-1 Dyf) + omega^2 mu0, and its transpose swaps the order of the derivatives
+        eps_vec_xx, eps_vec_yy = self._grid_average_2d(eps_vec)
+        eps_grid_xx_inv = self._vec_to_grid(1 / (eps_vec_xx + 1e-5))
+        eps_grid_yy_inv = self._vec_to_grid(1 / (eps_vec_yy + 1e-5))
+        order = (('xb', 'xf', eps_grid_yy_inv), ('yb', 'yf', eps_grid_xx_inv))
+        if trans == 'T':
+            order = tuple((inner, outer, eps_inv) for outer, inner, eps_inv in order)
+        derivs = sum(self._apply_D(outer, eps_inv * self._apply_D(inner, F, trans), trans) for outer, inner, eps_inv in order)
+        return 1 / EPSILON_0 * derivs + MU_0 * self.omega**2 * F
+
+    def _z_to_xy(self, eps_vec, Hz_vec):
+        eps_vec_xx, eps_vec_yy = self._grid_average_2d(eps_vec)
+        return self._Hz_to_Ex_Ey(Hz_vec, eps_vec_xx, eps_vec_yy)
+
     def _solve_fn(self, eps_vec, entries_a, indices_a, Mz_vec):
 
         b_vec = 1j * self.omega * Mz_vec          # needed so fields are SI units
+        entries_a, b_vec = self._symmetrize(entries_a, indices_a, b_vec)
         Hz_vec = sp_solve(entries_a, indices_a, b_vec)
         eps_vec_xx, eps_vec_yy = self._grid_average_2d(eps_vec)
 
@@ -243,6 +454,20 @@ class fdfd_hz(fdfd):
 
         return Ex_vec, Ey_vec, Hz_vec
 
+    def _solve_many_fn(self, eps_vec, entries_a, indices_a, Mz_vecs):
+
+        b_vecs = 1j * self.omega * Mz_vecs
+        entries_a, b_vecs = self._symmetrize(entries_a, indices_a, b_vecs)
+        Hz_vecs = sp_solve_batch(entries_a, indices_a, b_vecs)
+        eps_vec_xx, eps_vec_yy = self._grid_average_2d(eps_vec)
+
+        field_vecs = []
+        for i in range(Hz_vecs.shape[1]):
+            Hz_vec = Hz_vecs[:, i]
+            Ex_vec, Ey_vec = self._Hz_to_Ex_Ey(Hz_vec, eps_vec_xx, eps_vec_yy)
+            field_vecs.append((Ex_vec, Ey_vec, Hz_vec))
+        return field_vecs
+
 class fdfd_3d(fdfd):
     """ 3D FDFD class (work in progress) """
 
@@ -302,3 +527,17 @@ class fdfd_3d(fdfd):
 
         return Ex_vec, Ey_vec, Hz_vec
 
+
+""" Nonlinear materials for `fdfd_ez.solve_nl` """
+
+def kerr_nonlinearity(chi3, E_sat=None):
+    """ Returns the permittivity eps_nl(eps_r, Ez) of a Kerr material, eps = eps_r + 3 chi3 |Ez|^2.
+        If E_sat is given, the change saturates at field amplitudes around E_sat: eps = eps_r + 3 chi3 |Ez|^2 / (1 + |Ez|^2 / E_sat^2)
+        chi3 can be a grid, for example zero outside of the nonlinear material.
+    """
+    def eps_nl(eps_r, Ez):
+        intensity = npa.real(npa.conj(Ez) * Ez)   # |Ez|^2, written so that its derivative is smooth at Ez = 0
+        if E_sat is not None:
+            intensity = intensity / (1 + intensity / E_sat**2)
+        return eps_r + 3 * chi3 * intensity
+    return eps_nl
@@ -1,10 +1,13 @@
 import autograd.numpy as npa
 
-from autograd.core import make_vjp, make_jvp
+from itertools import islice
+
+from autograd.core import VJPNode, add_outgrads, primitive_jvps
+from autograd.tracer import trace, toposort, Node
 from autograd.wrap_util import unary_to_nary
 from autograd.extend import vspace
 
-from .utils import get_value, get_shape, get_value_arr, float_2_array
+from .utils import get_value, get_shape, get_value_arr, float_2_array, map_perturbations
 
 
 """
@@ -13,36 +16,74 @@ The only function you'll want to use in your code is `jacobian`,
 where you can specify the mode of differentiation (reverse, forward, or numerical)
 """
 
-def jacobian(fun, argnum=0, mode='reverse', step_size=1e-6):
-    """ Computes jacobian of `fun` with respect to argument number `argnum` using automatic differentiation """
+# number of backprop vectors (reverse mode) or tangents (forward mode) carried through the function together,
+# the batched solves hold an (N, batch_size) matrix of right hand sides
+JACOBIAN_BATCH_SIZE = 64
+
+def jacobian(fun, argnum=0, mode='reverse', step_size=1e-6, difference='forward', num_workers=0, batch_size=JACOBIAN_BATCH_SIZE):
+    """ Computes jacobian of `fun` with respect to argument number `argnum` using automatic differentiation.
+        For mode='numerical', `difference` and `num_workers` are passed on to `jacobian_numerical`.
+        For mode='reverse' and 'forward', `batch_size` is passed on to `jacobian_reverse` and `jacobian_forward`.
+    """
 
     if mode == 'reverse':
-        return jacobian_reverse(fun, argnum)
+        return jacobian_reverse(fun, argnum, batch_size=batch_size)
     elif mode == 'forward':
-        return jacobian_forward(fun, argnum)
+        return jacobian_forward(fun, argnum, batch_size=batch_size)
     elif mode == 'numerical':
-        return jacobian_numerical(fun, argnum, step_size=step_size)
+        return jacobian_numerical(fun, argnum, step_size=step_size, difference=difference, num_workers=num_workers)
     else:
         raise ValueError("'mode' kwarg must be either 'reverse' or 'forward' or 'numerical', given {}".format(mode))
 
 
 @unary_to_nary
-def jacobian_reverse(fun, x):
-    """ Compute jacobian of fun with respect to x using reverse mode differentiation"""
-    vjp, ans = make_vjp(fun, x)
-    grads = map(vjp, vspace(ans).standard_basis())
+def jacobian_reverse(fun, x, batch_size=JACOBIAN_BATCH_SIZE):
+    """ Compute jacobian of fun with respect to x using reverse mode differentiation.
+        The backward passes of `batch_size` outputs at a time are done together, so the primitives with a batched vjp
+        (like the sparse solves, see `defvjp_batched` in primitives.py) do one multi right hand side adjoint solve for each batch.
+    """
+    start_node = VJPNode.new_root()
+    ans, end_node = trace(start_node, fun, x)
+    grads = []
+    for basis in _batches(vspace(ans).standard_basis(), batch_size):
+        if end_node is None:
+            grads += [vspace(x).zeros() for _ in basis]
+        else:
+            grads += _batched_backward_pass(basis, end_node)
     m, n = _jac_shape(x, ans)
     return npa.reshape(npa.stack(grads), (n, m))
 
+def _batched_backward_pass(gs, end_node):
+    """ autograd's `backward_pass` for the list of backprop vectors `gs` at once, returning the list of their gradients.
+        Each node gets the backprop vectors of all of them, and passes them through its `batched` vjp if it has one.
+    """
+    outgrads = {end_node: [(g, False) for g in gs]}
+    for node in toposort(end_node):
+        outgrad = outgrads.pop(node)
+        batched = getattr(node.vjp, 'batched', None)
+        if batched is not None:
+            ingrads_stacked = batched(npa.stack([g for g, _ in outgrad]))
+            ingrads = [[ingrad[k] for ingrad in ingrads_stacked] for k in range(len(gs))]
+        else:
+            ingrads = [node.vjp(g) for g, _ in outgrad]
+        for k, ingrads_k in enumerate(ingrads):
+            for parent, ingrad in zip(node.parents, ingrads_k):
+                parent_outgrads = outgrads.setdefault(parent, [None] * len(gs))
+                parent_outgrads[k] = add_outgrads(parent_outgrads[k], ingrad)
+    return [g for g, _ in outgrad]
+
 
 @unary_to_nary
-def jacobian_forward(fun, x):
-    """ Compute jacobian of fun with respect to x using forward mode differentiation"""
-    jvp = make_jvp(fun, x)
-    # ans = fun(x)
-    val_grad = map(lambda b: jvp(b), vspace(x).standard_basis())
-    vals, grads = zip(*val_grad)
-    ans = npa.zeros((list(vals)[0].size,))  # fake answer so that dont have to compute it twice
+def jacobian_forward(fun, x, batch_size=JACOBIAN_BATCH_SIZE):
+    """ Compute jacobian of fun with respect to x using forward mode differentiation.
+        The function is run once for every `batch_size` inputs, carrying their tangents together, so the primitives with a batched jvp
+        (like the sparse solves, see `defjvp_batched` in primitives.py) do one multi right hand side solve for each batch.
+    """
+    grads = []
+    for basis in _batches(vspace(x).standard_basis(), batch_size):
+        start_node = _BatchedJVPNode.new_root(basis)
+        ans, end_node = trace(start_node, fun, x)
+        grads += [vspace(ans).zeros() for _ in basis] if end_node is None else end_node.gs
     m, n = _jac_shape(x, ans)
     if _iscomplex(x):
         grads_real = npa.array(grads[::2])
@@ -51,26 +92,71 @@ def jacobian_forward(fun, x):
     return npa.reshape(npa.stack(grads), (m, n)).T
 
 
-@unary_to_nary
-def jacobian_numerical(fn, x, step_size=1e-7):
-    """ numerically differentiate `fn` w.r.t. its argument `x` """
-    in_array = float_2_array(x).flatten()
-    out_array = float_2_array(fn(x)).flatten()
+class _BatchedJVPNode(Node):
+    """ autograd's `JVPNode` carrying the list of tangents `gs` of many inputs at once,
+        which go through the `batched` jvps of the primitives that have them (and one at a time through the others)
+    """
+    __slots__ = ['gs']
 
-    m = in_array.size
-    n = out_array.size
-    shape = (n, m)
-    jacobian = npa.zeros(shape)
+    def __init__(self, value, fun, args, kwargs, parent_argnums, parents):
+        parent_gs = [parent.gs for parent in parents]
+        try:
+            jvpmaker = primitive_jvps[fun]
+        except KeyError:
+            name = getattr(fun, '__name__', fun)
+            raise NotImplementedError("JVP of {} wrt argnums {} not defined".format(name, parent_argnums))
+        batched = getattr(jvpmaker, 'batched', None)
+        if batched is not None:
+            self.gs = batched(parent_argnums, parent_gs, value, args, kwargs)
+        else:
+            self.gs = [jvpmaker(parent_argnums, gs, value, args, kwargs) for gs in zip(*parent_gs)]
 
-    for i in range(m):
-        input_i = in_array.copy()
-        input_i[i] += step_size
-        arg_i = input_i.reshape(in_array.shape)
-        output_i = fn(arg_i).flatten()
-        grad_i = (output_i - out_array) / step_size
-        jacobian[:, i] = get_value_arr(get_value(grad_i))  # need to convert both the grad_i array and its contents to actual data.
+    def initialize_root(self, gs):
+        self.gs = gs
+
+
+@unary_to_nary
+def jacobian_numerical(fn, x, step_size=1e-7, difference='forward', num_workers=0):
+    """ numerically differentiate `fn` w.r.t. its argument `x`
+            difference: 'forward' or 'central' differences, or 'complex' steps (for real `x` and an `fn` that is analytic in it)
+            num_workers: number of processes the perturbed evaluations of `fn` are spread over (see `map_perturbations` in utils.py),
+                         None uses all of the cores and 0 does them all in this process.
+    """
+    if difference not in ('forward', 'central', 'complex'):
+        raise ValueError("'difference' kwarg must be either 'forward', 'central' or 'complex', given {}".format(difference))
+    if difference == 'complex' and _iscomplex(x):
+        raise ValueError("complex step differentiation needs a real valued argument")
+
+    in_array = float_2_array(x)
+    out_array = float_2_array(fn(x)).flatten()
 
-    return jacobian
+    def perturbed_output(i, delta):
+        input_i = in_array.flatten().astype(npa.result_type(in_array, delta))
+        input_i[i] += delta
+        return float_2_array(fn(input_i.reshape(in_array.shape))).flatten()
+
+    def grad_i(i):
+        if difference == 'forward':
+            grad = (perturbed_output(i, step_size) - out_array) / step_size
+        elif difference == 'central':
+            grad = (perturbed_output(i, step_size / 2) - perturbed_output(i, -step_size / 2)) / step_size
+        else:
+            grad = npa.imag(perturbed_output(i, 1j * step_size)) / step_size
+        return get_value_arr(get_value(grad))  # need to convert both the grad_i array and its contents to actual data.
+
+    grads = map_perturbations(grad_i, in_array.size, num_workers=num_workers)
+    return npa.stack(grads, axis=1)
+
+
+def _batches(vectors, batch_size):
+    """ Splits the iterable of `vectors` into lists of at most `batch_size` of them, without making all of them at once """
+    if batch_size < 1:
+        raise ValueError("'batch_size' must be at least 1, given {}".format(batch_size))
+    vectors = iter(vectors)
+    batch = list(islice(vectors, batch_size))
+    while batch:
+        yield batch
+        batch = list(islice(vectors, batch_size))
 
 
 def _jac_shape(x, ans):
@@ -0,0 +1,170 @@
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spl
+
+"""
+This file contains a geometric multigrid V-cycle for the 2D (and 1D) FDFD system matrices.
+-  The grid levels are made by (bilinear) interpolation between the fine grid and a grid with every other point,
+   wrapping around the periodic boundaries like the derivative matrices from `derivatives.compute_derivative_matrices`.
+-  The coarse operators are the Galerkin products P^T A P, so the PML and the permittivity carry over to every level.
+-  The smoother is PML-aware: damped Jacobi diverges on the complex-stretched PML operator, so the PML rows are
+   instead relaxed with an exact solve of the PML block, and damped Jacobi is only used in the interior.
+It is meant to invert a complex shifted-Laplacian, see `make_multigrid_preconditioner` in solvers.py, since
+multigrid on the Helmholtz operator itself does not converge.
+"""
+
+# number of smoothing sweeps done before and after each coarse grid correction
+MULTIGRID_SMOOTHING_STEPS = 2
+
+# weight of the damped Jacobi sweeps
+MULTIGRID_JACOBI_WEIGHT = 0.8
+
+# grids with at most this many points are solved directly instead of being coarsened further
+MULTIGRID_COARSEST_SIZE = 4096
+
+# grids are only coarsened while the wavelength (in the highest index material) spans at least this many grid points
+MULTIGRID_MIN_POINTS_PER_WAVELENGTH = 6
+
+
+""" ========================= GRID TRANSFER OPERATORS ======================== """
+
+def make_prolongation_1d(n):
+    """ Interpolates a periodic 1D grid of (n + 1) // 2 points (the even points) onto the grid of n points """
+    n_coarse = (n + 1) // 2
+    coarse = np.arange(n_coarse)
+    odd = np.arange(n // 2)
+    rows = np.hstack((2 * coarse, 2 * odd + 1, 2 * odd + 1))
+    cols = np.hstack((coarse, odd, (odd + 1) % n_coarse))
+    vals = np.hstack((np.ones(n_coarse), 0.5 * np.ones(odd.size), 0.5 * np.ones(odd.size)))
+    return sp.csr_matrix((vals, (rows, cols)), shape=(n, n_coarse))
+
+def make_prolongation(shape):
+    """ Interpolation from the next coarser grid onto the grid of `shape` (flattened like `fdfd._grid_to_vec`).
+        Returns the sparse prolongation matrix and the coarse grid shape. Dimensions of size 1 are left alone.
+    """
+    prolongations = [make_prolongation_1d(n) if n > 1 else sp.eye(1) for n in shape]
+    coarse_shape = tuple(P.shape[1] for P in prolongations)
+    return sp.kron(prolongations[0], prolongations[1], format='csr'), coarse_shape
+
+def find_pml_rows(A):
+    """ Boolean mask of the rows of A coupled to their neighbours by complex entries.
+        The curl-curl operators are real away from the PML (and the bloch boundaries), the permittivity only enters the diagonal.
+    """
+    A = sp.csr_matrix(A)
+    off_diag = (A - sp.diags(A.diagonal())).tocoo()
+    is_complex = np.abs(off_diag.data.imag) > 1e-8 * np.abs(off_diag.data)
+    mask = np.zeros(A.shape[0], dtype=bool)
+    mask[off_diag.row[is_complex]] = True
+    return mask
+
+def estimate_kh(A, mass):
+    """ Estimates the largest wavenumber times grid spacing of an FDFD matrix A with (diagonal) mass term `mass`.
+        The diagonal of the discrete Laplacian part of A is 4 / dL^2 in 2D, while the mass term is k^2 (up to a common factor).
+        The PML rows are skipped, the stretched Laplacian doesn't sum to zero there so `mass` (usually A @ 1) is off.
+    """
+    laplacian_diag = A.diagonal() - mass
+    nonzero = (np.abs(laplacian_diag) > 0) & ~find_pml_rows(A)
+    if not np.any(nonzero):
+        return 0.0
+    return float(np.sqrt(4 * np.max(np.abs(mass[nonzero] / laplacian_diag[nonzero]))))
+
+
+""" ============================ MULTIGRID CYCLE ============================= """
+
+class _MultigridLevel():
+    """ Holds the operator of a grid level and its PML-aware smoother """
+
+    def __init__(self, A, pml_rows, weight=MULTIGRID_JACOBI_WEIGHT):
+        A = A.tocsr()
+        self.pml = np.where(pml_rows)[0]
+        self.interior = np.where(~pml_rows)[0]
+        self.inv_diag = weight / A.diagonal()[self.interior]
+        self.pml_lu = spl.splu(A[self.pml][:, self.pml].tocsc()) if self.pml.size else None
+
+        # the full operator and its PML and interior rows, for A (trans='N') and A^T (trans='T')
+        self.blocks = {}
+        for trans, A_trans in (('N', A), ('T', A.T.tocsr())):
+            self.blocks[trans] = (A_trans, A_trans[self.pml], A_trans[self.interior])
+
+    def operator(self, trans):
+        return self.blocks[trans][0]
+
+    def smooth(self, x, b, trans='N', reverse=False):
+        """ One sweep of exact relaxation on the PML rows and damped Jacobi on the interior rows (in reverse order if `reverse`) """
+        steps = (self._relax_interior, self._relax_pml) if reverse else (self._relax_pml, self._relax_interior)
+        for step in steps:
+            x = step(x, b, trans)
+        return x
+
+    def _relax_pml(self, x, b, trans):
+        if self.pml_lu is None:
+            return x
+        r = b[self.pml] - self.blocks[trans][1].dot(x)
+        x = x.copy()
+        x[self.pml] += self.pml_lu.solve(r, trans=trans)
+        return x
+
+    def _relax_interior(self, x, b, trans):
+        r = b[self.interior] - self.blocks[trans][2].dot(x)
+        x = x.copy()
+        x[self.interior] += self.inv_diag * r
+        return x
+
+class MultigridSolver():
+    """ Approximately solves A x = b (trans='N') or A^T x = b (trans='T') with one multigrid V-cycle.
+            A: sparse FDFD-like matrix on a grid of `shape`, typically a complex shifted-Laplacian
+            kh: largest wavenumber times grid spacing (see `estimate_kh`), coarsening stops before the
+                wavelength spans fewer than `min_points_per_wavelength` grid points.  0 means no limit.
+    """
+
+    def __init__(self, A, shape, kh=0.0, smoothing_steps=MULTIGRID_SMOOTHING_STEPS, weight=MULTIGRID_JACOBI_WEIGHT,
+                 coarsest_size=MULTIGRID_COARSEST_SIZE, min_points_per_wavelength=MULTIGRID_MIN_POINTS_PER_WAVELENGTH):
+
+        shape = tuple(shape)
+        if int(np.prod(shape)) != A.shape[0]:
+            raise ValueError("grid shape {} doesn't match the matrix of shape {}".format(shape, A.shape))
+
+        self.smoothing_steps = smoothing_steps
+        self.levels = []
+        self.prolongations = []
+
+        A = sp.csr_matrix(A)
+        pml_rows = find_pml_rows(A)
+        while A.shape[0] > coarsest_size and max(shape) > 1:
+            if kh > 0 and 2 * np.pi / (2 * kh) < min_points_per_wavelength:
+                break
+            P, shape = make_prolongation(shape)
+            self.levels.append(_MultigridLevel(A, pml_rows, weight=weight))
+            self.prolongations.append(P)
+
+            # the coarse PML is wherever a coarse point interpolates onto a fine PML point
+            A = (P.T.dot(A).dot(P)).tocsr()
+            pml_rows = P.T.dot(pml_rows.astype(float)) > 0
+            kh *= 2
+
+        self.coarse_lu = spl.splu(A.tocsc())
+
+    def solve(self, b, trans='N'):
+        """ Applies one V-cycle to b (a vector, or a matrix of right hand sides in its columns) """
+        b = np.asarray(b, dtype=np.complex128)
+        if b.ndim == 2:
+            return np.stack([self._v_cycle(0, b[:, i], trans) for i in range(b.shape[1])], axis=1)
+        return self._v_cycle(0, b, trans)
+
+    def _v_cycle(self, depth, b, trans):
+        if depth == len(self.levels):
+            return self.coarse_lu.solve(b, trans=trans)
+
+        level = self.levels[depth]
+        P = self.prolongations[depth]
+
+        x = np.zeros_like(b)
+        for _ in range(self.smoothing_steps):
+            x = level.smooth(x, b, trans=trans)
+
+        r = b - level.operator(trans).dot(x)
+        x = x + P.dot(self._v_cycle(depth + 1, P.T.dot(r), trans))
+
+        for _ in range(self.smoothing_steps):
+            x = level.smooth(x, b, trans=trans, reverse=True)
+        return x
@@ -1,10 +1,14 @@
+import numpy as np
 import autograd.numpy as npa
 import scipy.sparse as sp
+import scipy.sparse.linalg as spl
 import autograd as ag
+import warnings
 
-from .solvers import solve_linear
+from autograd.extend import vspace
+from .solvers import solve_factored, factorize, get_solver_settings, solver_settings, telemetry_kind
 from .utils import (make_sparse, transpose_indices, make_rand, make_rand_complex, make_rand_indeces,
-                    make_rand_sparse, der_num, grad_num, get_entries_indices, make_IO_matrices)
+                    make_rand_sparse, der_num, grad_num, get_entries_indices)
 
 """ This file defines the very lowest level sparse matrix primitives that allow autograd to
 be compatible with FDFD.  One needs to define the derivatives of Ax = b and x = A^-1 b for sparse A.
@@ -51,12 +55,93 @@ know how to handle those as arguments to functions.
     After this, you need to link the @primitive to its vjp/jvp using
     defvjp(function, arg1's vjp, arg2's vjp, ...)
     defjvp(function, arg1's jvp, arg2's jvp, ...)
+
+    BATCHED REVERSE MODE:
+        `jacobian(..., mode='reverse')` does the backward passes of all of the outputs together.
+        A primitive can give it a batched vjp, taking a block of backprop vectors V stacked along the first axis at once, using
+        defvjp_batched(function, batched vjp_maker)
+        where the batched vjp_maker takes the same arguments as a vjp_maker and returns a function of V giving a dict of
+        the stacked (d{function} / d{argument_i})^T @ V for each argument number i.  The sparse solves use it to do all of the adjoint solves at once.
+
+    BATCHED FORWARD MODE:
+        Likewise, `jacobian(..., mode='forward')` pushes the tangents of all of the inputs through the function together.
+        A primitive can take a block of tangents G stacked along the first axis at once with
+        defjvp_batched(function, arg1's batched jvp, arg2's batched jvp, ...)
+        where each batched jvp takes the same arguments as a jvp (with G instead of g) and returns the list of output tangents.
 """
 
+class _BatchedVJP():
+    """ The vjp of a node in autograd's graph, which also has a `batched` version for a block of backprop vectors """
+
+    def __init__(self, vjp, batched_vjpmaker, argnums, ans, args, kwargs):
+        self.vjp = vjp
+        self.batched_vjpmaker = batched_vjpmaker
+        self.argnums, self.ans, self.args, self.kwargs = argnums, ans, args, kwargs
+        # the solver settings of the forward pass (like a simulation's own backend and grid shape), for making the batched vjp later
+        self.settings = get_solver_settings()
+
+    def __call__(self, g):
+        return self.vjp(g)
+
+    def batched(self, V):
+        # the batched vjp is only made when needed, since this is done for every node of every trace
+        with solver_settings(**self.settings):
+            batched_vjp = self.batched_vjpmaker(self.ans, *self.args, **self.kwargs)
+        grads = batched_vjp(V)
+        # like in `defvjp`, the arguments without a vjp get zero gradients
+        return tuple(grads[argnum] if argnum in grads else [vspace(self.args[argnum]).zeros()] * len(V) for argnum in self.argnums)
+
+class _BatchedJVP():
+    """ The jvp of a primitive (as registered by `defjvp`), which also has a `batched` version for a list of tangents """
+
+    def __init__(self, jvp_argnums, batched_jvps):
+        self.jvp_argnums = jvp_argnums
+        self.batched_jvps = batched_jvps
+
+    def __call__(self, argnums, gs, ans, args, kwargs):
+        return self.jvp_argnums(argnums, gs, ans, args, kwargs)
+
+    def batched(self, argnums, gs_list, ans, args, kwargs):
+        num_tangents = len(gs_list[0])
+        outs = []
+        for argnum, gs in zip(argnums, gs_list):
+            batched_jvp = self.batched_jvps.get(argnum)
+            if batched_jvp is not None:
+                outs.append(batched_jvp(npa.stack(gs), ans, *args, **kwargs))
+            else:
+                outs.append([self.jvp_argnums((argnum,), [g], ans, args, kwargs) for g in gs])
+        # the output tangent is the sum of the ones from each argument, like in `defjvp`
+        return [ag.core.sum_outgrads(out[k] for out in outs) for k in range(num_tangents)]
+
+def defjvp_batched(fun, *batched_jvps):
+    """ Adds batched jvps to the primitive `fun`, whose jvps were already defined with `defjvp` (see the guide above) """
+    batched_jvps = {argnum: jvp for argnum, jvp in enumerate(batched_jvps) if jvp is not None}
+    ag.core.defjvp_argnums(fun, _BatchedJVP(ag.core.primitive_jvps[fun], batched_jvps))
+
+def _sum_into_batched(index, values, size):
+    # `_sum_into` for each row of `values`, done as one sparse matrix product
+    summing = sp.csr_matrix((np.ones(index.size), (index, np.arange(index.size))), shape=(size, index.size))
+    return np.asarray(summing.dot(np.asarray(values).T)).T
+
+def defvjp_batched(fun, batched_vjpmaker):
+    """ Adds a batched vjp to the primitive `fun`, whose vjps were already defined with `defvjp` (see the guide above) """
+    vjp_argnums = ag.core.primitive_vjps[fun]
+    def batched_vjp_argnums(argnums, ans, args, kwargs):
+        return _BatchedVJP(vjp_argnums(argnums, ans, args, kwargs), batched_vjpmaker, argnums, ans, args, kwargs)
+    ag.core.defvjp_argnums(fun, batched_vjp_argnums)
+
 """ ========================== Sparse Matrix-Vector Multiplication =========================="""
 
+def _other_trans(trans):
+    # the adjoint of a product (or solve) with A is one with A^T and vice versa
+    return 'N' if trans == 'T' else 'T'
+
+def _trans_indices(indices, trans):
+    # row and column indices of the entries in A (trans='N') or A^T (trans='T')
+    return indices if trans == 'N' else transpose_indices(indices)
+
 @ag.primitive
-def sp_mult(entries, indices, x):
+def sp_mult(entries, indices, x, trans='N'):
     """ Multiply a sparse matrix (A) by a dense vector (x)
     Args:
       entries: numpy array with shape (num_non_zeros,) giving values for non-zero
@@ -64,44 +149,58 @@ def sp_mult(entries, indices, x):
       indices: numpy array with shape (2, num_non_zeros) giving x and y indices for
         non-zero matrix entries into A.
       x: 1d numpy array specifying the vector to multiply by.
+      trans: 'T' to multiply by A^T instead (using A's matrix, without building A^T)
     Returns:
       1d numpy array corresponding to the result (b) of A * x = b.
     """
     N = x.size
     A = make_sparse(entries, indices, shape=(N, N))
+    if trans == 'T':
+        return A.T.dot(x)
     return A.dot(x)
 
-def grad_sp_mult_entries_reverse(ans, entries, indices, x):
+def grad_sp_mult_entries_reverse(ans, entries, indices, x, trans='N'):
     # x^T @ dA/de^T @ v => the outer product of x and v using the indices of A
-    ia, ja = indices
+    ia, ja = _trans_indices(indices, trans)
     def vjp(v):
         return v[ia] * x[ja]
     return vjp
 
-def grad_sp_mult_x_reverse(b, entries, indices, x):
+def grad_sp_mult_x_reverse(b, entries, indices, x, trans='N'):
     # dx/de^T @ A^T @ v => multiplying A^T by v
-    indices_T = transpose_indices(indices)
     def vjp(v):
-        return sp_mult(entries, indices_T, v)
+        return sp_mult(entries, indices, v, trans=_other_trans(trans))
     return vjp
 
 ag.extend.defvjp(sp_mult, grad_sp_mult_entries_reverse, None, grad_sp_mult_x_reverse)
 
-def grad_sp_mult_entries_forward(g, b, entries, indices, x):
+def grad_sp_mult_entries_forward(g, b, entries, indices, x, trans='N'):
     # dA/de @ x @ g => use `g` as the entries into A and multiply by x
-    return sp_mult(g, indices, x)
+    return sp_mult(g, indices, x, trans=trans)
 
-def grad_sp_mult_x_forward(g, b, entries, indices, x):
+def grad_sp_mult_x_forward(g, b, entries, indices, x, trans='N'):
     # A @ dx/de @ g -> simply multiply A @ g
-    return sp_mult(entries, indices, g)
+    return sp_mult(entries, indices, g, trans=trans)
 
 ag.extend.defjvp(sp_mult, grad_sp_mult_entries_forward, None, grad_sp_mult_x_forward)
 
+def grad_sp_mult_entries_forward_batched(G, b, entries, indices, x, trans='N'):
+    # each row of G used as the entries into A, multiplied by x
+    i, j = _trans_indices(indices, trans)
+    return list(_sum_into_batched(i, G * x[j], x.size))
+
+def grad_sp_mult_x_forward_batched(G, b, entries, indices, x, trans='N'):
+    # A @ G^T, the tangents are multiplied all at once
+    A = make_sparse(entries, indices, shape=(x.size, x.size))
+    return list((A.T if trans == 'T' else A).dot(G.T).T)
+
+defjvp_batched(sp_mult, grad_sp_mult_entries_forward_batched, None, grad_sp_mult_x_forward_batched)
+
 
 """ ========================== Sparse Matrix-Vector Solve =========================="""
 
 @ag.primitive
-def sp_solve(entries, indices, b):
+def sp_solve(entries, indices, b, trans='N'):
     """ Solve a sparse matrix (A) with source (b)
     Args:
       entries: numpy array with shape (num_non_zeros,) giving values for non-zero
@@ -109,44 +208,161 @@ def sp_solve(entries, indices, b):
       indices: numpy array with shape (2, num_non_zeros) giving x and y indices for
         non-zero matrix entries.
       b: 1d numpy array specifying the source.
+      trans: 'T' to solve A^T * x = b instead (using A's factorization)
     Returns:
       1d numpy array corresponding to the solution of A * x = b.
-    Note: Calls a customizable solving function from ceviche.solvers, could add options to sp_solve() here eventually
+    Note: The factorization of A is cached in ceviche.solvers, so the adjoint solve with A^T (in the vjp) reuses it.
+      The solver backend is chosen by the settings in ceviche.solvers (see `solver_settings` there).
+      The solves can be recorded with `solver_telemetry` from ceviche.solvers.
     """
-    N = b.size
-    A = make_sparse(entries, indices, shape=(N, N))
-    # calls a customizable solving function from ceviche.solvers, could add options to sp_solve() here eventually
-    return solve_linear(A, b)
+    # look up (or compute) the factorization of A and solve with it, A^T's factorization is used if it was the one factored before
+    return solve_factored(entries, indices, b, trans=trans)
 
-def grad_sp_solve_entries_reverse(x, entries, indices, b):
+def grad_sp_solve_entries_reverse(x, entries, indices, b, trans='N'):
     # x^T @ dA/de^T @ A_inv^T @ -v => do the solve on the RHS, then take outer product with x using indices of A
-    indices_T = transpose_indices(indices)
-    i, j = indices
+    i, j = _trans_indices(indices, trans)
+    settings = get_solver_settings()  # the vjp is called after the forward solve, so it needs to remember its solver settings
     def vjp(v):
-        adj = sp_solve(entries, indices_T, -v)
+        with solver_settings(**settings), telemetry_kind('adjoint'):
+            adj = sp_solve(entries, indices, -v, trans=_other_trans(trans))
         return adj[i] * x[j]
     return vjp
 
-def grad_sp_solve_b_reverse(ans, entries, indices, b):
+def grad_sp_solve_b_reverse(ans, entries, indices, b, trans='N'):
     # dx/de^T @ A_inv^T @ v => do the solve on the RHS and you're done.
-    indices_T = transpose_indices(indices)
+    settings = get_solver_settings()
     def vjp(v):
-        return sp_solve(entries, indices_T, v)
+        with solver_settings(**settings), telemetry_kind('adjoint'):
+            return sp_solve(entries, indices, v, trans=_other_trans(trans))
     return vjp
 
 ag.extend.defvjp(sp_solve, grad_sp_solve_entries_reverse, None, grad_sp_solve_b_reverse)
 
-def grad_sp_solve_entries_forward(g, x, entries, indices, b):
+def grad_sp_solve_reverse_batched(x, entries, indices, b, trans='N'):
+    # the vjps of a block of backprop vectors (rows of V) with one multi right hand side adjoint solve
+    i, j = _trans_indices(indices, trans)
+    settings = get_solver_settings()
+    def vjp(V):
+        with solver_settings(**settings), telemetry_kind('adjoint'):
+            adj = sp_solve_batch(entries, indices, V.T, trans=_other_trans(trans))
+        return {0: -(adj[i] * x[j][:, None]).T, 2: adj.T}
+    return vjp
+
+defvjp_batched(sp_solve, grad_sp_solve_reverse_batched)
+
+def grad_sp_solve_entries_forward(g, x, entries, indices, b, trans='N'):
     # -A_inv @ dA/de @ A_inv @ b @ g => insert x = A_inv @ b and multiply with g using A indices.  Then solve as source for A_inv.
-    forward = sp_mult(g, indices, x)
-    return sp_solve(entries, indices, -forward)
+    forward = sp_mult(g, indices, x, trans=trans)
+    with telemetry_kind('tangent'):
+        return sp_solve(entries, indices, -forward, trans=trans)
 
-def grad_sp_solve_b_forward(g, x, entries, indices, b):
+def grad_sp_solve_b_forward(g, x, entries, indices, b, trans='N'):
     # A_inv @ db/de @ g => simply solve A_inv @ g
-    return sp_solve(entries, indices, g)
+    with telemetry_kind('tangent'):
+        return sp_solve(entries, indices, g, trans=trans)
 
 ag.extend.defjvp(sp_solve, grad_sp_solve_entries_forward, None, grad_sp_solve_b_forward)
 
+def grad_sp_solve_entries_forward_batched(G, x, entries, indices, b, trans='N'):
+    # the sources -dA/de @ x of all of the tangents go in one solve with the factorization of the primal solve
+    i, j = _trans_indices(indices, trans)
+    forward = _sum_into_batched(i, G * x[j], x.size)
+    with telemetry_kind('tangent'):
+        return list(sp_solve_batch(entries, indices, -forward.T, trans=trans).T)
+
+def grad_sp_solve_b_forward_batched(G, x, entries, indices, b, trans='N'):
+    # A_inv @ G^T in one solve
+    with telemetry_kind('tangent'):
+        return list(sp_solve_batch(entries, indices, G.T, trans=trans).T)
+
+defjvp_batched(sp_solve, grad_sp_solve_entries_forward_batched, None, grad_sp_solve_b_forward_batched)
+
+
+""" ========================== Sparse Matrix-Matrix Batched Solve =========================="""
+
+@ag.primitive
+def sp_solve_batch(entries, indices, B, trans='N'):
+    """ Solve a sparse matrix (A) with a block of sources (B), one per column, using one factorization of A
+    Args:
+      entries: numpy array with shape (num_non_zeros,) giving values for non-zero
+        matrix entries.
+      indices: numpy array with shape (2, num_non_zeros) giving x and y indices for
+        non-zero matrix entries.
+      B: 2d numpy array with shape (N, num_sources) where each column is a source.
+      trans: 'T' to solve A^T * X = B instead (using A's factorization)
+    Returns:
+      2d numpy array with shape (N, num_sources) corresponding to the solution of A * X = B.
+    """
+    return solve_factored(entries, indices, B, trans=trans)
+
+def grad_sp_solve_batch_entries_reverse(X, entries, indices, B, trans='N'):
+    # same as for sp_solve, except the outer products of each column are summed
+    i, j = _trans_indices(indices, trans)
+    settings = get_solver_settings()
+    def vjp(V):
+        with solver_settings(**settings), telemetry_kind('adjoint'):
+            adj = sp_solve_batch(entries, indices, -V, trans=_other_trans(trans))
+        return npa.sum(adj[i] * X[j], axis=1)
+    return vjp
+
+def grad_sp_solve_batch_B_reverse(X, entries, indices, B, trans='N'):
+    # A_inv^T @ V => one solve with all of the columns of V
+    settings = get_solver_settings()
+    def vjp(V):
+        with solver_settings(**settings), telemetry_kind('adjoint'):
+            return sp_solve_batch(entries, indices, V, trans=_other_trans(trans))
+    return vjp
+
+ag.extend.defvjp(sp_solve_batch, grad_sp_solve_batch_entries_reverse, None, grad_sp_solve_batch_B_reverse)
+
+def grad_sp_solve_batch_reverse_batched(X, entries, indices, B, trans='N'):
+    # the columns of all of the backprop blocks (V has shape (num_vectors, N, num_sources)) go in one adjoint solve
+    i, j = _trans_indices(indices, trans)
+    settings = get_solver_settings()
+    def vjp(V):
+        num_vectors, N, num_sources = V.shape
+        with solver_settings(**settings), telemetry_kind('adjoint'):
+            adj = sp_solve_batch(entries, indices, V.transpose((1, 0, 2)).reshape((N, -1)), trans=_other_trans(trans))
+        adj = adj.reshape((N, num_vectors, num_sources))
+        return {0: -npa.sum(adj[i] * X[j][:, None, :], axis=2).T, 2: adj.transpose((1, 0, 2))}
+    return vjp
+
+defvjp_batched(sp_solve_batch, grad_sp_solve_batch_reverse_batched)
+
+def grad_sp_solve_batch_entries_forward(g, X, entries, indices, B, trans='N'):
+    # -A_inv @ dA/de @ X @ g => multiply each column of X by the matrix with entries g, then solve for all of them at once
+    N = X.shape[0]
+    G = make_sparse(g, indices, shape=(N, N))
+    forward = (G.T if trans == 'T' else G).dot(X)
+    with telemetry_kind('tangent'):
+        return sp_solve_batch(entries, indices, -forward, trans=trans)
+
+def grad_sp_solve_batch_B_forward(g, X, entries, indices, B, trans='N'):
+    # A_inv @ dB/de @ g => solve with the block of tangents
+    with telemetry_kind('tangent'):
+        return sp_solve_batch(entries, indices, g, trans=trans)
+
+ag.extend.defjvp(sp_solve_batch, grad_sp_solve_batch_entries_forward, None, grad_sp_solve_batch_B_forward)
+
+def _solve_blocks(entries, indices, G, trans):
+    # solves with all of the (N, num_sources) blocks of G (shape (num_tangents, N, num_sources)) at once, returning the list of solutions
+    num_tangents, N, num_sources = G.shape
+    with telemetry_kind('tangent'):
+        X = sp_solve_batch(entries, indices, G.transpose((1, 0, 2)).reshape((N, -1)), trans=trans)
+    return list(X.reshape((N, num_tangents, num_sources)).transpose((1, 0, 2)))
+
+def grad_sp_solve_batch_entries_forward_batched(G, X, entries, indices, B, trans='N'):
+    # the products of each row of G (as entries into A) with X, solved for together
+    i, j = _trans_indices(indices, trans)
+    N = X.shape[0]
+    forward = np.stack([make_sparse(g, np.vstack((i, j)), shape=(N, N)).dot(X) for g in G])
+    return _solve_blocks(entries, indices, -forward, trans)
+
+def grad_sp_solve_batch_B_forward_batched(G, X, entries, indices, B, trans='N'):
+    return _solve_blocks(entries, indices, G, trans)
+
+defjvp_batched(sp_solve_batch, grad_sp_solve_batch_entries_forward_batched, None, grad_sp_solve_batch_B_forward_batched)
+
 
 """ ==========================Sparse Matrix-Sparse Matrix Multiplication ========================== """
 
@@ -175,204 +391,397 @@ def spsp_mult(entries_a, indices_a, entries_x, indices_x, N):
     entries_b, indices_b = get_entries_indices(B)
     return entries_b, indices_b
 
+def _spsp_mult_pairs(indices_a, indices_x, N):
+    """ Returns the arrays (ka, kx) of the indices of every pair of an entry of A and an entry of X with A's column equal to X's row """
+    _, ja = np.asarray(indices_a, dtype=np.int64)
+    ix, _ = np.asarray(indices_x, dtype=np.int64)
+
+    # group the entries of X by row, so the entries of X multiplying A's entry k are x_order[starts[ja[k]]: starts[ja[k]] + counts[ja[k]]]
+    x_order = np.argsort(ix, kind='stable')
+    counts = np.bincount(ix, minlength=N)
+    starts = np.cumsum(counts) - counts
+
+    # one pair for each of them
+    num_pairs = counts[ja]
+    ka = np.repeat(np.arange(ja.size), num_pairs)
+    first_pair = np.cumsum(num_pairs) - num_pairs
+    kx = x_order[np.arange(ka.size) - np.repeat(first_pair - starts[ja], num_pairs)]
+    return ka, kx
+
+def _spsp_mult_terms(indices_a, indices_x, indices_b, N):
+    """ Lists the terms a_ka * x_kx of the product AX=B (all of the pairs of entries of A and X with A's column equal to X's row).
+        Returns the arrays (ka, kx, kb) with the index of each term's entry in A, in X and in B
+        (terms landing on locations not in `indices_b`, where the product cancelled to zero, are left out).
+    """
+    ia, _ = np.asarray(indices_a, dtype=np.int64)
+    _, jx = np.asarray(indices_x, dtype=np.int64)
+    ib, jb = np.asarray(indices_b, dtype=np.int64)
+    ka, kx = _spsp_mult_pairs(indices_a, indices_x, N)
+
+    # find where each term lands in B
+    if ib.size == 0:
+        return ka[:0], kx[:0], ka[:0]
+    b_linear = ib * N + jb
+    b_order = np.argsort(b_linear)
+    term_linear = ia[ka] * N + jx[kx]
+    pos = np.minimum(np.searchsorted(b_linear[b_order], term_linear), b_order.size - 1)
+    kb = b_order[pos]
+    in_b = b_linear[kb] == term_linear
+    return ka[in_b], kx[in_b], kb[in_b]
+
+def _sum_into(index, values, size):
+    # sums the complex `values` into an array of length `size` at `index`
+    return np.bincount(index, weights=values.real, minlength=size) + 1j * np.bincount(index, weights=values.imag, minlength=size)
+
 def grad_spsp_mult_entries_a_reverse(b_out, entries_a, indices_a, entries_x, indices_x, N):
     """ For AX=B, we want to relate the entries of A to the entries of B.
-        The goal is to compute the gradient of the output entries with respect to the input.
-        For this, though, we need to convert into matrix form, do our computation, and convert back to the entries.
-        If you write out the matrix elements and do the calculation, you can derive the code below, but it's a hairy derivation.
+        Each entry of B is a sum of terms a_ka * x_kx (see `_spsp_mult_terms`), so the gradient with respect to a_ka
+        gathers v at the entries of B that the terms of a_ka land on, times their x_kx.
     """
-
-    # make the indices matrices for A
     _, indices_b = b_out
-    Ia, Oa = make_IO_matrices(indices_a, N)
+    ka, kx, kb = _spsp_mult_terms(indices_a, indices_x, indices_b, N)
+    entries_x = np.asarray(entries_x, dtype=np.complex128)
 
     def vjp(v):
-
-        # multiply the v_entries with X^T using the indices of B
         entries_v, _ = v
-        indices_xT = transpose_indices(indices_x)
-        entries_vxt, indices_vxt = spsp_mult(entries_v, indices_b, entries_x, indices_xT, N)
-
-        # rutn this into a sparse matrix and convert to the basis of A's indices
-        VXT = make_sparse(entries_vxt, indices_vxt, shape=(N, N))
-        M = (Ia.T).dot(VXT).dot(Oa.T)
-
-        # return the diagonal elements, which contain the entries
-        return M.diagonal()
+        return _sum_into(ka, entries_v[kb] * entries_x[kx], entries_a.size)
 
     return vjp
 
 def grad_spsp_mult_entries_x_reverse(b_out, entries_a, indices_a, entries_x, indices_x, N):
-    """ Now we wish to do the gradient with respect to the X matrix in AX=B
-        Instead of doing it all out again, we just use the previous grad function on the transpose equation X^T A^T = B^T 
-    """
-
-    # get the transposes of the original problem
-    entries_b, indices_b = b_out
-    indices_aT = transpose_indices(indices_a)
-    indices_xT = transpose_indices(indices_x)
-    indices_bT = transpose_indices(indices_b)
-    b_T_out = entries_b, indices_bT
+    """ Now we wish to do the gradient with respect to the X matrix in AX=B, which uses the same terms with the roles of A and X swapped """
+    _, indices_b = b_out
+    ka, kx, kb = _spsp_mult_terms(indices_a, indices_x, indices_b, N)
+    entries_a = np.asarray(entries_a, dtype=np.complex128)
 
-    # call the vjp maker for AX=B using the substitution A=>X^T, X=>A^T, B=>B^T
-    vjp_XT_AT = grad_spsp_mult_entries_a_reverse(b_T_out, entries_x, indices_xT, entries_a, indices_aT, N)
+    def vjp(v):
+        entries_v, _ = v
+        return _sum_into(kx, entries_v[kb] * entries_a[ka], entries_x.size)
 
-    # return the function of the transpose vjp maker being called on the backprop vector
-    return lambda v: vjp_XT_AT(v)
+    return vjp
 
 ag.extend.defvjp(spsp_mult, grad_spsp_mult_entries_a_reverse, None, grad_spsp_mult_entries_x_reverse, None, None)
 
 def grad_spsp_mult_entries_a_forward(g, b_out, entries_a, indices_a, entries_x, indices_x, N):
-    """ Forward mode is not much better than reverse mode, but the same general logic aoplies:
-        Convert to matrix form, do the calculation, convert back to entries.        
+    """ Forward mode sums the terms of the product with the entries of A replaced by g into the entries of B.
             dA/de @ x @ g
     """
-
-    # get the IO indices matrices for B
     _, indices_b = b_out
+    ka, kx, kb = _spsp_mult_terms(indices_a, indices_x, indices_b, N)
+    entries_x = np.asarray(entries_x, dtype=np.complex128)
+
+    # return the resulting entries and indices of 0 (because indices are not affected by entries)
     Mb = indices_b.shape[1]
-    Ib, Ob = make_IO_matrices(indices_b, N)
+    return _sum_into(kb, g[ka] * entries_x[kx], Mb), npa.zeros(Mb)
 
-    # multiply g by X using a's index
-    entries_gX, indices_gX = spsp_mult(g, indices_a, entries_x, indices_x, N)
-    gX = make_sparse(entries_gX, indices_gX, shape=(N, N))
+def grad_spsp_mult_entries_x_forward(g, b_out, entries_a, indices_a, entries_x, indices_x, N):
+    """ Same thing, with the entries of X replaced by g """
+    _, indices_b = b_out
+    ka, kx, kb = _spsp_mult_terms(indices_a, indices_x, indices_b, N)
+    entries_a = np.asarray(entries_a, dtype=np.complex128)
 
-    # convert these entries and indides into the basis of the indices of B
-    M = (Ib.T).dot(gX).dot(Ob.T)
+    Mb = indices_b.shape[1]
+    return _sum_into(kb, entries_a[ka] * g[kx], Mb), npa.zeros(Mb)
 
-    # return the diagonal (resulting entries) and indices of 0 (because indices are not affected by entries)
-    return M.diagonal(), npa.zeros(Mb)
+ag.extend.defjvp(spsp_mult, grad_spsp_mult_entries_a_forward, None, grad_spsp_mult_entries_x_forward, None, None)
 
-def grad_spsp_mult_entries_x_forward(g, b_out, entries_a, indices_a, entries_x, indices_x, N):
-    """ Same trick as before: Reuse the previous VJP but for the transpose system """
+def grad_spsp_mult_entries_a_forward_batched(G, b_out, entries_a, indices_a, entries_x, indices_x, N):
+    # the terms of the product are found once for all of the tangents
+    _, indices_b = b_out
+    ka, kx, kb = _spsp_mult_terms(indices_a, indices_x, indices_b, N)
+    Mb = indices_b.shape[1]
+    entries_b = _sum_into_batched(kb, G[:, ka] * np.asarray(entries_x, dtype=np.complex128)[kx], Mb)
+    return [(entries, npa.zeros(Mb)) for entries in entries_b]
 
-    # Transpose A, X, and B
-    indices_aT = transpose_indices(indices_a)
-    indices_xT = transpose_indices(indices_x)
-    entries_b, indices_b = b_out
-    indices_bT = transpose_indices(indices_b)
-    b_T_out = entries_b, indices_bT
+def grad_spsp_mult_entries_x_forward_batched(G, b_out, entries_a, indices_a, entries_x, indices_x, N):
+    _, indices_b = b_out
+    ka, kx, kb = _spsp_mult_terms(indices_a, indices_x, indices_b, N)
+    Mb = indices_b.shape[1]
+    entries_b = _sum_into_batched(kb, np.asarray(entries_a, dtype=np.complex128)[ka] * G[:, kx], Mb)
+    return [(entries, npa.zeros(Mb)) for entries in entries_b]
 
-    # return the jvp of B^T = X^T A^T
-    return grad_spsp_mult_entries_a_forward(g, b_T_out, entries_x, indices_xT, entries_a, indices_aT, N)
+defjvp_batched(spsp_mult, grad_spsp_mult_entries_a_forward_batched, None, grad_spsp_mult_entries_x_forward_batched)
 
-ag.extend.defjvp(spsp_mult, grad_spsp_mult_entries_a_forward, None, grad_spsp_mult_entries_x_forward, None, None)
 
+""" ========================== Sparse Diagonal Sandwich D1 @ diag(w) @ D2 ========================== """
 
-""" ========================== Nonlinear Solve ========================== """
+def make_diag_sandwich(entries_1, indices_1, entries_2, indices_2, N):
+    """ Precomputes the products B = D1 @ diag(w) @ D2 of two constant sparse matrices D1 and D2 for `sp_diag_sandwich`
+    Args:
+      entries_1, indices_1: entries and indices of D1
+      entries_2, indices_2: entries and indices of D2
+      N: all matrices are assumed of shape (N, N)
+    Returns:
+      indices_b: numpy array with shape (2, num_non_zeros) giving i, j indices for
+        non-zero matrix entries into B (for any w).
+      sandwich: the (products, kw, kb, Mb) to pass to `sp_diag_sandwich`, where each entry of B is a sum of terms
+        products[t] * w[kw[t]] over the t with kb[t] equal to its index, and Mb is the number of entries of B.
+    """
+    k1, k2 = _spsp_mult_pairs(indices_1, indices_2, N)
+    i1, m1 = np.asarray(indices_1, dtype=np.int64)
+    _, j2 = np.asarray(indices_2, dtype=np.int64)
 
-# this is just a sketch of how to do problems involving sparse matrix solves with nonlinear elements...  WIP.
+    # sum the terms with the same location into one entry of B
+    unique, kb = np.unique(i1[k1] * N + j2[k2], return_inverse=True)
+    indices_b = np.vstack((unique // N, unique % N))
 
-def sp_solve_nl(parameters, a_indices, b, fn_nl):
-    """
-        parameters: entries into matrix A are function of parameters and solution x
-        a_indices: indices into sparse A matrix
-        b: source vector for A(xx = b
-        fn_nl: describes how the entries of a depend on the solution of A(x,p) @ x = b and the parameters  `a_entries = fn_nl(params, x)`
+    products = np.asarray(entries_1, dtype=np.complex128)[k1] * np.asarray(entries_2, dtype=np.complex128)[k2]
+    return indices_b, (products, m1[k1], kb.ravel(), unique.size)
+
+@ag.primitive
+def sp_diag_sandwich(w, sandwich):
+    """ Computes the entries of a sparse matrix B = D1 @ diag(w) @ D2 with constant D1 and D2
+    Args:
+      w: numpy array with shape (N,) giving the diagonal between D1 and D2
+      sandwich: the precomputed products of D1 and D2 from `make_diag_sandwich`
+    Returns:
+      entries_b: numpy array with shape (num_non_zeros,) giving values for non-zero
+        matrix entries into B, at the `indices_b` returned by `make_diag_sandwich`
     """
+    products, kw, kb, Mb = sandwich
+    return _sum_into(kb, products * w[kw], Mb)
 
-    # do the actual nonlinear solve in `_solve_nl_problem` (using newton, picard, whatever)
-    # this tells you the final entries into A given the parameters and the nonlinear function.
-    a_entries = ceviche.solvers._solve_nl_problem(parameters, a_indices, fn_nl, a_entries0=None)  # optinally, give starting a_entries
-    x = sp_solve(a_entries, a_indices, b)  # the final solution to A(x) x = b
-    return x
+def grad_sp_diag_sandwich_w_reverse(entries_b, w, sandwich):
+    # each term of B's entries is linear in one element of w, so sum v times the products of the terms into w's elements
+    products, kw, kb, _ = sandwich
+    def vjp(v):
+        return _sum_into(kw, v[kb] * products, w.size)
+    return vjp
 
-def grad_sp_solve_nl_parameters(x, parameters, a_indices, b, fn_nl):
+ag.extend.defvjp(sp_diag_sandwich, grad_sp_diag_sandwich_w_reverse, None)
 
-    """ 
-    We are finding the solution (x) to the nonlinear function:
+def grad_sp_diag_sandwich_w_forward(g, entries_b, w, sandwich):
+    # B is linear in w, so this is the sandwich with g as the diagonal
+    return sp_diag_sandwich(g, sandwich)
 
-        f = A(x, p) @ x - b = 0
+ag.extend.defjvp(sp_diag_sandwich, grad_sp_diag_sandwich_w_forward, None)
 
-    And need to define the vjp of the solution (x) with respect to the parameters (p)
+def grad_sp_diag_sandwich_w_forward_batched(G, entries_b, w, sandwich):
+    products, kw, kb, Mb = sandwich
+    return list(_sum_into_batched(kb, products * G[:, kw], Mb))
 
-        vjp(v) = (dx / dp)^T @ v
+defjvp_batched(sp_diag_sandwich, grad_sp_diag_sandwich_w_forward_batched)
 
-    To do this (see Eq. 5 of https://pubs-acs-org.stanford.idm.oclc.org/doi/pdf/10.1021/acsphotonics.8b01522)
-    we need to solve the following linear system:
 
-        [ df  / dx,  df  / dx*] [ dx  / dp ] = -[ df  / dp]
-        [ df* / dx,  df* / dx*] [ dx* / dp ]    [ df* / dp]
-    
-    Note that we need to explicitly make A a function of x and x* for complex x
+""" ========================== Nonlinear Solve ========================== """
 
-    In our case:
+# relative residual |A(x) x - b| / |b| that the nonlinear solves (and their adjoints) converge to
+NL_RTOL = 1e-10
 
-        (df / dx)  = (dA / dx) @ x + A
-        (df / dx*) = (dA / dx*) @ x
-        (df / dp)  = (dA / dp) @ x
+# maximum number of Newton (or Picard) iterations of a nonlinear solve
+NL_MAX_ITERATIONS = 50
 
-    How do we put this into code?  Let
+# the lagged factorization of A(x) is redone when an iteration reduces the residual by less than this factor
+NL_REFACTOR_RATIO = 0.5
 
-        A(x, p) @ x -> Ax = sp_mult(entries_a(x, p), indices_a, x)
+@ag.primitive
+def sp_solve_nl(parameters, a_indices, b, fn_nl, method='newton'):
+    """ Solve a sparse matrix (A) that depends on the solution, A(x, p) x = b
+    Args:
+      parameters: numpy array of the parameters (p) that the entries of A depend on.
+      a_indices: numpy array with shape (2, num_non_zeros) giving x and y indices for
+        non-zero matrix entries.
+      b: 1d numpy array specifying the source.
+      fn_nl: describes how the entries of A depend on the parameters and the solution, `a_entries = fn_nl(parameters, x)`
+        (it has to be written with autograd.numpy, since it is differentiated for the Newton iterations and the gradients)
+      method: 'newton' for Newton-Krylov iterations, or 'picard' for fixed point iterations x <- A(x)^-1 b
+    Returns:
+      1d numpy array corresponding to the solution of A(x, p) * x = b.
+    Note: Both methods keep one factorization of A(x) for as long as it makes good progress (see `NL_REFACTOR_RATIO`).
+      Picard steps solve with it directly, and Newton steps use it to precondition GMRES on the full Jacobian.
+      The dependence of A on x usually isn't holomorphic (like |x|^2), so the iterations treat the real and imaginary parts of x separately.
+    """
+    return _solve_nl_problem(parameters, a_indices, b, fn_nl, method=method)
 
-    Since we already defined the primitive of sp_mult, we can just do:
+def _realify(x):
+    # the real vector [Re(x), Im(x)] of a complex vector x
+    return npa.concatenate((npa.real(x), npa.imag(x)))
 
-        (dA / dx) @ x -> ag.jacobian(Ax, 0)
+def _complexify(z):
+    # the complex vector x of a real vector z = [Re(x), Im(x)]
+    N = z.size // 2
+    return z[:N] + 1j * z[N:]
 
-    Now how about the source term?
+def _nl_residual(z, parameters, a_indices, b, fn_nl):
+    # f = A(x, p) @ x - b as a real vector, for the real vector z of the solution x
+    x = _complexify(z)
+    return _realify(sp_mult(fn_nl(parameters, x), a_indices, x) - b)
 
-        (dA / dp) @ x -> ag.jacobian(Ax, 1)
+def _nl_factorize(parameters, a_indices, x, fn_nl):
+    # factors A(x, p) with the solver settings (outside of the cache, since every iteration has a new matrix)
+    N = x.size
+    return factorize(make_sparse(fn_nl(parameters, x), a_indices, shape=(N, N)))
+
+def _nl_preconditioner(factorization, N, trans='N'):
+    """ The inverse of A (trans='N') or A^T (trans='T') in the real form of the Jacobian of the nonlinear system, which leaves out the dA/dx terms.
+        The real form of A^T is the one of A^H, whose inverse is conj(A^-T conj(.))
+    """
+    if trans == 'N':
+        solve = lambda r: _realify(factorization.solve(_complexify(r)))
+    else:
+        solve = lambda r: _realify(np.conj(factorization.solve(np.conj(_complexify(r)), trans='T')))
+    return spl.LinearOperator((2 * N, 2 * N), matvec=solve, dtype=np.float64)
+
+def _nl_krylov_solve(J, rhs, M, rtol):
+    """ Solves J y = rhs to a relative residual of `rtol` with GMRES preconditioned by M,
+        restarting it on the remaining residual since scipy's default tolerance (which changed names between versions) is looser
+    """
+    y = np.zeros_like(rhs)
+    norm_rhs = np.linalg.norm(rhs)
+    for _ in range(NL_MAX_ITERATIONS):
+        r = rhs - J.matvec(y)
+        if np.linalg.norm(r) <= rtol * norm_rhs:
+            break
+        dy, _ = spl.gmres(J, r, M=M, atol=0.0)
+        y = y + dy
+    return y
+
+def _solve_nl_problem(parameters, a_indices, b, fn_nl, method='newton'):
+    """ Does the iterations of `sp_solve_nl`, starting from the solution of the linear problem A(0, p) x = b """
+
+    if method not in ('newton', 'picard'):
+        raise ValueError("nonlinear solve method {} not recognized, use 'newton' or 'picard'".format(method))
+
+    b = np.asarray(b, dtype=np.complex128)
+    N = b.size
+    norm_b = np.linalg.norm(b) or 1.0
+    residual = lambda z: _nl_residual(z, parameters, a_indices, b, fn_nl)
+
+    factorization = _nl_factorize(parameters, a_indices, np.zeros(N, dtype=np.complex128), fn_nl)
+    x = factorization.solve(b)
+    res_norm_prev = np.inf
+
+    for iteration in range(NL_MAX_ITERATIONS):
+        z = _realify(x)
+        f = residual(z)
+        res_norm = np.linalg.norm(f) / norm_b
+        if res_norm < NL_RTOL:
+            break
+
+        # redo the lagged factorization once it stops making good progress
+        if res_norm > NL_REFACTOR_RATIO * res_norm_prev:
+            factorization.clear()
+            factorization = _nl_factorize(parameters, a_indices, x, fn_nl)
+        res_norm_prev = res_norm
+
+        if method == 'picard':
+            # x <- x - A(x_lag)^-1 f, which is x <- A(x)^-1 b when the factorization is up to date
+            x = x - factorization.solve(_complexify(f))
+        else:
+            # x <- x - J^-1 f with the Jacobian of the real system applied with autograd's forward mode
+            jvp = lambda v: ag.make_jvp(residual)(z)(v)[1]
+            J = spl.LinearOperator((2 * N, 2 * N), matvec=jvp, dtype=np.float64)
+            dz, _ = spl.gmres(J, -f, M=_nl_preconditioner(factorization, N), atol=0.0)
+            x = x + _complexify(dz)
+    else:
+        warnings.warn("nonlinear solve did not converge (relative residual {:.2e}) after {} iterations".format(res_norm, NL_MAX_ITERATIONS), RuntimeWarning)
+
+    factorization.clear()
+    return x
 
-    Note that this is a matrix, not a vector. 
-    We'll have to handle dA/dx* but this can probably be done, maybe with autograd directly.
+def _nl_adjoint(v, x, parameters, a_indices, b, fn_nl):
+    """ Solves (df / dz)^T lambda = w for the real form z = [Re(x), Im(x)] of the solution of f = A(x, p) @ x - b = 0,
+        where w is the backprop vector v of x put into the real form by autograd
+    """
+    z = _realify(x)
+    N = x.size
+    w = ag.make_vjp(_complexify)(z)[0](v)
+    vjp_z, _ = ag.make_vjp(lambda z: _nl_residual(z, parameters, a_indices, b, fn_nl))(z)
+    JT = spl.LinearOperator((2 * N, 2 * N), matvec=vjp_z, dtype=np.float64)
+    factorization = _nl_factorize(parameters, a_indices, x, fn_nl)
+    adjoint = _nl_krylov_solve(JT, w, _nl_preconditioner(factorization, N, trans='T'), rtol=NL_RTOL)
+    factorization.clear()
+    return adjoint
+
+def grad_sp_solve_nl_parameters(x, parameters, a_indices, b, fn_nl, method='newton'):
+    """
+    We are finding the solution (x) to the nonlinear function:
 
-    Other than this, assuming entries_a(x, p) is fully autograd compatible, we can get these terms no problem!
+        f = A(x, p) @ x - b = 0
 
-    Coming back to our problem, we actually need to compute:
+    And need to define the vjp of the solution (x) with respect to the parameters (p)
 
-        (dx / dp)^T @ v
+        vjp(v) = (dx / dp)^T @ v
 
-    Because
+    (see Eq. 5 of https://pubs.acs.org/doi/10.1021/acsphotonics.8b01522)
+    A depends on x and x* (e.g. through |x|^2), so we work with the real vector z = [Re(x), Im(x)],
+    for which the Jacobian is an ordinary (2N, 2N) real matrix holding the blocks of df/dx and df/dx*:
 
-        (dx / dp) = -(df / dx)^{-1} @ (df / dp)
+        (df / dz) = (dA / dz) @ x + A    (in real form)
 
-    (ignoring the complex conjugate terms).  We can write this vjp as
+    Since f(z(p), p) = 0
 
-        (df / dp)^T @ (df / dx)^{-T} @ v
+        (dz / dp) = -(df / dz)^{-1} @ (df / dp)
 
-    Since df / dp is a matrix, not a vector, its more efficient to do the mat_mul on the right first.
-    So we first solve
+    so the vjp is
 
-        adjoint(v) = -(df / dx)^{-T} @ v
-                   => sp_solve(entries_a_big, transpose(indices_a_big), -v)
+        vjp(v) = -(df / dp)^T @ (df / dz)^{-T} @ v
 
-    and then it's a simple matter of doing the matrix multiplication
+    Since df / dp is a matrix, not a vector, its more efficient to do the mat_mul on the right first.
+    So we first solve the adjoint problem (with GMRES, applying (df / dz)^T with autograd's reverse mode
+    and preconditioning it with the factorization of A^T, see `_nl_adjoint`)
 
-        vjp(v) = (df / dp)^T @ adjoint(v)
-               => sp_mult(entries_dfdp, transpose(indices_dfdp), adjoint)
+        adjoint(v) = (df / dz)^{-T} @ v
 
-    and then return the result, making sure to strip the complex conjugate.
+    and then it's a simple matter of backpropagating -adjoint through f as a function of p
 
-        return vjp[:N]
+        vjp(v) = (df / dp)^T @ -adjoint(v)
     """
 
+    settings = get_solver_settings()
     def vjp(v):
-        raise NotImplementedError
+        with solver_settings(**settings):
+            adjoint = _nl_adjoint(v, x, parameters, a_indices, b, fn_nl)
+        residual_p = lambda p: _nl_residual(_realify(x), p, a_indices, b, fn_nl)
+        return ag.make_vjp(residual_p)(parameters)[0](-adjoint)
     return vjp
 
-def grad_sp_solve_nl_b(x, parameters, a_indices, b, fn_nl):
-
-    """ 
+def grad_sp_solve_nl_b(x, parameters, a_indices, b, fn_nl, method='newton'):
+    """
     Computing the derivative w.r.t b is simpler
 
         f = A(x) @ x - b(p) = 0
 
-    And now the terms we need are
+    And now the term we need is
 
-        df / dx  = (dA / dx) @ x + A
-        df / dx* = (dA / dx*) @ x
         df / dp  = -(db / dp)
 
     So it's basically the same problem with a differenct source term now.
     """
 
+    settings = get_solver_settings()
     def vjp(v):
-        raise NotImplementedError
+        with solver_settings(**settings):
+            adjoint = _nl_adjoint(v, x, parameters, a_indices, b, fn_nl)
+        residual_b = lambda b: _nl_residual(_realify(x), parameters, a_indices, b, fn_nl)
+        return ag.make_vjp(residual_b)(b)[0](-adjoint)
     return vjp
 
 ag.extend.defvjp(sp_solve_nl, grad_sp_solve_nl_parameters, None, grad_sp_solve_nl_b, None)
 
+def _nl_tangent(df, x, parameters, a_indices, b, fn_nl):
+    # dz = -(df / dz)^{-1} @ df for the tangent df of the residual, put back into complex form
+    z = _realify(x)
+    N = x.size
+    jvp = lambda v: ag.make_jvp(lambda z: _nl_residual(z, parameters, a_indices, b, fn_nl))(z)(v)[1]
+    J = spl.LinearOperator((2 * N, 2 * N), matvec=jvp, dtype=np.float64)
+    factorization = _nl_factorize(parameters, a_indices, x, fn_nl)
+    dz = _nl_krylov_solve(J, -df, _nl_preconditioner(factorization, N), rtol=NL_RTOL)
+    factorization.clear()
+    return _complexify(dz)
+
+def grad_sp_solve_nl_parameters_forward(g, x, parameters, a_indices, b, fn_nl, method='newton'):
+    # -(df / dz)^{-1} @ (df / dp) @ g
+    df = ag.make_jvp(lambda p: _nl_residual(_realify(x), p, a_indices, b, fn_nl))(parameters)(g)[1]
+    return _nl_tangent(df, x, parameters, a_indices, b, fn_nl)
+
+def grad_sp_solve_nl_b_forward(g, x, parameters, a_indices, b, fn_nl, method='newton'):
+    # (df / dz)^{-1} @ (db / dp) @ g
+    df = ag.make_jvp(lambda b: _nl_residual(_realify(x), parameters, a_indices, b, fn_nl))(b)(g)[1]
+    return _nl_tangent(df, x, parameters, a_indices, b, fn_nl)
+
+ag.extend.defjvp(sp_solve_nl, grad_sp_solve_nl_parameters_forward, None, grad_sp_solve_nl_b_forward, None)
+
 
 if __name__ == '__main__':
 
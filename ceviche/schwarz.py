@@ -0,0 +1,202 @@
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spl
+import multiprocessing as mp
+import os
+
+"""
+This file contains an overlapping Schwarz (domain decomposition) preconditioner for the 2D (and 1D) FDFD system matrices.
+-  The grid is cut into a rectangular array of subdomains, each extended by `overlap` grid points on every side.
+-  The blocks of A on the extended subdomains are factored in a pool of worker processes, each worker keeping
+   the LU factors of its subdomains in memory, so the factorizations (and their memory) are spread over the cores.
+-  It is applied as restricted additive Schwarz: every subdomain solves with the residual on its extended domain
+   and only its own (non-overlapping) points are kept, which converges faster than the plain additive version.
+It is meant to precondition an outer Krylov iteration, see the 'schwarz' backend in solvers.py.
+"""
+
+# number of grid points each subdomain extends into its neighbours
+SCHWARZ_OVERLAP = 8
+
+
+""" ========================== DOMAIN DECOMPOSITION ========================== """
+
+def split_grid(shape, subdomains, overlap=SCHWARZ_OVERLAP):
+    """ Cuts a grid of `shape` into `subdomains` (number of subdomains along each dimension) overlapping boxes.
+        Returns a list of (indices, core) for every subdomain, where `indices` are the points of the
+        extended subdomain in the flattened grid (like `fdfd._grid_to_vec`), and `core` is a boolean mask
+        of the points of `indices` that belong to this subdomain only.
+    """
+
+    ranges = []
+    for n, num in zip(shape, subdomains):
+        if num > n:
+            raise ValueError("can't split a dimension of {} grid points into {} subdomains".format(n, num))
+        ranges.append([(chunk[0], chunk[-1] + 1) for chunk in np.array_split(np.arange(n), num)])
+
+    boxes = []
+    for (x_start, x_stop) in ranges[0]:
+        for (y_start, y_stop) in ranges[1]:
+            xs = np.arange(max(x_start - overlap, 0), min(x_stop + overlap, shape[0]))
+            ys = np.arange(max(y_start - overlap, 0), min(y_stop + overlap, shape[1]))
+            indices = (xs[:, None] * shape[1] + ys[None, :]).ravel()
+            core = ((xs[:, None] >= x_start) & (xs[:, None] < x_stop) & (ys[None, :] >= y_start) & (ys[None, :] < y_stop)).ravel()
+            boxes.append((indices, core))
+    return boxes
+
+def choose_subdomains(shape, num_subdomains):
+    """ Picks the number of subdomains along each dimension (multiplying to `num_subdomains`) keeping them as square as possible """
+    if shape[1] == 1:
+        return (num_subdomains, 1)
+    if shape[0] == 1:
+        return (1, num_subdomains)
+    best = None
+    for nx in range(1, num_subdomains + 1):
+        if num_subdomains % nx == 0:
+            ny = num_subdomains // nx
+            aspect = abs(np.log((shape[0] / nx) / (shape[1] / ny)))
+            if best is None or aspect < best[0]:
+                best = (aspect, (nx, ny))
+    return best[1]
+
+
+""" ============================ WORKER PROCESSES ============================ """
+
+def _worker_loop(conn):
+    """ Runs in a worker process: factors the subdomain blocks it's sent and solves with them until told to stop.
+        Messages are ('factor', blocks), ('solve', trans, right hand sides) and ('close',)
+    """
+    lus = []
+    while True:
+        message = conn.recv()
+        if message[0] == 'factor':
+            lus = [spl.splu(block.tocsc()) for block in message[1]]
+            conn.send(None)
+        elif message[0] == 'solve':
+            _, trans, rhs = message
+            conn.send([lu.solve(b, trans=trans) for lu, b in zip(lus, rhs)])
+        else:
+            break
+    conn.close()
+
+class _LocalWorker():
+    """ Stands in for a worker process when solving the subdomains in the calling process (num_workers=0) """
+
+    def send_factor(self, blocks):
+        self.lus = [spl.splu(block.tocsc()) for block in blocks]
+
+    def recv_factor(self):
+        pass
+
+    def send_solve(self, trans, rhs):
+        self.result = [lu.solve(b, trans=trans) for lu, b in zip(self.lus, rhs)]
+
+    def recv_solve(self):
+        return self.result
+
+    def close(self):
+        self.lus = []
+
+class _ProcessWorker():
+    """ Handle on a worker process holding the factorizations of some of the subdomains """
+
+    def __init__(self):
+        self.conn, child_conn = mp.Pipe()
+        self.process = mp.Process(target=_worker_loop, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def send_factor(self, blocks):
+        self.conn.send(('factor', blocks))
+
+    def recv_factor(self):
+        self.conn.recv()
+
+    def send_solve(self, trans, rhs):
+        self.conn.send(('solve', trans, rhs))
+
+    def recv_solve(self):
+        return self.conn.recv()
+
+    def close(self):
+        if self.process.is_alive():
+            self.conn.send(('close',))
+            self.process.join()
+        self.conn.close()
+
+
+""" ========================= SCHWARZ PRECONDITIONER ========================= """
+
+class SchwarzSolver():
+    """ Approximately solves A x = b (trans='N') or A^T x = b (trans='T') with restricted additive Schwarz.
+            A: sparse FDFD matrix on a grid of `shape`
+            num_workers: number of worker processes factoring and solving the subdomains, by default the number of cores.
+                         0 solves the subdomains in the calling process.
+            subdomains: number of subdomains along each dimension, by default one subdomain per worker (see `choose_subdomains`)
+        Call `close` when done with it to stop the worker processes.
+    """
+
+    def __init__(self, A, shape, num_workers=None, subdomains=None, overlap=SCHWARZ_OVERLAP):
+
+        shape = tuple(shape)
+        if int(np.prod(shape)) != A.shape[0]:
+            raise ValueError("grid shape {} doesn't match the matrix of shape {}".format(shape, A.shape))
+
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        if subdomains is None:
+            subdomains = choose_subdomains(shape, max(num_workers, 1))
+
+        self.boxes = split_grid(shape, subdomains, overlap=overlap)
+
+        # deal the subdomains out to the workers
+        num_workers = min(num_workers, len(self.boxes))
+        if num_workers == 0:
+            self.workers = [_LocalWorker()]
+        else:
+            self.workers = [_ProcessWorker() for _ in range(num_workers)]
+        self.assignments = [list(range(i, len(self.boxes), len(self.workers))) for i in range(len(self.workers))]
+
+        self.refactor(A)
+
+    def refactor(self, A):
+        """ Factors the subdomain blocks of a new matrix A on the same grid, keeping the worker processes """
+        A = sp.csr_matrix(A)
+        blocks = [A[indices][:, indices] for indices, _ in self.boxes]
+        for worker, assigned in zip(self.workers, self.assignments):
+            worker.send_factor([blocks[i] for i in assigned])
+        for worker in self.workers:
+            worker.recv_factor()
+
+    def solve(self, b, trans='N'):
+        """ Applies the preconditioner to b (a vector, or a matrix of right hand sides in its columns) """
+        b = np.asarray(b, dtype=np.complex128)
+        if b.ndim == 2:
+            return np.stack([self.solve(b[:, i], trans=trans) for i in range(b.shape[1])], axis=1)
+
+        # the transpose of restricted Schwarz restricts the right hand side to the core instead of the solution
+        rhs = []
+        for indices, core in self.boxes:
+            b_local = b[indices]
+            if trans == 'T':
+                b_local = np.where(core, b_local, 0)
+            rhs.append(b_local)
+
+        # all of the workers solve at the same time
+        for worker, assigned in zip(self.workers, self.assignments):
+            worker.send_solve(trans, [rhs[i] for i in assigned])
+
+        x = np.zeros_like(b)
+        for worker, assigned in zip(self.workers, self.assignments):
+            for i, x_local in zip(assigned, worker.recv_solve()):
+                indices, core = self.boxes[i]
+                if trans == 'T':
+                    np.add.at(x, indices, x_local)
+                else:
+                    x[indices[core]] = x_local[core]
+        return x
+
+    def close(self):
+        """ Stops the worker processes, freeing the factorizations """
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
@@ -1,5 +1,21 @@
 import numpy as np
+import scipy.sparse as sp
 import scipy.sparse.linalg as spl
+import hashlib
+import inspect
+import os
+import time
+import warnings
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from scipy.linalg import lapack, lu_factor, lu_solve
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+
+from .multigrid import MultigridSolver, estimate_kh
+from .schwarz import SchwarzSolver
+from .utils import transpose_indices, make_sparse
 
 
 """ This file stores the various sparse linear system solvers you can use for FDFD """
@@ -13,9 +29,17 @@ except:
     HAS_MKL = False
     # print('using scipy.sparse for direct solvers.  Note: using MKL will make things significantly faster.')
 
+# same for UMFPACK (from the scikit-umfpack package)
+try:
+    import scikits.umfpack as umfpack
+    HAS_UMFPACK = True
+except:
+    HAS_UMFPACK = False
+
 # default iterative method to use
 # for reference on the methods available, see:  https://docs.scipy.org/doc/scipy/reference/sparse.linalg.html
-DEFAULT_ITERATIVE_METHOD = 'bicg'
+# bicg breaks down on the (complex symmetric, indefinite) FDFD matrices before reaching ITERATIVE_RTOL, restarted gmres doesn't
+DEFAULT_ITERATIVE_METHOD = 'gmres_100'
 
 # dict of iterative methods supported (name: function)
 ITERATIVE_METHODS = {
@@ -26,59 +50,1269 @@ ITERATIVE_METHODS = {
     'gmres': spl.gmres,
     'lgmres': spl.lgmres,
     'qmr': spl.qmr,
-    'gcrotmk': spl.gcrotmk
+    'gcrotmk': spl.gcrotmk,
+    'gmres_100': partial(spl.gmres, restart=100)
 }
 
-# convergence tolerance for iterative solvers.
-ATOL = 1e-8
+# convergence tolerance for iterative solvers, relative to the right hand side: they stop once |A x - b| <= ITERATIVE_RTOL |b|.
+# (an absolute tolerance would accept x = 0 for the tiny right hand sides of many adjoint solves)
+ITERATIVE_RTOL = 1e-8
+
+# scipy's iterative methods call the relative tolerance 'rtol' since scipy 1.12, and 'tol' before
+_RTOL_KEYWORD = 'rtol' if 'rtol' in inspect.signature(spl.gmres).parameters else 'tol'
+
+# default preconditioner for the iterative methods (None means no preconditioning)
+DEFAULT_PRECONDITIONER = None
+
+# parameters of the incomplete LU preconditioner (see scipy.sparse.linalg.spilu), scipy's defaults.
+# the fill factor bounds the memory of the ILU factors to that many times the nonzeros of A,
+# a 2D grid's full LU is not much bigger than 30 times, so hard problems that need more fill are better off with a direct backend.
+# it can be raised for the whole module by setting `ceviche.solvers.ILU_FILL_FACTOR`, or for one solve with a preconditioner function like
+#     solver_settings(preconditioner=lambda A: make_ilu_preconditioner(A, fill_factor=20))
+ILU_DROP_TOL = 1e-4
+ILU_FILL_FACTOR = 10
+
+# complex shift applied to the 'mass' (omega^2 * eps) term of A for the shifted-Laplacian preconditioners
+# its sign matches the damping of the PML, which takes about a third fewer iterations than the opposite sign
+SHIFTED_LAPLACIAN_SHIFT = -0.5j
+
+# restart length of the GMRES iterations of the 'multigrid' backend
+MULTIGRID_GMRES_RESTART = 100
+
+# restart length of the GMRES iterations of the 'schwarz' backend
+SCHWARZ_GMRES_RESTART = 100
+
+# the 'mixed' backend refines its single precision solutions until the relative residual is below this
+MIXED_PRECISION_RTOL = 1e-12
+
+# number of iterative refinement steps of the 'mixed' backend before switching to GMRES
+MIXED_PRECISION_MAX_REFINEMENTS = 10
+
+# the 'fallback' backend moves on to the next step of its chain when a solve has a relative residual |A x - b| / |b| above this
+FALLBACK_RTOL = 1e-4
+
+# steps (solver settings) tried in order by the 'fallback' backend: preconditioned bicgstab, GMRES with a long restart, then a direct solve
+DEFAULT_FALLBACK_CHAIN = (
+    {'backend': 'iterative', 'iterative_method': 'bicgstab', 'preconditioner': 'ilu'},
+    {'backend': 'iterative', 'iterative_method': 'gmres_100', 'preconditioner': 'ilu'},
+    {'backend': 'superlu'},
+)
+
+# index of the step of the fallback chain that last worked for each sparsity pattern, which the 'fallback' backend tries first
+_fallback_steps = {}
+
+# the 'woodbury' backend applies changes to at most this many rows of the reference matrix with a low-rank update,
+# which stores an (N, rows) dense matrix, and otherwise uses the reference factorization as a preconditioner for GMRES
+WOODBURY_MAX_RANK = 128
+
+# number of reference factorizations (one per sparsity pattern) kept around by the 'woodbury' backend
+REFERENCE_CACHE_SIZE = 2
+
+# stores the (matrix, factorization) of the reference matrix of each sparsity pattern used by the 'woodbury' backend
+_reference_factorizations = OrderedDict()
+
+# number of warm-started solve slots kept around (each one holds a solution vector, and a batched solve uses one slot per right hand side)
+WARM_START_CACHE_SIZE = 16
+
+# stores the last solution found in the most recently used warm-started solve slots (see `solve_linear`)
+_warm_starts = OrderedDict()
+
+# number of factorized matrices kept around for reuse (each one can take a lot of memory for large problems)
+# one is enough for the adjoint solve to reuse the forward factorization
+FACTORIZATION_CACHE_SIZE = 1
+
+# stores the most recently used factorizations, keyed by the solver backend and the content of the (entries, indices) of the matrix
+_factorization_cache = OrderedDict()
+
+# options of scipy's `splu` for symmetric matrices: order A + A^T and prefer pivots on the diagonal.
+# a diagonal entry is only passed over if it is smaller than this fraction of the largest one in its column (0.1 as SuperLU suggests),
+# never pivoting off the diagonal loses a lot of accuracy on matrices with small diagonal entries
+SUPERLU_SYMMETRIC_PIVOT_THRESH = 0.1
+SUPERLU_SYMMETRIC_OPTIONS = {'permc_spec': 'MMD_AT_PLUS_A', 'diag_pivot_thresh': SUPERLU_SYMMETRIC_PIVOT_THRESH, 'options': {'SymmetricMode': True}}
+
+# number of fill-reducing orderings (one per sparsity pattern) kept around for reuse by SuperLU
+ORDERING_CACHE_SIZE = 16
+
+# stores the fill-reducing orderings computed by SuperLU, keyed by the sparsity pattern of the matrix and whether it is symmetric
+# (and the bandwidth-reducing ones of the 'banded' backend), they are also saved in the 'ordering_cache_dir' setting if it is set
+_ordering_cache = OrderedDict()
+
+# environment variable giving the default directory where the orderings are saved, so new processes don't need to recompute them
+ORDERING_CACHE_DIR_VARIABLE = 'CEVICHE_ORDERING_CACHE_DIR'
+
+# relative tolerance on max|A - A^T| / max|A| below which a matrix is treated as complex symmetric (A = A^T)
+SYMMETRY_RTOL = 1e-10
+
+# the 'auto' backend solves matrices with at most this many nonzero diagonals with the 'banded' backend
+AUTO_BANDED_MAX_DIAGONALS = 11
+
+# the 'auto' backend also uses the 'banded' backend for (quasi) 1D grids at most this many points thick,
+# whose periodic boundaries put entries far from the diagonal, but which have a narrow band once reordered
+AUTO_BANDED_MAX_THICKNESS = 4
+
+# the 'auto' backend switches to the 'iterative' backend when a direct factorization would take more than this fraction of the free memory
+AUTO_MEMORY_FRACTION = 0.5
+
+# settings of the solves done in the primitives (sp_solve, sp_solve_batch), change them using `solver_settings`
+#   backend: key into BACKENDS, or 'auto' to pick one based on the size of the problem (see `choose_backend`)
+#   iterative_method: key into ITERATIVE_METHODS used by the 'iterative' backend
+#   preconditioner: preconditioner used by the 'iterative' backend (see `make_preconditioner`)
+#   symmetric: whether the direct backends may use a symmetric factorization, True, False or 'auto' to check each matrix (see `is_symmetric`)
+#   grid_shape: shape of the FDFD grid of the matrices, needed by the 'multigrid' and 'schwarz' backends (set by `fdfd.solve`)
+#   num_workers: number of worker processes of the 'schwarz' backend, None uses one per core
+#   subdomains: number of subdomains along each grid dimension of the 'schwarz' backend, None uses one per worker
+#   fallback_chain: list of solver settings tried in order by the 'fallback' backend, None uses DEFAULT_FALLBACK_CHAIN
+#   ordering_cache_dir: directory where the orderings of the direct backends are saved and loaded from, None to only keep them in memory
+_settings = {
+    'backend': 'auto',
+    'iterative_method': DEFAULT_ITERATIVE_METHOD,
+    'preconditioner': 'ilu',
+    'symmetric': 'auto',
+    'grid_shape': None,
+    'num_workers': None,
+    'subdomains': None,
+    'fallback_chain': None,
+    'ordering_cache_dir': os.environ.get(ORDERING_CACHE_DIR_VARIABLE),
+}
 
 """ ========================== SOLVER FUNCTIONS ========================== """
 
-def solve_linear(A, b, iterative_method=False):
-    """ Master function to call the others """
+def solve_linear(A, b, iterative_method=False, preconditioner=DEFAULT_PRECONDITIONER, x0=None, slot=None):
+    """ Master function to call the others
+            A: sparse matrix, or a LinearOperator (e.g. from `fdfd.make_operator`) for the iterative methods
+            x0: initial guess for the iterative methods
+            slot: hashable key naming a logical solve that is repeated, for example ('forward', id(simulation))
+                  and ('adjoint', id(simulation)) in an optimization. If `x0` isn't supplied, the iterative
+                  methods start from the last solution found in this slot, which is usually close when A changes little.
+    """
+
+    if x0 is None and slot is not None:
+        x0 = _get_warm_start(slot, b)
 
     if iterative_method and iterative_method is not None:
         # if iterative solver string is supplied, use that method
-        return _solve_iterative(A, b, iterative_method=iterative_method)
+        x = _solve_iterative(A, b, iterative_method=iterative_method, preconditioner=preconditioner, x0=x0)
     elif iterative_method and iterative_method is None:
         # if iterative_method is supplied as None, use the default
-        return _solve_iterative(A, b, iterative_method=DEFAULT_ITERATIVE_METHOD)
+        x = _solve_iterative(A, b, iterative_method=DEFAULT_ITERATIVE_METHOD, preconditioner=preconditioner, x0=x0)
+    elif isinstance(A, spl.LinearOperator):
+        raise ValueError("matrix-free operators can only be solved with an iterative method, set `iterative_method`")
     else:
         # otherwise, use a direct solver
-        return _solve_direct(A, b)
+        x = _solve_direct(A, b)
 
-def _solve_direct(A, b):
-    """ Direct solver """
+    if slot is not None:
+        _remember_warm_start(slot, x)
+    return x
 
-    if HAS_MKL:
-        # prefered method using MKL. Much faster (on Mac at least)
-        pSolve = pardisoSolver(A, mtype=13)
-        pSolve.factor()
-        x = pSolve.solve(b)
-        pSolve.clear()
-        return x
+def _remember_warm_start(slot, x):
+    _warm_starts[slot] = x
+    _warm_starts.move_to_end(slot)
+    while len(_warm_starts) > WARM_START_CACHE_SIZE:
+        _warm_starts.popitem(last=False)
+
+def _get_warm_start(slot, b):
+    """ Returns the last solution stored in `slot` if there is one matching the size of `b`, otherwise None """
+    x0 = _warm_starts.get(slot)
+    if x0 is not None and x0.size == b.size:
+        _warm_starts.move_to_end(slot)
+        return x0.reshape(b.shape)
+    return None
+
+def clear_warm_starts(slot=None):
+    """ Forgets the stored solution of `slot`, or of all slots if `slot` is None """
+    if slot is None:
+        _warm_starts.clear()
     else:
-        # scipy solver.
-        return spl.spsolve(A, b)
+        _warm_starts.pop(slot, None)
 
-def _solve_iterative(A, b, iterative_method=DEFAULT_ITERATIVE_METHOD):
+def _solve_direct(A, b):
+    """ Direct solver, uses the backend from the current solver settings (see `solver_settings`) """
+    t0 = time.perf_counter()
+    factorization = factorize(A)
+    t1 = time.perf_counter()
+    x = factorization.solve(b)
+    if _telemetry_collectors:
+        _record_solve(factorization, A, b, x, 'N', factor_time=t1 - t0, solve_time=time.perf_counter() - t1)
+    factorization.clear()
+    return x
+
+def _solve_iterative(A, b, iterative_method=DEFAULT_ITERATIVE_METHOD, preconditioner=DEFAULT_PRECONDITIONER, x0=None):
     """ Iterative solver """
+    solver_fn = _get_iterative_method(iterative_method)
+    t0 = time.perf_counter()
+    inverse = make_preconditioner(A, preconditioner)
+    t1 = time.perf_counter()
+    x, info, iterations = _run_iterative(solver_fn, A, b, inverse=inverse, x0=x0)
+    if _telemetry_collectors:
+        _telemetry_append(SolveRecord(kind=_telemetry_kind[-1], backend='iterative', N=A.shape[0], num_rhs=1, trans='N',
+                                      cached=False, factor_time=t1 - t0, solve_time=time.perf_counter() - t1,
+                                      fill_in=_fill_in(inverse), iterations=iterations, info=info,
+                                      residual=_relative_residual(A, b, x)))
+    return x
+
+def _get_iterative_method(iterative_method):
+    """ Looks up the scipy function of `iterative_method` """
 
     # error checking on the method name (https://docs.scipy.org/doc/scipy/reference/sparse.linalg.html)
     try:
-        solver_fn = ITERATIVE_METHODS[iterative_method]
+        return ITERATIVE_METHODS[iterative_method]
     except:
         raise ValueError("iterative method {} not found.\n supported methods are:\n {}".format(iterative_method, ITERATIVE_METHODS))
 
-    # call the solver using scipy's API
-    x, info = solver_fn(A, b, atol=ATOL)
-    return x
+def _run_iterative(solver_fn, A, b, inverse=None, x0=None, trans='N'):
+    """ Solves A x = b (trans='N') or A^T x = b (trans='T') with the iterative method `solver_fn`,
+        preconditioned by `inverse` (an approximate inverse of A from `make_preconditioner`, or None)
+        Returns the solution, scipy's `info` code (0 if it converged) and the number of iterations.
+        Raises a RuntimeError if the method doesn't converge to a relative residual of ITERATIVE_RTOL (or breaks down).
+    """
+
+    norm_b = np.linalg.norm(b)
+    if norm_b == 0:
+        return np.zeros(b.shape, dtype=np.result_type(b, np.complex128)), 0, 0
+
+    M = None
+    if inverse is not None:
+        # M^H v = conj(M^T conj(v)), which methods like bicg and qmr need
+        other_trans = 'T' if trans == 'N' else 'N'
+        M = spl.LinearOperator(A.shape, matvec=lambda v: inverse.solve(v, trans=trans),
+                               rmatvec=lambda v: np.conj(inverse.solve(np.conj(v), trans=other_trans)), dtype=np.complex128)
+    A_trans = A if trans == 'N' else A.T
+
+    # call the solver using scipy's API, counting the iterations with its callback
+    iterations = [0]
+    def count(_):
+        iterations[0] += 1
+    options = {'callback_type': 'pr_norm'} if getattr(solver_fn, 'func', solver_fn) is spl.gmres else {}
+    options[_RTOL_KEYWORD] = ITERATIVE_RTOL
+
+    # the system is solved for b / |b|, since some methods (like bicg) have absolute breakdown tests that tiny right hand sides trip
+    x0 = None if x0 is None else x0 / norm_b
+    x, info = solver_fn(A_trans, b / norm_b, x0=x0, atol=ITERATIVE_RTOL, M=M, callback=count, **options)
+    if info != 0:
+        raise RuntimeError("iterative solve did not converge (info = {}) after {} iterations".format(info, iterations[0]))
+    return norm_b * x, info, iterations[0]
 
 def _solve_cuda(A, b, **kwargs):
     """ You could put some other solver here if you're feeling adventurous """
     raise NotImplementedError("Please implement something fast and exciting here!")
 
 
+""" =========================== PRECONDITIONERS ========================== """
+
+def make_preconditioner(A, preconditioner):
+    """ Makes an approximate inverse of A to precondition the iterative methods.
+        `preconditioner` is either None (no preconditioning), a key into PRECONDITIONERS,
+        or a function of A returning an object with a `solve(b, trans='N')` method that approximately
+        solves A x = b (trans='N') or A^T x = b (trans='T'), like scipy's SuperLU objects.
+    """
+
+    if preconditioner is None:
+        return None
+    elif callable(preconditioner):
+        return preconditioner(A)
+
+    try:
+        preconditioner_fn = PRECONDITIONERS[preconditioner]
+    except:
+        raise ValueError("preconditioner {} not found.\n supported preconditioners are:\n {}".format(preconditioner, PRECONDITIONERS))
+    return preconditioner_fn(A)
+
+def make_ilu_preconditioner(A, drop_tol=None, fill_factor=None):
+    """ Incomplete LU factorization of A with drop tolerance `drop_tol` and at most `fill_factor` times the nonzeros of A
+        (by default ILU_DROP_TOL and ILU_FILL_FACTOR)
+    """
+    drop_tol = ILU_DROP_TOL if drop_tol is None else drop_tol
+    fill_factor = ILU_FILL_FACTOR if fill_factor is None else fill_factor
+    return spl.spilu(A.tocsc(), drop_tol=drop_tol, fill_factor=fill_factor)
+
+def make_shifted_laplacian_preconditioner(A, shift=SHIFTED_LAPLACIAN_SHIFT, mass=None, inner='ilu'):
+    """ Complex shifted-Laplacian preconditioner.
+        Adds `shift` times the mass term (the omega^2 * eps diagonal) to A, which damps the waves
+        and makes the shifted matrix much easier to (approximately) invert than A itself.
+            mass: diagonal mass term of A.  By default, it is computed as A @ 1, since the
+                  rows of the FDFD curl-curl operator sum to zero (exactly so without bloch phases)
+            inner: how to invert the shifted matrix, 'ilu' (cheap, approximate) or 'direct'
+    """
+
+    if mass is None:
+        mass = A.dot(np.ones(A.shape[0]))
+    A_shifted = (A + sp.diags(shift * mass)).tocsc()
+
+    if inner == 'ilu':
+        return spl.spilu(A_shifted, drop_tol=ILU_DROP_TOL, fill_factor=ILU_FILL_FACTOR)
+    elif inner == 'direct':
+        return spl.splu(A_shifted)
+    else:
+        raise ValueError("inner solve {} not recognized, must be one of 'ilu' or 'direct'".format(inner))
+
+def make_multigrid_preconditioner(A, shape=None, shift=SHIFTED_LAPLACIAN_SHIFT, mass=None):
+    """ Complex shifted-Laplacian preconditioner (see above) inverted approximately by one geometric multigrid V-cycle.
+        Its cost and memory scale linearly with the size of A, see multigrid.py for the details.
+            shape: shape of the FDFD grid of A, by default the 'grid_shape' solver setting
+    """
+
+    if shape is None:
+        shape = _settings['grid_shape']
+    if shape is None:
+        raise ValueError("the multigrid preconditioner needs the shape of the grid, set it with `solver_settings(grid_shape=...)`")
+
+    if mass is None:
+        mass = A.dot(np.ones(A.shape[0]))
+    A_shifted = (A + sp.diags(shift * mass)).tocsr()
+    return MultigridSolver(A_shifted, shape, kh=estimate_kh(A, mass))
+
+# dict of preconditioners supported (name: function of A returning the approximate inverse)
+PRECONDITIONERS = {
+    'ilu': make_ilu_preconditioner,
+    'shifted_laplacian': make_shifted_laplacian_preconditioner,
+    'multigrid': make_multigrid_preconditioner,
+}
+
+
+""" =========================== SOLVER BACKENDS ========================== """
+
+# Each backend is a class that factorizes (or otherwise prepares) a sparse matrix A when constructed with (A, pattern, symmetric).
+# If `symmetric` is True, A is complex symmetric (A = A^T) and the backend may factor it as such, otherwise it must ignore it.
+# Its instances need the methods
+#     solve(b, trans='N'): solves A x = b (trans='N') or A^T x = b (trans='T'), where b can also be a (N, num_rhs) matrix
+#     refactor(A):         prepares a new matrix A with the same sparsity pattern, reusing whatever it can
+#     clear():             frees the memory
+# and `pattern` and `symmetric` attributes storing the sparsity pattern key (see `pattern_key`) and flag passed to the constructor.
+
+class _SuperLUFactorization():
+    """ Holds a scipy SuperLU factorization of a sparse matrix A.
+        Symmetric matrices use SuperLU's symmetric mode: an ordering of A + A^T and (mostly) diagonal pivots, which keeps the
+        factors close to symmetric in structure (scipy has no sparse LDL^T) and needs about half the fill and time.
+    """
+
+    def __init__(self, A, pattern=None, symmetric=False):
+        self.pattern = pattern
+        self.symmetric = symmetric
+        self.options = SUPERLU_SYMMETRIC_OPTIONS if symmetric else {}
+        self.refactor(A)
+
+    def refactor(self, A):
+        """ Factors A, reusing the fill-reducing ordering of any previous matrix with the same sparsity pattern """
+        # free the factors of the previous matrix first, so the two sets of factors are never in memory together
+        self.lu = None
+        A = A.tocsc()
+        ordering_key = (self.pattern, self.symmetric)
+        self.order = _get_cached_ordering(ordering_key)
+        if self.order is None:
+            self.lu = spl.splu(A, **self.options)
+            # SuperLU's `perm_c` is stored as the inverse of the ordering we want to apply to A
+            _store_ordering(ordering_key, np.argsort(self.lu.perm_c))
+        else:
+            # symmetrically permuting A with the cached ordering lets SuperLU skip computing one
+            options = dict(self.options, permc_spec='NATURAL')
+            self.lu = spl.splu(A[self.order][:, self.order].tocsc(), **options)
+
+    def solve(self, b, trans='N'):
+        """ Solves A x = b (trans='N') or A^T x = b (trans='T') """
+        b = np.asarray(b, dtype=np.complex128)
+        if self.order is None:
+            return self.lu.solve(b, trans=trans)
+        x = np.empty_like(b)
+        x[self.order] = self.lu.solve(b[self.order], trans=trans)
+        return x
+
+    def clear(self):
+        self.lu = None
+
+class _MixedPrecisionFactorization(_SuperLUFactorization):
+    """ Holds a single precision (complex64) SuperLU factorization of A, which takes half the memory of the double one.
+        Solutions are refined to double precision accuracy with iterative refinement using the single precision factors,
+        and GMRES preconditioned by them if the refinement stagnates (for badly conditioned A).
+        The relative residuals of each refinement step of the last solve are kept in `residuals`, one list per right hand side,
+        and the number of refinement steps and `info` code of GMRES (0 if it wasn't needed) in `iterations` and `info`.
+    """
+
+    def refactor(self, A):
+        self.A = A.tocsr()
+        self.residuals, self.iterations, self.info = [], [], []
+        super().refactor(A.astype(np.complex64))
+
+    def solve(self, b, trans='N'):
+        """ Solves A x = b (trans='N') or A^T x = b (trans='T') """
+        b = np.asarray(b, dtype=np.complex128)
+        self.residuals, self.iterations, self.info = [], [], []
+        if b.ndim == 2:
+            return np.stack([self._refine(b[:, i], trans) for i in range(b.shape[1])], axis=1)
+        return self._refine(b, trans)
+
+    def _solve_single(self, b, trans):
+        """ Solves with the single precision factors """
+        b = b.astype(np.complex64)
+        if self.order is None:
+            return self.lu.solve(b, trans=trans).astype(np.complex128)
+        x = np.empty(b.shape, dtype=np.complex128)
+        x[self.order] = self.lu.solve(b[self.order], trans=trans)
+        return x
+
+    def _refine(self, b, trans):
+        A_trans = self.A if trans == 'N' else self.A.T
+        norm_b = np.linalg.norm(b)
+        history = []
+        self.residuals.append(history)
+        if norm_b == 0:
+            self.iterations.append(0)
+            self.info.append(0)
+            return np.zeros_like(b)
+
+        x = self._solve_single(b, trans)
+        for step in range(MIXED_PRECISION_MAX_REFINEMENTS):
+            r = b - A_trans.dot(x)
+            history.append(float(np.linalg.norm(r) / norm_b))
+            if history[-1] <= MIXED_PRECISION_RTOL:
+                self.iterations.append(step)
+                self.info.append(0)
+                return x
+            x = x + self._solve_single(r, trans)
+
+        # the refinement stagnated, which happens when A is too badly conditioned for single precision
+        M = spl.LinearOperator(A_trans.shape, matvec=lambda v: self._solve_single(v, trans), dtype=np.complex128)
+        x, info = spl.gmres(A_trans, b, x0=x, atol=MIXED_PRECISION_RTOL * norm_b, M=M, **{_RTOL_KEYWORD: MIXED_PRECISION_RTOL})
+        history.append(float(np.linalg.norm(b - A_trans.dot(x)) / norm_b))
+        self.iterations.append(MIXED_PRECISION_MAX_REFINEMENTS)
+        self.info.append(info)
+        if info != 0:
+            raise RuntimeError("mixed precision solve did not converge (info = {}), relative residual {}".format(info, history[-1]))
+        return x
+
+    def clear(self):
+        super().clear()
+        self.A = None
+
+class _UMFPACKFactorization():
+    """ Holds an UMFPACK factorization of a sparse matrix A (needs scikit-umfpack) """
+
+    def __init__(self, A, pattern=None, symmetric=False):
+        if not HAS_UMFPACK:
+            raise ValueError("the 'umfpack' backend needs the scikit-umfpack package, which could not be imported")
+        self.pattern = pattern
+        self.symmetric = symmetric
+        self.context = None
+        self.refactor(A)
+
+    def refactor(self, A):
+        """ Factors A, the context keeps the symbolic analysis of the first matrix and reuses it since the pattern is the same """
+        self.A = A.tocsc()
+        self.A.sort_indices()
+        if self.context is None:
+            family = 'zi' if self.A.indices.dtype == np.int32 else 'zl'
+            self.context = umfpack.UmfpackContext(family)
+        self.context.numeric(self.A)
+
+    def solve(self, b, trans='N'):
+        """ Solves A x = b (trans='N') or A^T x = b (trans='T') """
+        b = np.asarray(b, dtype=np.complex128)
+        if b.ndim == 2:
+            return np.stack([self.solve(b[:, i], trans=trans) for i in range(b.shape[1])], axis=1)
+        # UMFPACK_Aat solves with the (non-conjugated) transpose of A
+        system = umfpack.UMFPACK_A if trans == 'N' else umfpack.UMFPACK_Aat
+        return self.context.solve(system, self.A, b, autoTranspose=False)
+
+    def clear(self):
+        self.context.free()
+
+class _PardisoFactorization():
+    """ Holds an MKL Pardiso factorization of a sparse matrix A.
+        Symmetric matrices are factored as such (mtype=6), which only stores and factors the upper triangle of A.
+    """
+
+    def __init__(self, A, pattern=None, symmetric=False):
+        if not HAS_MKL:
+            raise ValueError("the 'pardiso' backend needs the pyMKL package, which could not be imported")
+        self.pattern = pattern
+        self.symmetric = symmetric
+        self.solver = pardisoSolver(A.tocsr(), mtype=6 if symmetric else 13)
+        self.solver.factor()
+
+    def refactor(self, A):
+        """ Factors A, which must have the same sparsity pattern as the original matrix.
+            Only the numerical factorization (phase 22) is redone, the ordering and symbolic analysis are reused.
+        """
+        A = sp.triu(A, format='csr') if self.symmetric else A.tocsr()
+        A.sort_indices()
+        self.solver.a[:] = A.data
+        self.solver.run_pardiso(phase=22)
+
+    def solve(self, b, trans='N'):
+        """ Solves A x = b (trans='N') or A^T x = b (trans='T') """
+        # iparm[11] = 2 tells pardiso to solve the transposed system using the same factors, symmetric systems don't need it
+        self.solver.iparm[11] = 2 if trans == 'T' and not self.symmetric else 0
+        return self.solver.solve(b)
+
+    def clear(self):
+        self.solver.clear()
+
+class _BandedFactorization():
+    """ Holds a LAPACK band LU factorization of a sparse matrix A with few nonzero diagonals.
+        Matrices with a wider band (like those of 1D grids with periodic boundaries, whose corners are nonzero)
+        are first reordered with reverse Cuthill-McKee to narrow it, the ordering is reused for the same sparsity pattern.
+    """
+
+    def __init__(self, A, pattern=None, symmetric=False):
+        self.pattern = pattern
+        self.symmetric = symmetric
+        self.refactor(A)
+
+    def refactor(self, A):
+        self.lu = None
+        A = A.tocsr()
+        self.order = self._get_ordering(A)
+        if self.order is not None:
+            A = A[self.order][:, self.order]
+        A = A.tocoo()
+        N = A.shape[0]
+        self.kl, self.ku = _bandwidths((A.row, A.col))
+
+        # LAPACK band storage: A[i, j] goes in ab[kl + ku + i - j, j], the first kl rows are space for the pivoting
+        ab = np.zeros((2 * self.kl + self.ku + 1, N), dtype=np.complex128)
+        np.add.at(ab, (self.kl + self.ku + A.row - A.col, A.col), A.data)
+
+        self.lu, self.piv, info = lapack.zgbtrf(ab, self.kl, self.ku)
+        if info > 0:
+            raise RuntimeError("Factor is exactly singular")
+
+    def _get_ordering(self, A):
+        """ The reverse Cuthill-McKee ordering of A, or None if it doesn't narrow the band of A """
+        # an empty ordering is cached when A is used as is
+        ordering_key = (self.pattern, 'banded')
+        order = _get_cached_ordering(ordering_key)
+        if order is None:
+            kl, ku = _bandwidths(A.nonzero())
+            order = np.zeros(0, dtype=np.int64)
+            if kl + ku + 1 > AUTO_BANDED_MAX_DIAGONALS:
+                structure = (abs(A) + abs(A.T)).tocsr()
+                rcm_order = reverse_cuthill_mckee(structure, symmetric_mode=True).astype(np.int64)
+                A_ordered = structure[rcm_order][:, rcm_order]
+                if sum(_bandwidths(A_ordered.nonzero())) < kl + ku:
+                    order = rcm_order
+            _store_ordering(ordering_key, order)
+        return order if order.size else None
+
+    def solve(self, b, trans='N'):
+        """ Solves A x = b (trans='N') or A^T x = b (trans='T') """
+        b = np.asarray(b, dtype=np.complex128)
+        if self.order is not None:
+            # P A P^T is factored, and (P A P^T)^T = P A^T P^T, so the same permutation works for both
+            x = np.empty_like(b)
+            x[self.order] = self._solve_band(b[self.order], trans)
+            return x
+        return self._solve_band(b, trans)
+
+    def _solve_band(self, b, trans):
+        x, info = lapack.zgbtrs(self.lu, self.kl, self.ku, b.reshape((b.shape[0], -1)), self.piv, trans=0 if trans == 'N' else 1)
+        return x.reshape(b.shape)
+
+    def clear(self):
+        self.lu = None
+
+class _IterativeSolver():
+    """ Solves with a preconditioned iterative method, chosen by the 'iterative_method' and 'preconditioner' settings.
+        The preconditioner is built once per matrix and reused (transposed) by the solves with A^T.
+        Solves with A and A^T are warm-started from the previous solution with the same pattern (see `solve_linear`).
+    """
+
+    def __init__(self, A, pattern=None, symmetric=False):
+        self.pattern = pattern
+        self.symmetric = symmetric
+        self.solver_fn = _get_iterative_method(_settings['iterative_method'])
+        self.preconditioner = _settings['preconditioner']
+        self.refactor(A)
+
+    def refactor(self, A):
+        self.A = A.tocsr()
+        self.inverse = None
+        self.inverse = make_preconditioner(self.A, self.preconditioner)
+
+    def solve(self, b, trans='N'):
+        """ Solves A x = b (trans='N') or A^T x = b (trans='T'), the iteration counts and `info` codes are kept in `iterations` and `info` """
+        slot = ('forward' if trans == 'N' else 'adjoint', self.pattern)
+        self.iterations, self.info = [], []
+        if b.ndim == 2:
+            return np.stack([self._solve_vec(b[:, i], trans, slot + (i,)) for i in range(b.shape[1])], axis=1)
+        return self._solve_vec(b, trans, slot)
+
+    def _solve_vec(self, b, trans, slot):
+        x, info, iterations = _run_iterative(self.solver_fn, self.A, b, inverse=self.inverse, x0=_get_warm_start(slot, b), trans=trans)
+        self.iterations.append(iterations)
+        self.info.append(info)
+        _remember_warm_start(slot, x)
+        return x
+
+    def clear(self):
+        self.A = None
+        self.inverse = None
+
+class _MultigridSolver(_IterativeSolver):
+    """ Solves with GMRES preconditioned by geometric multigrid (see `make_multigrid_preconditioner`).
+        Unlike the direct backends, its memory scales linearly with the size of the grid, which is set by the 'grid_shape' setting.
+    """
+
+    def __init__(self, A, pattern=None, symmetric=False):
+        self.pattern = pattern
+        self.symmetric = symmetric
+        self.solver_fn = partial(spl.gmres, restart=MULTIGRID_GMRES_RESTART)
+        self.preconditioner = partial(make_multigrid_preconditioner, shape=_settings['grid_shape'])
+        self.refactor(A)
+
+class _SchwarzSolver(_IterativeSolver):
+    """ Solves with GMRES preconditioned by overlapping Schwarz domain decomposition (see schwarz.py).
+        The subdomains of the grid (the 'grid_shape' setting) are factored in parallel by the worker processes,
+        which are kept alive to refactor matrices with the same pattern and are stopped by `clear`.
+    """
+
+    def __init__(self, A, pattern=None, symmetric=False):
+        if _settings['grid_shape'] is None:
+            raise ValueError("the 'schwarz' backend needs the shape of the grid, set it with `solver_settings(grid_shape=...)`")
+        self.pattern = pattern
+        self.symmetric = symmetric
+        self.solver_fn = partial(spl.gmres, restart=SCHWARZ_GMRES_RESTART)
+        self.A = A.tocsr()
+        self.inverse = SchwarzSolver(self.A, _settings['grid_shape'], num_workers=_settings['num_workers'], subdomains=_settings['subdomains'])
+
+    def refactor(self, A):
+        self.A = A.tocsr()
+        self.inverse.refactor(self.A)
+
+    def clear(self):
+        self.inverse.close()
+        super().clear()
+
+class _FallbackSolver():
+    """ Solves with the steps of a chain of solver settings (the 'fallback_chain' setting), verifying the residual of each solve.
+        If the relative residual is above FALLBACK_RTOL (or the step fails), the solve is redone with the next step of the chain.
+        The step that worked is remembered for the sparsity pattern, and tried first by the next matrices with that pattern.
+    """
+
+    def __init__(self, A, pattern=None, symmetric=False):
+        self.pattern = pattern
+        self.symmetric = symmetric
+        self.chain = _get_fallback_chain()
+        self.inner = None
+        self.refactor(A)
+
+    def refactor(self, A):
+        self.A = A.tocsr()
+        self._clear_inner()
+        self.step = _fallback_steps.get((self.pattern, _chain_key(self.chain)), 0)
+
+    def solve(self, b, trans='N'):
+        """ Solves A x = b (trans='N') or A^T x = b (trans='T') """
+        b = np.asarray(b, dtype=np.complex128)
+        A_trans = self.A if trans == 'N' else self.A.T
+        for step in range(self.step, len(self.chain)):
+            if step != self.step:
+                self._clear_inner()
+                self.step = step
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    x = self._solve_step(b, trans)
+            except RuntimeError:
+                continue
+            if _relative_residual(A_trans, b, x) <= FALLBACK_RTOL:
+                if self.pattern is not None:
+                    _fallback_steps[(self.pattern, _chain_key(self.chain))] = step
+                self.iterations = getattr(self.inner, 'iterations', None)
+                self.info = getattr(self.inner, 'info', None)
+                return x
+        raise RuntimeError("no step of the fallback chain solved the system to a relative residual of {}".format(FALLBACK_RTOL))
+
+    def _solve_step(self, b, trans):
+        settings = self.chain[self.step]
+        with solver_settings(**settings):
+            if self.inner is None:
+                self.inner = factorize(self.A, pattern=self.pattern, symmetric=self.symmetric)
+            return self.inner.solve(b, trans=trans)
+
+    @property
+    def backend(self):
+        """ Name of the backend of the step currently used """
+        return self.chain[self.step]['backend']
+
+    def _clear_inner(self):
+        if self.inner is not None:
+            self.inner.clear()
+        self.inner = None
+
+    def clear(self):
+        self._clear_inner()
+        self.A = None
+
+class _WoodburyFactorization():
+    """ Solves with A = A0 + D using the factorization of a reference matrix A0 with the same sparsity pattern.
+        The first matrix of each pattern is factored as the reference (see `set_reference_matrix` to choose it).
+        If D only changes k <= WOODBURY_MAX_RANK rows of A0 (e.g. the permittivity of a small design region),
+        A0 + D = A0 + E_k D_k is solved exactly with the Woodbury identity, which costs k solves with A0 per matrix:
+            A^-1 = A0^-1 - Z (I + D_k Z)^-1 D_k A0^-1,  with Z = A0^-1 E_k
+        Larger changes are solved by GMRES preconditioned by the reference factorization.
+    """
+
+    def __init__(self, A, pattern=None, symmetric=False):
+        self.pattern = pattern
+        self.symmetric = symmetric
+        self.reference = _reference_factorizations.get(pattern)
+        if self.reference is None:
+            self.reference = _factor_reference(A, pattern, symmetric)
+        self.refactor(A)
+
+    def refactor(self, A):
+        """ Prepares the update of the reference factorization to A, which only needs the solves with the changed rows """
+        self.A = A.tocsr()
+        A_ref, self.lu_ref = self.reference
+        D = (self.A - A_ref).tocsr()
+        D.eliminate_zeros()
+        self.rows = np.unique(D.tocoo().row)
+        self.D_rows = D[self.rows]
+        self.low_rank = self.rows.size <= WOODBURY_MAX_RANK
+
+        # the low-rank factors for A^T are computed when first needed (see `_update`)
+        self.updates = {}
+        if self.low_rank and self.rows.size > 0:
+            self._update('N')
+
+    def _update(self, trans):
+        """ Computes Z and the LU factors of the capacitance matrix (I + D_k Z) for solving with A (trans='N') or A^T (trans='T') """
+        if trans not in self.updates:
+            k = self.rows.size
+            if trans == 'N':
+                E_k = np.zeros((self.A.shape[0], k), dtype=np.complex128)
+                E_k[self.rows, np.arange(k)] = 1
+                Z = self.lu_ref.solve(E_k, trans='N')
+                capacitance = np.eye(k) + self.D_rows.dot(Z)
+            else:
+                # A^T = A0^T + D_k^T E_k^T, so the roles of E_k and D_k are swapped
+                Z = self.lu_ref.solve(self.D_rows.T.toarray().astype(np.complex128), trans='T')
+                capacitance = np.eye(k) + Z[self.rows]
+            self.updates[trans] = (Z, lu_factor(capacitance))
+        return self.updates[trans]
+
+    def solve(self, b, trans='N'):
+        """ Solves A x = b (trans='N') or A^T x = b (trans='T'), where b can also be a (N, num_rhs) matrix """
+        b = np.asarray(b, dtype=np.complex128)
+        if self.rows.size == 0:
+            return self.lu_ref.solve(b, trans=trans)
+        if not self.low_rank:
+            self.iterations, self.info = [], []
+            if b.ndim == 2:
+                return np.stack([self._solve_preconditioned(b[:, i], trans) for i in range(b.shape[1])], axis=1)
+            return self._solve_preconditioned(b, trans)
+
+        Z, capacitance = self._update(trans)
+        y = self.lu_ref.solve(b, trans=trans)
+        projected = self.D_rows.dot(y) if trans == 'N' else y[self.rows]
+        return y - Z.dot(lu_solve(capacitance, projected))
+
+    def _solve_preconditioned(self, b, trans):
+        x, info, iterations = _run_iterative(partial(spl.gmres, restart=MULTIGRID_GMRES_RESTART), self.A, b, inverse=self.lu_ref, trans=trans)
+        self.iterations.append(iterations)
+        self.info.append(info)
+        return x
+
+    def clear(self):
+        # the reference factorization is shared with the other matrices of the pattern, see `clear_reference_factorizations`
+        self.updates = {}
+        self.A = None
+
+def _direct_backend():
+    """ The fastest direct solver backend available """
+    if HAS_MKL:
+        return 'pardiso'
+    elif HAS_UMFPACK:
+        return 'umfpack'
+    else:
+        return 'superlu'
+
+def _factor_reference(A, pattern, symmetric):
+    """ Factors A with the fastest direct backend and stores it as the reference matrix of its sparsity pattern """
+    reference = (A.tocsr(), factorize(A, pattern=pattern, backend=_direct_backend(), symmetric=symmetric))
+    if pattern is not None:
+        _reference_factorizations[pattern] = reference
+        while len(_reference_factorizations) > REFERENCE_CACHE_SIZE:
+            _, (_, old_factorization) = _reference_factorizations.popitem(last=False)
+            old_factorization.clear()
+    return reference
+
+def set_reference_matrix(entries, indices, shape):
+    """ Factors A(entries, indices) as the reference matrix of its sparsity pattern for the 'woodbury' backend,
+        for example the matrix of the unperturbed device before a sweep over local defects
+    """
+    pattern = pattern_key(indices, shape)
+    old_reference = _reference_factorizations.pop(pattern, None)
+    if old_reference is not None:
+        old_reference[1].clear()
+    A = make_sparse(entries, indices, shape=shape)
+    _factor_reference(A, pattern, _use_symmetric(A))
+
+def clear_reference_factorizations():
+    """ Frees the reference factorizations of the 'woodbury' backend """
+    while _reference_factorizations:
+        _, (_, factorization) = _reference_factorizations.popitem()
+        factorization.clear()
+
+def _get_fallback_chain():
+    """ The chain of solver settings of the 'fallback' backend, from the current settings """
+    chain = _settings['fallback_chain']
+    return DEFAULT_FALLBACK_CHAIN if chain is None else chain
+
+def clear_fallback_steps():
+    """ Forgets which step of the fallback chains worked for each sparsity pattern """
+    _fallback_steps.clear()
+
+def _chain_key(chain):
+    """ Hashable key of a fallback chain """
+    return tuple(tuple(sorted(settings.items())) for settings in chain)
+
+# dict of solver backends (name: class that factorizes a matrix, see above), add your own with `register_backend`
+BACKENDS = {
+    'superlu': _SuperLUFactorization,
+    'mixed': _MixedPrecisionFactorization,
+    'umfpack': _UMFPACKFactorization,
+    'pardiso': _PardisoFactorization,
+    'banded': _BandedFactorization,
+    'iterative': _IterativeSolver,
+    'multigrid': _MultigridSolver,
+    'schwarz': _SchwarzSolver,
+    'fallback': _FallbackSolver,
+    'woodbury': _WoodburyFactorization,
+}
+
+def register_backend(name, backend_class):
+    """ Adds a solver backend that can then be selected with `solver_settings(backend=name)` """
+    BACKENDS[name] = backend_class
+
+@contextmanager
+def solver_settings(**settings):
+    """ Changes the solver settings (see `_settings` above) within a `with` block, for example
+
+            with solver_settings(backend='iterative', iterative_method='gmres', preconditioner='shifted_laplacian'):
+                Hx, Hy, Ez = simulation.solve(source)
+
+        Simulations can also store their own settings, see the `solver_settings` argument of `fdfd`.
+    """
+
+    for name, value in settings.items():
+        if name not in _settings:
+            raise ValueError("solver setting {} not recognized, must be one of {}".format(name, list(_settings.keys())))
+        if name == 'backend' and value != 'auto' and value not in BACKENDS:
+            raise ValueError("backend {} not found.\n supported backends are:\n {}".format(value, list(BACKENDS.keys())))
+        if name == 'symmetric' and value not in (True, False, 'auto'):
+            raise ValueError("symmetric setting must be True, False or 'auto', got {}".format(value))
+
+    old_settings = dict(_settings)
+    _settings.update(settings)
+    try:
+        yield
+    finally:
+        _settings.clear()
+        _settings.update(old_settings)
+
+def get_solver_settings():
+    """ Returns a copy of the current solver settings """
+    return dict(_settings)
+
+def choose_backend(shape, indices):
+    """ The 'auto' backend policy: picks a backend for a matrix of `shape` with nonzeros at `indices`.
+        Banded matrices and (quasi) 1D grids (the 'grid_shape' setting) use the 'banded' backend, problems whose factorization would not fit
+        in memory use the 'mixed' backend if a single precision factorization fits, and otherwise the 'multigrid'
+        backend (or the 'iterative' one if the grid shape is unknown).  Everything else uses the fastest direct solver available.
+    """
+
+    N = shape[0]
+    nnz = len(indices[0])
+    kl, ku = _bandwidths(indices)
+    if kl + ku + 1 <= AUTO_BANDED_MAX_DIAGONALS:
+        return 'banded'
+
+    grid_shape = _settings['grid_shape']
+    if grid_shape is not None and int(np.prod(grid_shape)) == N and min(grid_shape) <= AUTO_BANDED_MAX_THICKNESS:
+        return 'banded'
+
+    memory = _available_memory()
+    if memory is not None:
+        # the cached factorizations evicted to make room for this one give their memory back before it is factored
+        memory += _evicted_factorization_bytes()
+    if memory is not None and _estimate_factorization_bytes(N, nnz) > AUTO_MEMORY_FRACTION * memory:
+        if _estimate_factorization_bytes(N, nnz, value_bytes=8) <= AUTO_MEMORY_FRACTION * memory:
+            return 'mixed'
+        return 'iterative' if _settings['grid_shape'] is None else 'multigrid'
+
+    return _direct_backend()
+
+def _bandwidths(indices):
+    """ Returns the number of nonzero sub-diagonals and super-diagonals of a matrix with nonzeros at `indices` """
+    rows, cols = indices
+    if len(rows) == 0:
+        return 0, 0
+    offsets = np.asarray(rows) - np.asarray(cols)
+    return int(max(offsets.max(), 0)), int(max(-offsets.min(), 0))
+
+def _estimate_factorization_bytes(N, nnz, value_bytes=16):
+    """ Rough estimate of the memory needed by the LU factors of an FDFD matrix.
+        The factors of 2D grid matrices have about 12 N log2(N) nonzeros, each taking `value_bytes` (16 for complex128) + 8 bytes of indices
+    """
+    return (value_bytes + 8) * max(nnz, 12 * N * np.log2(max(N, 2)))
+
+def _evicted_factorization_bytes():
+    """ Memory held by the cached factorizations that the next new factorization evicts (see `_lookup_factorization`) """
+    num_evicted = len(_factorization_cache) - FACTORIZATION_CACHE_SIZE + 1
+    evicted = list(_factorization_cache.values())[:max(num_evicted, 0)]
+    return sum(_factorization_bytes(factorization) for factorization in evicted)
+
+def _factorization_bytes(factorization):
+    """ Rough memory held by the factors of a backend (or its preconditioner), 0 if they aren't exposed.
+        Unlike `_fill_in`, this doesn't copy the factors out of SuperLU.
+    """
+    value_bytes = 8 if isinstance(factorization, _MixedPrecisionFactorization) else 16
+    for lu in (getattr(factorization, 'lu', None), getattr(factorization, 'inverse', None)):
+        if isinstance(lu, np.ndarray):
+            return lu.nbytes
+        if isinstance(lu, spl.SuperLU):
+            return (value_bytes + 8) * lu.nnz
+    return 0
+
+def _available_memory():
+    """ Returns the free physical memory in bytes, or None if it can't be determined on this platform """
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def _backend_signature(shape, indices):
+    """ Identifies the backend (and its settings) that the current settings select for a matrix """
+    backend = _settings['backend']
+    if backend == 'auto':
+        backend = choose_backend(shape, indices)
+    if backend == 'iterative':
+        return (backend, _settings['iterative_method'], _settings['preconditioner'])
+    if backend == 'multigrid':
+        return (backend, _settings['grid_shape'])
+    if backend == 'schwarz':
+        subdomains = _settings['subdomains']
+        return (backend, _settings['grid_shape'], _settings['num_workers'], None if subdomains is None else tuple(subdomains))
+    if backend == 'fallback':
+        return (backend, _chain_key(_get_fallback_chain()), _settings['grid_shape'])
+    return (backend,)
+
+def is_symmetric(A, rtol=SYMMETRY_RTOL):
+    """ Checks whether the sparse matrix A is complex symmetric (A = A^T, no conjugate) up to a relative tolerance """
+    A = sp.csr_matrix(A)
+    if A.shape[0] != A.shape[1]:
+        return False
+    if A.nnz == 0:
+        return True
+    return abs(A - A.T).max() <= rtol * abs(A).max()
+
+def _use_symmetric(A):
+    """ Whether to factor A as a symmetric matrix, according to the 'symmetric' solver setting """
+    symmetric = _settings['symmetric']
+    if symmetric == 'auto':
+        return is_symmetric(A)
+    return symmetric
+
+
+""" ======================= FACTORIZATION CACHING ======================== """
+
+def factorize(A, pattern=None, backend=None, symmetric=None):
+    """ Factorizes the sparse matrix A using `backend`, by default the one selected by the current solver settings.
+        Returns an object with a `solve(b, trans='N')` method, where trans='T' solves with A^T.
+        `pattern` (see `pattern_key`) identifies the sparsity pattern of A, so its ordering can be reused later.
+        `symmetric` says whether A is complex symmetric, by default this is set by the 'symmetric' solver setting.
+    """
+    if backend is None:
+        A_coo = A.tocoo()
+        backend = _backend_signature(A.shape, (A_coo.row, A_coo.col))[0]
+    if symmetric is None:
+        symmetric = _use_symmetric(A)
+    return BACKENDS[backend](A, pattern=pattern, symmetric=symmetric)
+
+def _hash_arrays(*arrays):
+    """ Hashes the content of numpy arrays """
+    hasher = hashlib.sha1()
+    for array in arrays:
+        hasher.update(array.tobytes())
+    return hasher.hexdigest()
+
+def matrix_key(entries, indices):
+    """ Computes a hashable key identifying a sparse matrix by the content of its entries and indices """
+    entries = np.ascontiguousarray(entries, dtype=np.complex128)
+    indices = np.ascontiguousarray(indices, dtype=np.int64)
+    return (entries.size, _hash_arrays(entries, indices))
+
+def pattern_key(indices, shape):
+    """ Computes a hashable key identifying the sparsity pattern of a matrix with `indices` and `shape` """
+    indices = np.ascontiguousarray(indices, dtype=np.int64)
+    return (tuple(shape), _hash_arrays(indices))
+
+def _get_cached_ordering(key):
+    """ Returns the ordering stored for `key` (a sparsity pattern and a flag), from memory or from the 'ordering_cache_dir', or None """
+    if key in _ordering_cache:
+        _ordering_cache.move_to_end(key)
+        return _ordering_cache[key]
+
+    path = _ordering_path(key)
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        order = np.load(path)
+    except (OSError, ValueError):
+        # a corrupt file is just recomputed and overwritten
+        return None
+    _remember_ordering(key, order)
+    return order
+
+def _store_ordering(key, order):
+    """ Stores the ordering for `key` in memory and, if the 'ordering_cache_dir' setting is set, on disk """
+    if key[0] is None:
+        return
+    _remember_ordering(key, order)
+
+    path = _ordering_path(key)
+    if path is None:
+        return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so other processes never read a partially written ordering
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            np.save(f, order)
+        os.replace(temp_path, path)
+    except OSError as e:
+        warnings.warn("could not save the ordering to {}: {}".format(path, e), RuntimeWarning)
+
+def _remember_ordering(key, order):
+    _ordering_cache[key] = order
+    _ordering_cache.move_to_end(key)
+    while len(_ordering_cache) > ORDERING_CACHE_SIZE:
+        _ordering_cache.popitem(last=False)
+
+def _ordering_path(key):
+    """ File of the ordering for `key` in the 'ordering_cache_dir', or None if there is no directory (or pattern) """
+    directory = _settings['ordering_cache_dir']
+    if directory is None or key[0] is None:
+        return None
+    return os.path.join(directory, 'ordering_{}.npy'.format(_hash_arrays(np.frombuffer(repr(key).encode(), dtype=np.uint8))))
+
+def clear_ordering_cache():
+    """ Forgets the orderings kept in memory (the files in the 'ordering_cache_dir' are kept) """
+    _ordering_cache.clear()
+
+def _recycle_factorization(signature, pattern, symmetric):
+    """ If the cache is full, removes and returns the least recently used factorization with sparsity `pattern` (or None).
+        Refactoring it is cheaper than a new factorization since its symbolic analysis can be kept.
+    """
+    if len(_factorization_cache) < FACTORIZATION_CACHE_SIZE:
+        return None
+    for key, factorization in _factorization_cache.items():
+        if key[0] == signature and factorization.pattern == pattern and factorization.symmetric == symmetric:
+            return _factorization_cache.pop(key)
+    return None
+
+def get_factorization(entries, indices, shape):
+    """ Returns a factorization of the matrix A(entries, indices) and the `trans` flag to pass to its `solve`.
+        The backend is chosen by the current solver settings (see `solver_settings`).
+        If A^T was factored recently (for example by the forward solve when this is the adjoint solve),
+        that factorization is returned with trans='T' instead of factoring A again.
+        Complex symmetric matrices get a symmetric factorization (see the 'symmetric' setting in `solver_settings`).
+    """
+    factorization, trans, _ = _lookup_factorization(entries, indices, shape)
+    return factorization, trans
+
+def solve_factored(entries, indices, b, trans='N'):
+    """ Solves A(entries, indices) x = b (or A^T x = b for trans='T') using the cached factorization of A (see `get_factorization`).
+        b can also be a (N, num_rhs) matrix of right hand sides.  This is the solve done by the primitives,
+        it is recorded by any active `solver_telemetry` collectors.
+    """
+    N = b.shape[0]
+    factorization, factored_trans, factor_time = _lookup_factorization(entries, indices, shape=(N, N))
+    # solving with A^T flips whether the factorization is used as is or transposed
+    if trans == 'T':
+        factored_trans = 'N' if factored_trans == 'T' else 'T'
+    t0 = time.perf_counter()
+    x = factorization.solve(b, trans=factored_trans)
+    if _telemetry_collectors:
+        A = make_sparse(entries, indices, shape=(N, N))
+        if trans == 'T':
+            A = A.T
+        _record_solve(factorization, A, b, x, factored_trans, factor_time=factor_time, solve_time=time.perf_counter() - t0)
+    return x
+
+def _lookup_factorization(entries, indices, shape):
+    """ Does the work of `get_factorization`, also returning the time spent factoring (None if a cached factorization was used) """
+
+    signature = _backend_signature(shape, indices)
+
+    key = (signature, matrix_key(entries, indices))
+    if key in _factorization_cache:
+        _factorization_cache.move_to_end(key)
+        return _factorization_cache[key], 'N', None
+
+    key_T = (signature, matrix_key(entries, transpose_indices(indices)))
+    if key_T in _factorization_cache:
+        _factorization_cache.move_to_end(key_T)
+        return _factorization_cache[key_T], 'T', None
+
+    t0 = time.perf_counter()
+    A = make_sparse(entries, indices, shape=shape)
+    pattern = pattern_key(indices, shape)
+    # the band LU doesn't exploit symmetry, so the (relatively costly for small problems) check is skipped
+    symmetric = _use_symmetric(A) if signature[0] != 'banded' else False
+
+    # only redo the numerical factorization if a matrix with the same pattern is about to be evicted anyway
+    factorization = _recycle_factorization(signature, pattern, symmetric)
+
+    # free the least recently used factorizations if the cache is full, before factoring so they don't add to the peak memory
+    while len(_factorization_cache) >= FACTORIZATION_CACHE_SIZE:
+        _, old_factorization = _factorization_cache.popitem(last=False)
+        old_factorization.clear()
+
+    if factorization is not None:
+        factorization.refactor(A)
+    else:
+        factorization = factorize(A, pattern=pattern, backend=signature[0], symmetric=symmetric)
+    _factorization_cache[key] = factorization
+
+    return factorization, 'N', time.perf_counter() - t0
+
+def clear_factorization_cache():
+    """ Frees all of the cached factorizations """
+    while _factorization_cache:
+        _, factorization = _factorization_cache.popitem()
+        factorization.clear()
+
+
+""" ============================== TELEMETRY ============================= """
+
+# lists collecting a SolveRecord for every solve while a `solver_telemetry` block is active
+_telemetry_collectors = []
+
+# stack of the kind of solve being done, the top one is put in the records (see `telemetry_kind`)
+_telemetry_kind = ['forward']
+
+class SolveRecord():
+    """ Telemetry of one (possibly multi right hand side) linear solve
+            kind: what the solve was for, 'forward' by default, 'adjoint' for the solves of the vjps and 'tangent' for those of the jvps
+            backend: name of the solver backend (class name for backends added with `register_backend`)
+            N: size of the matrix
+            num_rhs: number of right hand sides solved
+            trans: 'T' if the factorization was applied transposed (like the adjoint solves reusing the forward one), otherwise 'N'
+            cached: whether a cached factorization was reused
+            factor_time: seconds spent factoring (or building the preconditioner), 0 if it was cached
+            solve_time: seconds spent solving with the factorization
+            fill_in: number of nonzeros in the factors (or in the ILU preconditioner), None if the backend doesn't expose them
+            iterations: total number of iterations of the iterative backends, None for the direct ones
+            info: largest scipy `info` code of the iterative solves (0 if they all converged), None for the direct backends
+            residual: largest relative residual |A x - b| / |b| over the right hand sides
+    """
+
+    def __init__(self, kind, backend, N, num_rhs, trans, cached, factor_time, solve_time, fill_in, iterations, info, residual):
+        self.kind = kind
+        self.backend = backend
+        self.N = N
+        self.num_rhs = num_rhs
+        self.trans = trans
+        self.cached = cached
+        self.factor_time = factor_time
+        self.solve_time = solve_time
+        self.fill_in = fill_in
+        self.iterations = iterations
+        self.info = info
+        self.residual = residual
+
+    @property
+    def converged(self):
+        return self.info is None or self.info == 0
+
+    def __repr__(self):
+        return "SolveRecord(kind={}, backend={}, N={}, num_rhs={}, cached={}, factor_time={:.3g}, solve_time={:.3g}, iterations={}, residual={:.3g})".format(
+            self.kind, self.backend, self.N, self.num_rhs, self.cached, self.factor_time, self.solve_time, self.iterations, self.residual)
+
+@contextmanager
+def solver_telemetry():
+    """ Collects a SolveRecord for every solve done within a `with` block, including those of the gradients, for example
+
+            with solver_telemetry() as records:
+                grad_fn(params)
+            print(summarize_telemetry(records))
+
+        Computing the residuals takes an extra matrix multiplication per solve, so this is off by default.
+    """
+    records = []
+    _telemetry_collectors.append(records)
+    try:
+        yield records
+    finally:
+        _telemetry_collectors.remove(records)
+
+@contextmanager
+def telemetry_kind(kind):
+    """ Labels the solves done within a `with` block as `kind` in the telemetry records """
+    _telemetry_kind.append(kind)
+    try:
+        yield
+    finally:
+        _telemetry_kind.pop()
+
+def summarize_telemetry(records):
+    """ Totals the records by (kind, backend): returns a dict of dicts with the number of solves and right hand sides,
+        the total factorization and solve times, total iterations and the number of solves that did not converge
+    """
+    summary = {}
+    for record in records:
+        totals = summary.setdefault((record.kind, record.backend), {'solves': 0, 'num_rhs': 0, 'factor_time': 0.0,
+                                                                     'solve_time': 0.0, 'iterations': 0, 'not_converged': 0})
+        totals['solves'] += 1
+        totals['num_rhs'] += record.num_rhs
+        totals['factor_time'] += record.factor_time
+        totals['solve_time'] += record.solve_time
+        totals['iterations'] += record.iterations or 0
+        totals['not_converged'] += not record.converged
+    return summary
+
+def _telemetry_append(record):
+    for records in _telemetry_collectors:
+        records.append(record)
+
+def _record_solve(factorization, A, b, x, trans, factor_time, solve_time):
+    """ Records the solve of A x = b done by the backend object `factorization` """
+    names = {backend_class: name for name, backend_class in BACKENDS.items()}
+    iterations = getattr(factorization, 'iterations', None)
+    info = getattr(factorization, 'info', None)
+    _telemetry_append(SolveRecord(kind=_telemetry_kind[-1],
+                                  backend=names.get(type(factorization), type(factorization).__name__),
+                                  N=A.shape[0],
+                                  num_rhs=1 if b.ndim == 1 else b.shape[1],
+                                  trans=trans,
+                                  cached=factor_time is None,
+                                  factor_time=factor_time or 0.0,
+                                  solve_time=solve_time,
+                                  fill_in=_fill_in(factorization),
+                                  iterations=None if iterations is None else int(np.sum(iterations)),
+                                  info=None if info is None else max(info, key=abs, default=0),
+                                  residual=_relative_residual(A, b, x)))
+
+def _fill_in(factorization):
+    """ Number of nonzeros in the LU factors held by a backend (or its preconditioner), or None if they aren't exposed """
+    for lu in (getattr(factorization, 'lu', None), getattr(factorization, 'inverse', None), factorization):
+        if hasattr(lu, 'L') and hasattr(lu, 'U'):
+            return int(lu.L.nnz + lu.U.nnz)
+        if isinstance(lu, np.ndarray):
+            return int(np.count_nonzero(lu))
+    return None
+
+def _relative_residual(A, b, x):
+    """ Largest |A x - b| / |b| over the columns of b """
+    b = b.reshape((b.shape[0], -1))
+    r = A.dot(x.reshape(b.shape)) - b
+    norm_b = np.linalg.norm(b, axis=0)
+    norm_b[norm_b == 0] = 1
+    return float(np.max(np.linalg.norm(r, axis=0) / norm_b))
+
+
 """ ============================ SPEED TESTS ============================= """
 
 # to run speed tests use `python -W ignore ceviche/solvers.py` to suppress warnings
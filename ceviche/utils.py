@@ -1,9 +1,13 @@
 import numpy as np
 import scipy.sparse as sp
 import copy
+import hashlib
+import os
+import multiprocessing as mp
 import autograd.numpy as npa
 import matplotlib.pylab as plt
 from autograd.extend import primitive, vspace, defvjp, defjvp
+from collections import OrderedDict
 
 """ Useful functions """
 
@@ -21,14 +25,69 @@ def make_sparse(entries, indices, shape):
     Returns:
       sparse, complex, matrix with specified values
     """  
-    coo = sp.coo_matrix((entries, indices), shape=shape, dtype=npa.complex128)
-    return coo.tocsr()
+    indptr, csr_indices, scatter = _get_csr_pattern(indices, shape)
+    entries = np.asarray(entries, dtype=np.complex128).ravel()
+
+    # sum the entries into their (possibly duplicated) locations of the csr data array
+    nnz = csr_indices.size
+    data = np.bincount(scatter, weights=entries.real, minlength=nnz) + 1j * np.bincount(scatter, weights=entries.imag, minlength=nnz)
+
+    # copy the structure so that in-place changes to the returned matrix (e.g. `sort_indices`) never touch the cache
+    A = sp.csr_matrix((data, csr_indices.copy(), indptr.copy()), shape=shape)
+    A.has_sorted_indices = True
+    return A
+
+# number of csr structures (one per sparsity pattern) kept around by `make_sparse`
+CSR_PATTERN_CACHE_SIZE = 16
+
+# stores the (indptr, indices, scatter) of the csr matrices made by `make_sparse`, keyed by the shape and the content of the indices
+_csr_pattern_cache = OrderedDict()
+
+def _get_csr_pattern(indices, shape):
+    """ Returns the csr structure (indptr, indices) of a matrix with COO `indices` and `shape` and the 'scatter' array,
+        giving the location in the csr data array of each of the COO entries (duplicates share a location, where they are summed).
+    """
+    indices = np.ascontiguousarray(indices, dtype=np.int64)
+    key = (tuple(shape), indices.shape, hashlib.sha1(indices.tobytes()).hexdigest())
+    if key in _csr_pattern_cache:
+        _csr_pattern_cache.move_to_end(key)
+        return _csr_pattern_cache[key]
+
+    num_rows, num_cols = shape
+    rows, cols = indices
+
+    # sort the entries by row and then column (stable, to match the order scipy sums duplicates in)
+    linear = rows * num_cols + cols
+    order = np.argsort(linear, kind='stable')
+    linear_sorted = linear[order]
+
+    # each run of equal locations becomes one stored element
+    is_new = np.ones(linear_sorted.size, dtype=bool)
+    is_new[1:] = linear_sorted[1:] != linear_sorted[:-1]
+    scatter = np.empty(linear_sorted.size, dtype=np.intp)
+    scatter[order] = np.cumsum(is_new) - 1
+
+    unique = linear_sorted[is_new]
+    index_dtype = np.int32 if max(unique.size, num_rows, num_cols) < np.iinfo(np.int32).max else np.int64
+    csr_indices = (unique % num_cols).astype(index_dtype)
+    indptr = np.zeros(num_rows + 1, dtype=index_dtype)
+    np.cumsum(np.bincount(unique // num_cols, minlength=num_rows), out=indptr[1:])
+
+    pattern = (indptr, csr_indices, scatter)
+    _csr_pattern_cache[key] = pattern
+    while len(_csr_pattern_cache) > CSR_PATTERN_CACHE_SIZE:
+        _csr_pattern_cache.popitem(last=False)
+    return pattern
+
+def clear_csr_pattern_cache():
+    """ Frees the csr structures stored by `make_sparse` """
+    _csr_pattern_cache.clear()
 
 def get_entries_indices(csr_matrix):
     # takes sparse matrix and returns the entries and indeces in form compatible with 'make_sparse'
     shape = csr_matrix.shape
     coo_matrix = csr_matrix.tocoo()
-    entries = csr_matrix.data
+    entries = coo_matrix.data     # not csr_matrix.data, which is stored differently for other formats (e.g. the dia matrices of 1D problems)
     cols = coo_matrix.col
     rows = coo_matrix.row
     indices = npa.vstack((rows, cols))
@@ -114,15 +173,48 @@ def der_num(fn, arg, index, delta):
     df_darg = (fn(arg_i_for) - fn(arg_i_back)) / delta
     return df_darg
 
-def grad_num(fn, arg, delta=1e-6):
+def grad_num(fn, arg, delta=1e-6, num_workers=0):
     # take a (complex) numerical gradient of function 'fn' with argument 'arg' with step size 'delta'
+    # the elements are perturbed in a pool of `num_workers` processes (see `map_perturbations`), 0 does them in this process
     N = arg.size
-    grad = npa.zeros((N,), dtype=npa.complex128)
-    f0 = fn(arg)
-    for i in range(N):
-        grad[i] = der_num(fn, arg, i, delta)        # real part
-        grad[i] += der_num(fn, arg, i, 1j * delta)  # imaginary part
-    return grad
+    def der_i(i):
+        return der_num(fn, arg, i, delta) + der_num(fn, arg, i, 1j * delta)  # real part + imaginary part
+    return npa.array(map_perturbations(der_i, N, num_workers=num_workers), dtype=npa.complex128)
+
+# the function evaluating the perturbations, set in every worker process of `map_perturbations`
+_perturbation_fn = None
+
+def _set_perturbation_fn(fn):
+    global _perturbation_fn
+    _perturbation_fn = fn
+
+def _map_perturbation_chunk(chunk):
+    return [_perturbation_fn(i) for i in chunk]
+
+def map_perturbations(fn, num_perturbations, num_workers=0, chunk_size=None):
+    """ Returns [fn(0), ..., fn(num_perturbations - 1)], evaluated in a pool of `num_workers` processes.
+            fn: evaluates perturbation i (like a column of a numerical jacobian), usually a closure over the objective function
+            num_workers: number of worker processes, by default the number of cores.  0 evaluates them in this process.
+            chunk_size: number of consecutive perturbations sent to a worker at a time, by default one chunk per worker.
+        `fn` is handed to the workers once when they start, and each of them works through whole chunks of perturbations,
+        so whatever it sets up on its first call (simulation objects, factorizations) is reused for the rest of its chunk.
+        Where processes can be forked `fn` doesn't have to be picklable, otherwise it (and its results) must be.
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = min(num_workers, num_perturbations)
+    if num_workers <= 1:
+        return [fn(i) for i in range(num_perturbations)]
+
+    if chunk_size is None:
+        chunk_size = -(-num_perturbations // num_workers)
+    chunks = [range(start, min(start + chunk_size, num_perturbations)) for start in range(0, num_perturbations, chunk_size)]
+
+    # forked workers inherit `fn` instead of unpickling it, so closures and lambdas work
+    context = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+    with context.Pool(num_workers, initializer=_set_perturbation_fn, initargs=(fn,)) as pool:
+        results = pool.map(_map_perturbation_chunk, chunks, chunksize=1)
+    return [result for chunk_results in results for result in chunk_results]
 
 def jac_num(fn, arg, step_size=1e-7):
     """ DEPRICATED: use 'numerical' in jacobians.py instead
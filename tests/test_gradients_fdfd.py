@@ -13,7 +13,8 @@ import sys
 sys.path.append('../ceviche')
 
 from ceviche.utils import grad_num
-from ceviche import jacobian, fdfd_hz, fdfd_ez
+from ceviche import jacobian, fdfd_hz, fdfd_ez, kerr_nonlinearity
+from ceviche.solvers import DEFAULT_ITERATIVE_METHOD, clear_factorization_cache, clear_warm_starts
 
 """
 This file tests the autograd gradients of an FDFD and makes sure that they
@@ -189,6 +190,158 @@ class TestFDFD(unittest.TestCase):
 
         self.check_gradient_error(grad_numerical, grad_autograd_for)
 
+    def refine_grid(self, Nx, Ny, dL=2.5e-8):
+        """ Switches to a (larger) grid resolving the wavelength, for the preconditioned backends """
+        self.Nx, self.Ny, self.dL = Nx, Ny, dL
+        self.eps_r = np.random.random((Nx, Ny)) + 1
+        self.eps_arr = self.eps_r.flatten()
+        self.source_ez = np.zeros((Nx, Ny))
+        self.source_ez[Nx//2, Ny//2] = self.source_amp_ez
+        self.source_hz = np.zeros((Nx, Ny))
+        self.source_hz[Nx//2, Ny//2] = self.source_amp_hz
+
+    def backend_gradients(self, fdfd_cls, source, solver_settings):
+        """ Reverse-mode gradients of the total field intensity from a backend and from superlu """
+
+        def J_fdfd(eps_arr, f):
+
+            eps_r = eps_arr.reshape((self.Nx, self.Ny))
+
+            # set the permittivity
+            f.eps_r = eps_r
+
+            # set the source amplitude to the permittivity at that point
+            F1, F2, F3 = f.solve(eps_r * source)
+
+            return npa.sum(npa.square(npa.abs(F1))) \
+                 + npa.sum(npa.square(npa.abs(F2))) \
+                 + npa.sum(npa.square(npa.abs(F3)))
+
+        grads = []
+        for settings in (solver_settings, {'backend': 'superlu'}):
+            # don't let one backend start from (or reuse) the other's solutions
+            clear_factorization_cache()
+            clear_warm_starts()
+            f = fdfd_cls(self.omega, self.dL, self.eps_r, self.pml, solver_settings=settings)
+            grads.append(jacobian(J_fdfd, mode='reverse')(self.eps_arr, f))
+        return grads
+
+    def test_iterative_reverse(self):
+
+        print('\ttesting reverse-mode Ez and Hz in FDFD with the iterative solver backend')
+
+        # the iterative solves stop at a tolerance too loose for numerical derivatives, so compare to the direct solver instead
+        for fdfd_cls, source in ((fdfd_ez, self.source_ez), (fdfd_hz, self.source_hz)):
+            for method in (DEFAULT_ITERATIVE_METHOD, 'gmres'):
+                with self.subTest(fdfd=fdfd_cls.__name__, method=method):
+                    grad_iterative, grad_direct = self.backend_gradients(fdfd_cls, source, {'backend': 'iterative', 'iterative_method': method})
+                    self.check_gradient_error(grad_direct, grad_iterative)
+
+    def test_multigrid_reverse(self):
+
+        print('\ttesting reverse-mode Ez and Hz in FDFD with the multigrid solver backend')
+
+        # large and finely resolved enough for the multigrid V-cycle to coarsen
+        self.refine_grid(96, 80)
+
+        for fdfd_cls, source in ((fdfd_ez, self.source_ez), (fdfd_hz, self.source_hz)):
+            with self.subTest(fdfd=fdfd_cls.__name__):
+                grad_multigrid, grad_direct = self.backend_gradients(fdfd_cls, source, {'backend': 'multigrid'})
+                self.check_gradient_error(grad_direct, grad_multigrid)
+
+    def test_schwarz_reverse(self):
+
+        print('\ttesting reverse-mode Ez and Hz in FDFD with the schwarz solver backend')
+
+        # resolved finely enough that the overlapping subdomains don't already solve the whole problem
+        self.refine_grid(60, 50)
+
+        for fdfd_cls, source in ((fdfd_ez, self.source_ez), (fdfd_hz, self.source_hz)):
+            with self.subTest(fdfd=fdfd_cls.__name__):
+                grad_schwarz, grad_direct = self.backend_gradients(fdfd_cls, source, {'backend': 'schwarz', 'num_workers': 2, 'subdomains': (2, 2)})
+                self.check_gradient_error(grad_direct, grad_schwarz)
+
+    def test_Ez_many_reverse(self):
+
+        print('\ttesting reverse-mode Ez in FDFD with many sources')
+
+        f = fdfd_ez(self.omega, self.dL, self.eps_r, self.pml)
+
+        source_ez_2 = np.zeros((self.Nx, self.Ny))
+        source_ez_2[self.Nx//3, self.Ny//3] = self.source_amp_ez
+
+        def J_fdfd(eps_arr):
+
+            eps_r = eps_arr.reshape((self.Nx, self.Ny))
+
+            # set the permittivity
+            f.eps_r = eps_r
+
+            # solve for both sources with one factorization
+            Hx, Hy, Ez = f.solve_many([eps_r * self.source_ez, source_ez_2])
+
+            return npa.sum(npa.square(npa.abs(Ez[0]))) \
+                 + npa.sum(npa.square(npa.abs(Hx[1]))) \
+                 + npa.sum(npa.square(npa.abs(Hy[1])))
+
+        grad_autograd_rev = jacobian(J_fdfd, mode='reverse')(self.eps_arr)
+        grad_numerical = jacobian(J_fdfd, mode='numerical')(self.eps_arr)
+
+        self.check_gradient_error(grad_numerical, grad_autograd_rev)
+
+
+class TestNonlinearFDFD(unittest.TestCase):
+
+    """ Tests the gradients of the nonlinear FDFD solves (with a fixed permittivity, to leave the random state of the other tests alone) """
+
+    def setUp(self):
+
+        # basic simulation parameters
+        self.Nx = 30
+        self.Ny = 30
+        self.omega = 2*np.pi*200e12
+        self.dL = 1e-6
+        self.pml = [10, 10]
+
+        self.source_ez = np.zeros((self.Nx, self.Ny))
+        self.source_ez[self.Nx//2, self.Ny//2] = 1
+
+        # a block of dielectric with a Kerr nonlinearity
+        self.eps_r = np.ones((self.Nx, self.Ny))
+        self.eps_r[10:20, 12:18] = 3
+        self.chi3_mask = (self.eps_r > 1).astype(float)
+
+    def test_Ez_nl(self):
+
+        print('\ttesting reverse and forward-mode Ez in nonlinear FDFD')
+
+        f = fdfd_ez(self.omega, self.dL, self.eps_r, self.pml)
+
+        # a Kerr nonlinearity changing the permittivity by about 0.1 at the peak of the linear field
+        _, _, Ez_linear = f.solve(self.source_ez)
+        eps_nl = kerr_nonlinearity(0.1 / 3 / np.max(np.abs(Ez_linear))**2 * self.chi3_mask)
+
+        for method in ('newton', 'picard'):
+
+            def J_fdfd(c):
+
+                # set the permittivity
+                f.eps_r = c * self.eps_r
+
+                # set the source amplitude to the permittivity at that point
+                Hx, Hy, Ez = f.solve_nl(c * self.eps_r * self.source_ez, eps_nl, method=method)
+
+                return npa.sum(npa.square(npa.abs(Ez))) \
+                     + npa.sum(npa.square(npa.abs(Hx))) \
+                     + npa.sum(npa.square(npa.abs(Hy)))
+
+            grad_autograd_rev = jacobian(J_fdfd, mode='reverse')(1.0)
+            grad_autograd_for = jacobian(J_fdfd, mode='forward')(1.0)
+            grad_numerical = jacobian(J_fdfd, mode='numerical')(1.0)
+
+            for grad_autograd in (grad_autograd_rev, grad_autograd_for):
+                norm_ratio = np.linalg.norm(grad_numerical - grad_autograd) / np.linalg.norm(grad_numerical)
+                self.assertLessEqual(norm_ratio, ALLOWED_RATIO)
 
 if __name__ == '__main__':
     unittest.main()
@@ -7,6 +7,7 @@ from ceviche.constants import *
 
 import ceviche    # use the ceviche wrapper for autograd derivatives
 DECIMAL = 3       # number of decimals to check to
+DIAGONAL_SHIFT = 5  # added to the diagonals of the matrices of the batched solves
 
 ## Setup
 np.random.seed(2)  # note sometimes the random matrices are singular and therefore the solver doesn't work (gives really large answers)
@@ -28,6 +29,16 @@ class TestPlaneWave(unittest.TestCase):
         self.entries_const2 = make_rand_complex(self.M2)
         self.x_const = make_rand_complex(self.N)
         self.b_const = make_rand_complex(self.N)
+        self.B_const = make_rand_complex(3 * self.N).reshape((self.N, 3))
+
+        # the batched solves add a diagonal to the random matrix, so it is well conditioned whatever the random numbers are
+        diagonal = np.arange(self.N)
+        self.indices_shifted = np.hstack((self.indices_const, np.vstack((diagonal, diagonal))))
+        self.entries_shifted = np.hstack((self.entries_const, DIAGONAL_SHIFT * np.ones(self.N)))
+
+    def shift_diagonal(self, entries):
+        # entries into the matrix with indices `indices_shifted`
+        return npa.concatenate((entries, DIAGONAL_SHIFT * npa.ones(self.N)))
 
     def out_fn(self, output_vector):
         # this function takes the output of each primitive and returns a real scalar (sort of like the objective function)
@@ -100,6 +111,38 @@ class TestPlaneWave(unittest.TestCase):
         np.testing.assert_almost_equal(grad_rev, grad_true, decimal=DECIMAL, err_msg=self.err_msg('fn_solve_b', 'reverse'))
         np.testing.assert_almost_equal(grad_for, grad_true, decimal=DECIMAL, err_msg=self.err_msg('fn_solve_b', 'forward'))
 
+    def test_solve_batch_entries(self):
+
+        def fn_solve_batch_entries(entries):
+            # batched sparse matrix solve (X = A^{-1}B) as a function of matrix entries 'A(entries)'
+            X = sp_solve_batch(self.shift_diagonal(entries), self.indices_shifted, self.B_const)
+            return self.out_fn(X)
+
+        entries = make_rand_complex(self.M)
+
+        grad_rev = ceviche.jacobian(fn_solve_batch_entries, mode='reverse')(entries)[0]
+        grad_for = ceviche.jacobian(fn_solve_batch_entries, mode='forward')(entries)[0]
+        grad_true = grad_num(fn_solve_batch_entries, entries)
+
+        np.testing.assert_almost_equal(grad_rev, grad_true, decimal=DECIMAL, err_msg=self.err_msg('fn_solve_batch_entries', 'reverse'))
+        np.testing.assert_almost_equal(grad_for, grad_true, decimal=DECIMAL, err_msg=self.err_msg('fn_solve_batch_entries', 'forward'))
+
+    def test_solve_batch_B(self):
+
+        def fn_solve_batch_B(b):
+            # batched sparse matrix solve (X = A^{-1}B) as a function of the (flattened) sources 'B'
+            X = sp_solve_batch(self.entries_shifted, self.indices_shifted, b.reshape(self.B_const.shape))
+            return self.out_fn(X)
+
+        b = make_rand_complex(self.B_const.size)
+
+        grad_rev = ceviche.jacobian(fn_solve_batch_B, mode='reverse')(b)[0]
+        grad_for = ceviche.jacobian(fn_solve_batch_B, mode='forward')(b)[0]
+        grad_true = grad_num(fn_solve_batch_B, b)
+
+        np.testing.assert_almost_equal(grad_rev, grad_true, decimal=DECIMAL, err_msg=self.err_msg('fn_solve_batch_B', 'reverse'))
+        np.testing.assert_almost_equal(grad_for, grad_true, decimal=DECIMAL, err_msg=self.err_msg('fn_solve_batch_B', 'forward'))
+
     def test_spmut_entries(self):
 
         def fn_spsp_entries_a(entries):
@@ -120,5 +163,65 @@ class TestPlaneWave(unittest.TestCase):
         np.testing.assert_almost_equal(grad_rev, grad_true, decimal=DECIMAL, err_msg=self.err_msg('fn_solve_entries', 'reverse'))
         np.testing.assert_almost_equal(grad_for, grad_true, decimal=DECIMAL, err_msg=self.err_msg('fn_solve_entries', 'forward'))
 
+    def test_trans(self):
+
+        def fn_trans(entries):
+            # products and solves with A^T, done with the matrix and factorization of A
+            entries = self.shift_diagonal(entries)
+            x = sp_mult(entries, self.indices_shifted, self.x_const, trans='T')
+            x = sp_solve(entries, self.indices_shifted, x, trans='T')
+            X = sp_solve_batch(entries, self.indices_shifted, npa.stack((x, self.b_const), axis=1), trans='T')
+            return self.out_fn(X)
+
+        entries = make_rand_complex(self.M)
+
+        A = make_sparse(self.shift_diagonal(entries), self.indices_shifted, shape=(self.N, self.N))
+        x = sp_solve(self.shift_diagonal(entries), self.indices_shifted, self.b_const, trans='T')
+        np.testing.assert_almost_equal(A.T.dot(x), self.b_const, decimal=DECIMAL)
+
+        grad_rev = ceviche.jacobian(fn_trans, mode='reverse')(entries)[0]
+        grad_for = ceviche.jacobian(fn_trans, mode='forward')(entries)[0]
+        grad_true = grad_num(fn_trans, entries)
+
+        np.testing.assert_almost_equal(grad_rev, grad_true, decimal=DECIMAL, err_msg=self.err_msg('fn_trans', 'reverse'))
+        np.testing.assert_almost_equal(grad_for, grad_true, decimal=DECIMAL, err_msg=self.err_msg('fn_trans', 'forward'))
+
+    def test_sp_diag_sandwich(self):
+
+        indices_b, sandwich = make_diag_sandwich(self.entries_const, self.indices_const, self.entries_const2, self.indices_const2, self.N)
+
+        def fn_sandwich(w):
+            # D1 @ diag(w) @ D2 as a function of w
+            entries_b = sp_diag_sandwich(w, sandwich)
+            x = sp_mult(entries_b, indices_b, self.x_const)
+            return self.out_fn(x)
+
+        # its own random state, so as not to change the (sometimes singular) random matrices of the other tests
+        rand = np.random.RandomState(0)
+        w = rand.random_sample(self.N) + 1j * rand.random_sample(self.N)
+
+        D1 = make_sparse(self.entries_const, self.indices_const, shape=(self.N, self.N))
+        D2 = make_sparse(self.entries_const2, self.indices_const2, shape=(self.N, self.N))
+        B = make_sparse(sp_diag_sandwich(w, sandwich), indices_b, shape=(self.N, self.N))
+        np.testing.assert_almost_equal(B.toarray(), D1.dot(sp.diags(w)).dot(D2).toarray(), decimal=DECIMAL)
+
+        grad_rev = ceviche.jacobian(fn_sandwich, mode='reverse')(w)[0]
+        grad_for = ceviche.jacobian(fn_sandwich, mode='forward')(w)[0]
+        grad_true = grad_num(fn_sandwich, w)
+
+        np.testing.assert_almost_equal(grad_rev, grad_true, decimal=DECIMAL, err_msg=self.err_msg('fn_sandwich', 'reverse'))
+        np.testing.assert_almost_equal(grad_for, grad_true, decimal=DECIMAL, err_msg=self.err_msg('fn_sandwich', 'forward'))
+
+    def test_make_sparse(self):
+
+        # the cached csr structure has to give the same matrix as going through scipy's coo format, with duplicate entries summed
+        indices = np.hstack((self.indices_const, self.indices_const[:, :5]))
+        for _ in range(2):
+            entries = make_rand_complex(indices.shape[1])
+            A = make_sparse(entries, indices, shape=(self.N, self.N))
+            A_true = sp.coo_matrix((entries, indices), shape=(self.N, self.N)).tocsr()
+            np.testing.assert_almost_equal(A.toarray(), A_true.toarray(), decimal=DECIMAL)
+            self.assertEqual(A.nnz, A_true.nnz)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,662 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+import scipy.sparse as sp
+import autograd.numpy as npa
+
+from autograd import grad
+
+from ceviche import fdfd_ez, fdfd_hz, jacobian
+from ceviche.solvers import get_factorization, clear_factorization_cache, _factorization_cache, FACTORIZATION_CACHE_SIZE
+from ceviche.solvers import solve_linear, PRECONDITIONERS, DEFAULT_ITERATIVE_METHOD, clear_warm_starts, _warm_starts, WARM_START_CACHE_SIZE
+from ceviche.solvers import solver_settings, choose_backend, BACKENDS, HAS_MKL, HAS_UMFPACK, is_symmetric
+from ceviche.solvers import solver_telemetry, summarize_telemetry, clear_fallback_steps, _fallback_steps
+from ceviche.solvers import set_reference_matrix, clear_reference_factorizations, WOODBURY_MAX_RANK
+from ceviche.solvers import clear_ordering_cache, _evicted_factorization_bytes
+from ceviche.multigrid import MultigridSolver, estimate_kh
+from ceviche.constants import C_0
+from ceviche.schwarz import SchwarzSolver
+from ceviche.utils import make_sparse, transpose_indices, get_entries_indices, grad_num
+
+"""
+This file tests the sparse linear solvers and the machinery around them in ceviche.solvers
+"""
+
+DECIMAL = 8       # number of decimals to check to
+
+class TestSolvers(unittest.TestCase):
+
+    """ Tests the linear solvers against a dense reference """
+
+    def setUp(self):
+
+        # each test gets its own random numbers, independent of the other tests and test files
+        self.random = np.random.RandomState(0)
+
+        self.N = 30
+        A = make_sparse(self.rand_complex(self.N**2), np.indices((self.N, self.N)).reshape(2, -1), shape=(self.N, self.N))
+        A = A + 5 * self.N * make_sparse(np.ones(self.N), np.vstack((np.arange(self.N), np.arange(self.N))), shape=(self.N, self.N))
+        self.entries, self.indices = get_entries_indices(A)
+        self.A = A.toarray()
+        self.b = self.rand_complex(self.N)
+        clear_factorization_cache()
+
+    def rand_complex(self, N):
+        # like `make_rand_complex`, with the random numbers of this test
+        return self.random.random_sample(N) - 0.5 + 1j * (self.random.random_sample(N) - 0.5)
+
+    def test_factorization_cache(self):
+
+        factorization, trans = get_factorization(self.entries, self.indices, shape=(self.N, self.N))
+        self.assertEqual(trans, 'N')
+        x = factorization.solve(self.b, trans=trans)
+        np.testing.assert_almost_equal(x, np.linalg.solve(self.A, self.b), decimal=DECIMAL)
+
+        # the transposed matrix should reuse the factorization above
+        indices_T = transpose_indices(self.indices)
+        factorization_T, trans_T = get_factorization(self.entries, indices_T, shape=(self.N, self.N))
+        self.assertIs(factorization_T, factorization)
+        self.assertEqual(trans_T, 'T')
+        self.assertEqual(len(_factorization_cache), 1)
+        x_T = factorization_T.solve(self.b, trans=trans_T)
+        np.testing.assert_almost_equal(x_T, np.linalg.solve(self.A.T, self.b), decimal=DECIMAL)
+
+        # a new matrix evicts the cached factorization (here refactoring it, since the pattern is the same),
+        # so the 'auto' policy counts its memory as available
+        self.assertEqual(_evicted_factorization_bytes(), 24 * factorization.lu.nnz)
+        factorization_2, _ = get_factorization(2 * self.entries, self.indices, shape=(self.N, self.N))
+        self.assertIs(factorization_2, factorization)
+        self.assertEqual(len(_factorization_cache), FACTORIZATION_CACHE_SIZE)
+        np.testing.assert_almost_equal(factorization_2.solve(self.b), np.linalg.solve(2 * self.A, self.b), decimal=DECIMAL)
+
+    def test_same_pattern_refactor(self):
+
+        # fill up the cache with matrices of the same pattern, the last ones reuse the symbolic analysis of the first
+        for i in range(FACTORIZATION_CACHE_SIZE + 2):
+            entries = self.entries * (1 + 0.1 * i)
+            factorization, trans = get_factorization(entries, self.indices, shape=(self.N, self.N))
+            for trans in ('N', 'T'):
+                A = self.A * (1 + 0.1 * i)
+                A = A.T if trans == 'T' else A
+                x = factorization.solve(self.b, trans=trans)
+                np.testing.assert_almost_equal(x, np.linalg.solve(A, self.b), decimal=DECIMAL)
+
+        self.assertEqual(len(_factorization_cache), FACTORIZATION_CACHE_SIZE)
+
+    def test_preconditioned_iterative(self):
+
+        # an FDFD matrix with PML, which the unpreconditioned iterative methods struggle with
+        Nx, Ny = 40, 40
+        eps_r = np.ones((Nx, Ny))
+        eps_r[15:25, :] = 4
+        F = fdfd_ez(2 * np.pi * 200e12, 5e-8, eps_r, [10, 10])
+        entries_a, indices_a = F._make_A(eps_r.flatten())
+        A = make_sparse(entries_a, indices_a, shape=(F.N, F.N))
+        b = np.zeros(F.N, dtype=np.complex128)
+        b[F.N // 2 + Ny // 2] = 1j * F.omega
+
+        x_direct = solve_linear(A, b)
+        for iterative_method in ('bicgstab', DEFAULT_ITERATIVE_METHOD):
+            for preconditioner in PRECONDITIONERS.keys():
+                with solver_settings(grid_shape=(Nx, Ny)):
+                    x = solve_linear(A, b, iterative_method=iterative_method, preconditioner=preconditioner)
+                error = np.linalg.norm(x - x_direct) / np.linalg.norm(x_direct)
+                self.assertLess(error, 1e-4, msg='preconditioner {} failed with {}'.format(preconditioner, iterative_method))
+
+        # the tolerance is relative to the right hand side, so tiny ones (like those of adjoint solves) are solved just as accurately
+        x = solve_linear(A, 1e-20 * b, iterative_method=DEFAULT_ITERATIVE_METHOD, preconditioner='ilu')
+        self.assertLess(np.linalg.norm(1e20 * x - x_direct) / np.linalg.norm(x_direct), 1e-4)
+
+        # methods that break down (like bicg here) raise an error instead of returning their last iterate
+        with self.assertRaises(RuntimeError):
+            solve_linear(A, b, iterative_method='bicg', preconditioner='ilu')
+
+        # bicg also applies the preconditioner conjugate transposed
+        A = sp.csr_matrix(self.A)
+        x = solve_linear(A, self.b, iterative_method='bicg', preconditioner='ilu')
+        np.testing.assert_almost_equal(x, np.linalg.solve(self.A, self.b), decimal=DECIMAL)
+
+    def test_multigrid(self):
+
+        # an FDFD problem large enough to have a few grid levels
+        Nx, Ny = 96, 80
+        eps_r = np.ones((Nx, Ny))
+        eps_r[30:50, :] = 4
+        source = np.zeros((Nx, Ny))
+        source[Nx // 2, Ny // 2] = 1
+
+        for fdfd in (fdfd_ez, fdfd_hz):
+            F = fdfd(2 * np.pi * 200e12, 2.5e-8, eps_r, [10, 10])
+            with solver_settings(backend='superlu'):
+                _, _, Fz_direct = F.solve(source)
+            with solver_settings(backend='multigrid'):
+                _, _, Fz = F.solve(source)
+            error = np.linalg.norm(Fz - Fz_direct) / np.linalg.norm(Fz_direct)
+            self.assertLess(error, 1e-4, msg='multigrid failed for {}'.format(fdfd.__name__))
+
+        # one V-cycle on the shifted operator (with or without transposing) should reduce the error a lot
+        entries_a, indices_a = F._make_A(eps_r.flatten())
+        A = make_sparse(entries_a, indices_a, shape=(F.N, F.N))
+        M = A + make_sparse(-0.5j * A.dot(np.ones(F.N)), np.vstack((np.arange(F.N), np.arange(F.N))), shape=(F.N, F.N))
+        # the wavenumber in the eps = 4 layer is estimated away from the PML, where A @ 1 isn't the mass term
+        kh = estimate_kh(A, A.dot(np.ones(F.N)))
+        self.assertAlmostEqual(kh, 2 * (2 * np.pi * 200e12) / C_0 * 2.5e-8, places=3)
+        multigrid = MultigridSolver(M, (Nx, Ny), coarsest_size=500)
+        self.assertEqual(len(multigrid.levels), 2)
+        x_true = self.rand_complex(F.N)
+        for trans in ('N', 'T'):
+            M_trans = M if trans == 'N' else M.T
+            x = multigrid.solve(M_trans.dot(x_true), trans=trans)
+            self.assertLess(np.linalg.norm(x - x_true) / np.linalg.norm(x_true), 0.5)
+
+    def test_schwarz(self):
+
+        Nx, Ny = 60, 50
+        eps_r = np.ones((Nx, Ny))
+        eps_r[20:30, :] = 4
+        source = np.zeros((Nx, Ny))
+        source[Nx // 2, Ny // 2] = 1
+
+        for fdfd in (fdfd_ez, fdfd_hz):
+            F = fdfd(2 * np.pi * 200e12, 2.5e-8, eps_r, [10, 10])
+            with solver_settings(backend='superlu'):
+                _, _, Fz_direct = F.solve(source)
+            with solver_settings(backend='schwarz', num_workers=2, subdomains=(2, 2)):
+                clear_factorization_cache()
+                _, _, Fz = F.solve(source)
+                clear_factorization_cache()
+            error = np.linalg.norm(Fz - Fz_direct) / np.linalg.norm(Fz_direct)
+            self.assertLess(error, 1e-4, msg='schwarz failed for {}'.format(fdfd.__name__))
+
+        # the worker processes apply the same preconditioner as solving the subdomains in this process
+        entries_a, indices_a = F._make_A(eps_r.flatten())
+        A = make_sparse(entries_a, indices_a, shape=(F.N, F.N))
+        b = self.rand_complex(F.N)
+        local = SchwarzSolver(A, (Nx, Ny), num_workers=0, subdomains=(3, 2))
+        parallel = SchwarzSolver(A, (Nx, Ny), num_workers=2, subdomains=(3, 2))
+        for trans in ('N', 'T'):
+            np.testing.assert_allclose(parallel.solve(b, trans=trans), local.solve(b, trans=trans))
+        parallel.close()
+
+        # without overlap the preconditioner is block Jacobi, whose transpose is the block Jacobi of A^T
+        x = SchwarzSolver(A, (Nx, Ny), num_workers=0, subdomains=(2, 1), overlap=0).solve(b, trans='T')
+        blocks = SchwarzSolver(A.T, (Nx, Ny), num_workers=0, subdomains=(2, 1), overlap=0).solve(b)
+        np.testing.assert_allclose(x, blocks)
+
+    def test_mixed_precision(self):
+
+        eps_r = 1 + self.random.random_sample((40, 30))
+        source = np.zeros((40, 30))
+        source[20, 15] = 1
+        for fdfd in (fdfd_ez, fdfd_hz):
+            F = fdfd(2 * np.pi * 200e12, 5e-8, eps_r, [5, 5])
+            with solver_settings(backend='superlu'):
+                _, _, Fz_direct = F.solve(source)
+            with solver_settings(backend='mixed'):
+                clear_factorization_cache()
+                _, _, Fz = F.solve(source)
+            np.testing.assert_allclose(Fz, Fz_direct, rtol=1e-8, atol=1e-8 * np.abs(Fz_direct).max())
+
+        # the refinement reaches double precision residuals, starting from single precision ones
+        entries_a, indices_a = F._make_A(eps_r.flatten())
+        with solver_settings(backend='mixed'):
+            factorization, _ = get_factorization(entries_a, indices_a, shape=(F.N, F.N))
+        self.assertEqual(factorization.lu.L.dtype, np.complex64)
+        factorization.solve(np.stack((source.flatten(), self.rand_complex(F.N)), axis=1), trans='T')
+        self.assertEqual(len(factorization.residuals), 2)
+        for history in factorization.residuals:
+            self.assertGreater(history[0], 1e-10)
+            self.assertLess(history[-1], 1e-12)
+
+    def test_telemetry(self):
+
+        eps_r = 1 + self.random.random_sample((30, 20))
+        source = np.zeros((30, 20))
+        source[15, 10] = 1
+
+        def objective(eps_r):
+            F = fdfd_ez(2 * np.pi * 200e12, 5e-8, eps_r, [5, 5])
+            _, _, Ez = F.solve(source)
+            return npa.sum(npa.abs(Ez)**2)
+
+        # the adjoint solve of the gradient is recorded and reuses the forward factorization
+        clear_factorization_cache()
+        with solver_settings(backend='superlu'), solver_telemetry() as records:
+            grad(objective)(eps_r)
+        self.assertEqual([record.kind for record in records], ['forward', 'adjoint'])
+        forward, adjoint = records
+        self.assertFalse(forward.cached)
+        self.assertTrue(adjoint.cached)
+        self.assertGreater(forward.factor_time, 0)
+        self.assertGreater(forward.fill_in, 0)
+        self.assertIsNone(forward.iterations)
+        for record in records:
+            self.assertEqual(record.backend, 'superlu')
+            self.assertLess(record.residual, 1e-10)
+            self.assertTrue(record.converged)
+
+        # the iterative solves report their iterations and convergence, and nothing is recorded outside of the block
+        with solver_settings(backend='iterative', iterative_method='gmres'), solver_telemetry() as records:
+            objective(eps_r)
+        objective(eps_r)
+        self.assertEqual(len(records), 1)
+        self.assertGreater(records[0].iterations, 0)
+        self.assertEqual(records[0].info, 0)
+        self.assertEqual(summarize_telemetry(records)[('forward', 'iterative')]['solves'], 1)
+
+    def test_fallback(self):
+
+        eps_r = 1 + self.random.random_sample((30, 20))
+        F = fdfd_ez(2 * np.pi * 200e12, 5e-8, eps_r, [5, 5])
+        entries_a, indices_a = F._make_A(eps_r.flatten())
+        A = make_sparse(entries_a, indices_a, shape=(F.N, F.N))
+        b = self.rand_complex(F.N)
+        x_true = solve_linear(A, b)
+
+        # unpreconditioned CG doesn't converge on the (non hermitian) FDFD matrix, so the chain escalates to the direct solver
+        chain = [{'backend': 'iterative', 'iterative_method': 'cg', 'preconditioner': None}, {'backend': 'superlu'}]
+        clear_fallback_steps()
+        clear_factorization_cache()
+        with solver_settings(backend='fallback', fallback_chain=chain):
+            factorization, _ = get_factorization(entries_a, indices_a, shape=(F.N, F.N))
+            self.assertEqual(factorization.backend, 'iterative')
+            np.testing.assert_allclose(factorization.solve(b), x_true, rtol=1e-8)
+            self.assertEqual(factorization.backend, 'superlu')
+            self.assertEqual(list(_fallback_steps.values()), [1])
+
+            # the next matrix with the same pattern goes straight to the step that worked
+            entries_b = entries_a + 1e-3 * np.abs(entries_a).max()
+            clear_factorization_cache()
+            factorization, _ = get_factorization(entries_b, indices_a, shape=(F.N, F.N))
+            self.assertEqual(factorization.backend, 'superlu')
+
+        # a chain where nothing works raises an error instead of returning a wrong solution
+        with solver_settings(backend='fallback', fallback_chain=chain[:1]):
+            with self.assertRaises(RuntimeError):
+                solve_linear(A, b)
+        clear_fallback_steps()
+
+    def test_woodbury(self):
+
+        eps_r = 1 + self.random.random_sample((30, 20))
+        source = np.zeros((30, 20))
+        source[15, 10] = 1
+
+        for fdfd in (fdfd_ez, fdfd_hz):
+            F = fdfd(2 * np.pi * 200e12, 5e-8, eps_r, [5, 5])
+            entries_ref, indices_a = F._make_A(eps_r.flatten())
+            clear_reference_factorizations()
+            set_reference_matrix(entries_ref, indices_a, shape=(F.N, F.N))
+
+            # a few changed pixels are a low-rank update, a large design region uses the reference as a preconditioner
+            for design_region in ((slice(14, 16), slice(9, 12)), (slice(5, 25), slice(5, 15))):
+                eps_new = eps_r.copy()
+                eps_new[design_region] += 2
+                entries_a, _ = F._make_A(eps_new.flatten())
+                A = make_sparse(entries_a, indices_a, shape=(F.N, F.N)).toarray()
+                B = np.stack((self.rand_complex(F.N), self.rand_complex(F.N)), axis=1)
+                with solver_settings(backend='woodbury'):
+                    clear_factorization_cache()
+                    factorization, _ = get_factorization(entries_a, indices_a, shape=(F.N, F.N))
+                self.assertEqual(factorization.low_rank, factorization.rows.size <= WOODBURY_MAX_RANK)
+                for trans in ('N', 'T'):
+                    A_trans = A.T if trans == 'T' else A
+                    X = factorization.solve(B, trans=trans)
+                    residual = np.linalg.norm(A_trans.dot(X) - B) / np.linalg.norm(B)
+                    self.assertLess(residual, 1e-10 if factorization.low_rank else 1e-4)
+            self.assertTrue(factorization.rows.size > WOODBURY_MAX_RANK)
+
+            # fields solved through the backend match the direct solve
+            with solver_settings(backend='woodbury'):
+                clear_factorization_cache()
+                fields = F.solve(source)
+            with solver_settings(backend='superlu'):
+                fields_direct = F.solve(source)
+            for field, field_direct in zip(fields, fields_direct):
+                np.testing.assert_allclose(field, field_direct, rtol=1e-6, atol=1e-6 * np.abs(field_direct).max())
+        clear_reference_factorizations()
+
+    def test_matrix_free(self):
+
+        eps_r = np.ones((40, 30))
+        eps_r[15:25, :] = 3
+        source = np.zeros((40, 30))
+        source[20, 15] = 1
+        x = self.rand_complex(40 * 30)
+
+        for fdfd in (fdfd_ez, fdfd_hz):
+
+            # the operator applies the assembled matrix and its (conjugate) transpose, also with bloch boundaries
+            for bloch_phases in (None, [0.3, 0.7]):
+                F = fdfd(2 * np.pi * 200e12, 5e-8, eps_r, [8, 8], bloch_phases=bloch_phases)
+                entries_a, indices_a = F._make_A(eps_r.flatten())
+                A = make_sparse(entries_a, indices_a, shape=(F.N, F.N))
+                operator = F.make_operator()
+                np.testing.assert_allclose(operator.matvec(x), A.dot(x), rtol=1e-12, atol=1e-12 * np.abs(A.dot(x)).max())
+                np.testing.assert_allclose(operator.rmatvec(x), A.conj().T.dot(x), rtol=1e-12, atol=1e-12 * np.abs(A.dot(x)).max())
+
+            with solver_settings(backend='superlu'):
+                fields_direct = F.solve(source)
+            fields = F.solve_matrix_free(source)
+            for field, field_direct in zip(fields, fields_direct):
+                self.assertLess(np.linalg.norm(field - field_direct) / np.linalg.norm(field_direct), 1e-3)
+
+        with self.assertRaises(ValueError):
+            solve_linear(F.make_operator(), x)
+
+    def test_warm_start(self):
+
+        clear_warm_starts()
+        x_true = np.linalg.solve(self.A, self.b)
+
+        # the first solve stores its solution in the slot, the second one starts from it
+        for _ in range(2):
+            x = solve_linear(self.A, self.b, iterative_method='gmres', slot='forward')
+            np.testing.assert_almost_equal(x, x_true, decimal=5)
+            np.testing.assert_array_equal(_warm_starts['forward'], x)
+
+        self.assertNotIn('adjoint', _warm_starts)
+        clear_warm_starts('forward')
+        self.assertNotIn('forward', _warm_starts)
+
+        # only the most recently used slots are kept
+        for i in range(WARM_START_CACHE_SIZE + 1):
+            solve_linear(self.A, self.b, iterative_method='gmres', slot=('forward', i))
+        self.assertEqual(len(_warm_starts), WARM_START_CACHE_SIZE)
+        self.assertNotIn(('forward', 0), _warm_starts)
+        self.assertIn(('forward', WARM_START_CACHE_SIZE), _warm_starts)
+        clear_warm_starts()
+
+    def test_backends(self):
+
+        backends = ['superlu', 'mixed', 'banded', 'iterative']
+        if HAS_MKL:
+            backends.append('pardiso')
+        if HAS_UMFPACK:
+            backends.append('umfpack')
+
+        B = np.stack((self.b, 2 * self.b), axis=1)
+        for backend in backends:
+            clear_factorization_cache()
+            with solver_settings(backend=backend, iterative_method='gmres'):
+                factorization, trans = get_factorization(self.entries, self.indices, shape=(self.N, self.N))
+                self.assertIsInstance(factorization, BACKENDS[backend])
+                for trans in ('N', 'T'):
+                    A = self.A.T if trans == 'T' else self.A
+                    X = factorization.solve(B, trans=trans)
+                    np.testing.assert_almost_equal(X, np.linalg.solve(A, B), decimal=5, err_msg='backend {} failed'.format(backend))
+
+        with self.assertRaises(ValueError):
+            with solver_settings(backend='not_a_backend'):
+                pass
+
+    def test_auto_backend(self):
+
+        # tridiagonal matrices are banded, anything else is solved directly at this size
+        N = 100
+        indices_tri = np.hstack([np.vstack((np.arange(N - abs(k)) + max(k, 0), np.arange(N - abs(k)) + max(-k, 0))) for k in (-1, 0, 1)])
+        self.assertEqual(choose_backend((N, N), indices_tri), 'banded')
+        self.assertIn(choose_backend((self.N, self.N), self.indices), ('superlu', 'pardiso', 'umfpack'))
+
+    def test_banded_1d(self):
+
+        # 1D and thin grids have periodic boundaries far off the diagonal, but are banded after reordering
+        for fdfd in (fdfd_ez, fdfd_hz):
+            for shape, npml in (((1, 200), [0, 20]), ((200, 1), [20, 0]), ((150, 3), [20, 0])):
+                eps_r = 1 + self.random.random_sample(shape)
+                source = np.zeros(shape)
+                source.flat[10] = 1
+                F = fdfd(2 * np.pi * 200e12, 5e-8, eps_r, npml)
+                with solver_settings(backend='superlu'):
+                    fields_direct = F.solve(source)
+                clear_factorization_cache()
+                fields = F.solve(source)
+
+                entries_a, indices_a = F._make_A(eps_r.flatten())
+                with solver_settings(grid_shape=shape):
+                    self.assertEqual(choose_backend((F.N, F.N), indices_a), 'banded')
+                    factorization, _ = get_factorization(entries_a, indices_a, shape=(F.N, F.N))
+                self.assertIsNotNone(factorization.order)
+                self.assertLessEqual(factorization.kl + factorization.ku + 1, 4 * min(shape) + 1)
+                for field, field_direct in zip(fields, fields_direct):
+                    np.testing.assert_allclose(field, field_direct, rtol=1e-8, atol=1e-8 * np.abs(field_direct).max())
+
+                A = make_sparse(entries_a, indices_a, shape=(F.N, F.N))
+                b = self.rand_complex(F.N)
+                np.testing.assert_allclose(A.T.dot(factorization.solve(b, trans='T')), b, rtol=1e-8, atol=1e-8 * np.abs(b).max())
+
+    def test_ordering_disk_cache(self):
+
+        eps_r = 1 + self.random.random_sample((30, 20))
+        F = fdfd_ez(2 * np.pi * 200e12, 5e-8, eps_r, [5, 5])
+        entries_a, indices_a = F._make_A(eps_r.flatten())
+        b = self.rand_complex(F.N)
+
+        with tempfile.TemporaryDirectory() as directory:
+            with solver_settings(backend='superlu', ordering_cache_dir=directory):
+                clear_ordering_cache()
+                clear_factorization_cache()
+                factorization, _ = get_factorization(entries_a, indices_a, shape=(F.N, F.N))
+                self.assertIsNone(factorization.order)
+                x = factorization.solve(b)
+                files = os.listdir(directory)
+                self.assertEqual(len(files), 1)
+
+                # a new process (with nothing in memory) loads the ordering instead of computing it
+                clear_ordering_cache()
+                clear_factorization_cache()
+                factorization, _ = get_factorization(entries_a, indices_a, shape=(F.N, F.N))
+                self.assertIsNotNone(factorization.order)
+                np.testing.assert_allclose(factorization.solve(b), x, rtol=1e-8, atol=1e-8 * np.abs(x).max())
+
+                # corrupt files are recomputed
+                with open(os.path.join(directory, files[0]), 'w') as f:
+                    f.write('not an ordering')
+                clear_ordering_cache()
+                clear_factorization_cache()
+                factorization, _ = get_factorization(entries_a, indices_a, shape=(F.N, F.N))
+                self.assertIsNone(factorization.order)
+                np.testing.assert_allclose(factorization.solve(b), x, rtol=1e-8, atol=1e-8 * np.abs(x).max())
+            clear_factorization_cache()
+        clear_ordering_cache()
+
+    def test_symmetric(self):
+
+        # the FDFD matrices with PML are symmetric after scaling their rows, and then get a symmetric factorization
+        eps_r = 1 + self.random.random_sample((30, 20))
+        source = np.zeros((30, 20))
+        source[15, 10] = 1
+        for fdfd in (fdfd_ez, fdfd_hz):
+            F = fdfd(2 * np.pi * 200e12, 5e-8, eps_r, [5, 5])
+            entries_a, indices_a = F._make_A(eps_r.flatten())
+            self.assertFalse(is_symmetric(make_sparse(entries_a, indices_a, shape=(F.N, F.N))))
+            entries_sym, _ = F._symmetrize(entries_a, indices_a, np.zeros(F.N))
+            self.assertTrue(is_symmetric(make_sparse(entries_sym, indices_a, shape=(F.N, F.N))))
+
+            backends = ['superlu', 'pardiso'] if HAS_MKL else ['superlu']
+            for backend in backends:
+                with solver_settings(backend=backend, symmetric=False):
+                    clear_factorization_cache()
+                    fields = F.solve(source)
+                with solver_settings(backend=backend):
+                    clear_factorization_cache()
+                    fields_sym = F.solve(source)
+                    factorization, _ = get_factorization(entries_sym, indices_a, shape=(F.N, F.N))
+                    self.assertTrue(factorization.symmetric)
+                for field, field_sym in zip(fields, fields_sym):
+                    np.testing.assert_allclose(field_sym, field, rtol=1e-6, atol=1e-6 * np.abs(field).max())
+
+        # symmetric matrices with tiny diagonal entries still pivot off the diagonal, so they are solved accurately
+        B = sp.random(200, 200, density=0.03, random_state=self.random) + 1j * sp.random(200, 200, density=0.03, random_state=self.random)
+        A = B + B.T
+        A = (A - sp.diags(A.diagonal()) + 1e-9 * sp.eye(200)).tocsr()
+        b = self.random.randn(200) + 0j
+        entries, indices = get_entries_indices(A)
+        clear_factorization_cache()
+        factorization, trans = get_factorization(entries, indices, shape=A.shape)
+        self.assertTrue(factorization.symmetric)
+        x = factorization.solve(b, trans=trans)
+        self.assertLess(np.linalg.norm(A.dot(x) - b) / np.linalg.norm(b), 1e-10)
+
+    def test_update_derivatives(self):
+
+        # the parts of A precomputed with the derivatives are remade when omega, the PML or the grid change
+        eps_r = np.ones((30, 20))
+        eps_r[10:20, 5:15] = 4
+        source = np.zeros((30, 20))
+        source[15, 10] = 1
+        omega = 2 * np.pi * 200e12
+        for fdfd in (fdfd_ez, fdfd_hz):
+            F = fdfd(omega, 5e-8, eps_r, [5, 5])
+            F.solve(source)
+            F.omega = 1.1 * omega
+            F.npml = [4, 6]
+            fields = F.solve(source)
+            fields_new = fdfd(1.1 * omega, 5e-8, eps_r, [4, 6]).solve(source)
+            for field, field_new in zip(fields, fields_new):
+                np.testing.assert_allclose(field, field_new, rtol=1e-8, atol=1e-8 * np.abs(field_new).max())
+
+            F.eps_r = eps_r[:, :15]
+            fields = F.solve(source[:, :15])
+            fields_new = fdfd(1.1 * omega, 5e-8, eps_r[:, :15], [4, 6]).solve(source[:, :15])
+            np.testing.assert_allclose(fields[2], fields_new[2], rtol=1e-8, atol=1e-8 * np.abs(fields_new[2]).max())
+
+    def test_vectorized_adjoint(self):
+
+        # the reverse jacobian of an objective with many outputs does all of their adjoint solves at once
+        eps_r = np.ones((30, 20))
+        eps_r[10:20, 5:15] = 4
+        source = np.zeros((30, 20))
+        source[15, 10] = 1
+        F = fdfd_ez(2 * np.pi * 200e12, 5e-8, eps_r, [5, 5])
+
+        def objective(eps_arr):
+            F.eps_r = eps_arr.reshape(eps_r.shape)
+            _, _, Ez = F.solve(source)
+            return npa.abs(Ez[[5, 10, 20, 25], 10])**2
+
+        with solver_telemetry() as records:
+            jac = jacobian(objective, mode='reverse')(eps_r.flatten())
+        adjoint_records = [record for record in records if record.kind == 'adjoint']
+        self.assertEqual(len(adjoint_records), 1)
+        self.assertEqual(adjoint_records[0].num_rhs, 4)
+
+        for k in range(4):
+            grad_k = grad(lambda eps_arr: objective(eps_arr)[k])(eps_r.flatten())
+            np.testing.assert_allclose(jac[k], grad_k, rtol=1e-8, atol=1e-8 * np.abs(grad_k).max())
+
+    def test_vectorized_adjoint_settings(self):
+
+        # the batched adjoint solve uses the solver settings of the simulation, so it reuses the forward solve's backend
+        def objective_fn(F, source, points):
+            def objective(eps_arr):
+                F.eps_r = eps_arr.reshape(F.shape)
+                _, _, Ez = F.solve(source)
+                return npa.abs(Ez[points])**2
+            return objective
+
+        eps_r = np.ones((30, 20))
+        eps_r[10:20, 5:15] = 4
+        source = np.zeros((30, 20))
+        source[15, 10] = 1
+        def check_jacobian(jac, source, points):
+            # against the jacobian of the same objective solved directly, from scratch
+            clear_factorization_cache()
+            clear_warm_starts()
+            F_direct = fdfd_ez(2 * np.pi * 200e12, 5e-8, eps_r, F.npml, solver_settings={'backend': 'superlu'})
+            jac_direct = jacobian(objective_fn(F_direct, source, points), mode='reverse')(eps_r.flatten())
+            self.assertGreater(np.linalg.norm(jac_direct), 0)
+            self.assertLess(np.linalg.norm(jac - jac_direct) / np.linalg.norm(jac_direct), 1e-6)
+
+        F = fdfd_ez(2 * np.pi * 200e12, 5e-8, eps_r, [5, 5], solver_settings={'backend': 'iterative'})
+        with solver_telemetry() as records:
+            jac = jacobian(objective_fn(F, source, ([5, 10, 20], 10)), mode='reverse')(eps_r.flatten())
+        self.assertEqual([(record.kind, record.backend) for record in records], [('forward', 'iterative'), ('adjoint', 'iterative')])
+        check_jacobian(jac, source, ([5, 10, 20], 10))
+
+        # a thin grid goes to the banded backend, whose factorization is reused for the adjoint
+        eps_r = np.ones((200, 1))
+        eps_r[80:120] = 4
+        source = np.zeros((200, 1))
+        source[100, 0] = 1
+        F = fdfd_ez(2 * np.pi * 200e12, 5e-8, eps_r, [20, 0])
+        clear_factorization_cache()
+        with solver_telemetry() as records:
+            jac = jacobian(objective_fn(F, source, ([30, 60, 150], 0)), mode='reverse')(eps_r.flatten())
+        self.assertEqual([(record.kind, record.backend) for record in records], [('forward', 'banded'), ('adjoint', 'banded')])
+        self.assertTrue(records[1].cached)
+        check_jacobian(jac, source, ([30, 60, 150], 0))
+
+    def test_vectorized_tangents(self):
+
+        # the forward jacobian of an objective with a few inputs pushes all of their tangents through one solve
+        eps_r = np.ones((30, 20))
+        eps_r[10:20, 5:15] = 4
+        source = np.zeros((30, 20))
+        source[15, 10] = 1
+        shifts = np.stack([np.roll(eps_r > 1, k, axis=0) for k in range(5)])
+
+        for fdfd in (fdfd_ez, fdfd_hz):
+            F = fdfd(2 * np.pi * 200e12, 5e-8, eps_r, [5, 5])
+
+            def objective(params):
+                F.eps_r = eps_r + npa.sum(params[:, None, None] * shifts, axis=0)
+                fields = F.solve(source)
+                return npa.abs(fields[2][[5, 10, 20], 10])**2
+
+            params = np.zeros(5)
+            with solver_telemetry() as records:
+                jac_forward = jacobian(objective, mode='forward')(params)
+            tangent_records = [record for record in records if record.kind == 'tangent']
+            self.assertEqual(len(tangent_records), 1)
+            self.assertEqual(tangent_records[0].num_rhs, 5)
+
+            jac_reverse = jacobian(objective, mode='reverse')(params)
+            np.testing.assert_allclose(jac_forward, jac_reverse, rtol=1e-8, atol=1e-8 * np.abs(jac_reverse).max())
+
+            # in batches of at most `batch_size` tangents (forward) or backprop vectors (reverse), with the same jacobians
+            for mode, kind, num_rhs in (('forward', 'tangent', [2, 2, 1]), ('reverse', 'adjoint', [2, 1])):
+                with solver_telemetry() as records:
+                    jac = jacobian(objective, mode=mode, batch_size=2)(params)
+                self.assertEqual([record.num_rhs for record in records if record.kind == kind], num_rhs)
+                np.testing.assert_allclose(jac, jac_reverse, rtol=1e-8, atol=1e-8 * np.abs(jac_reverse).max())
+
+    def test_whole_parallel_numerical(self):
+
+        # numerical jacobians with the perturbations spread over worker processes
+        A = np.arange(12).reshape((3, 4)) / 10
+
+        def fn(x):
+            return npa.dot(A, npa.sin(x) * npa.exp(x / 2))
+
+        x = np.linspace(0.1, 1, 4)
+        jac_reverse = jacobian(fn, mode='reverse')(x)
+        for difference, rtol in (('forward', 1e-5), ('central', 1e-8), ('complex', 1e-12)):
+            step_size = 1e-20 if difference == 'complex' else 1e-6
+            for num_workers in (0, 2):
+                jac = jacobian(fn, mode='numerical', step_size=step_size, difference=difference, num_workers=num_workers)(x)
+                np.testing.assert_allclose(jac, jac_reverse, rtol=rtol, atol=rtol)
+        with self.assertRaises(ValueError):
+            jacobian(fn, mode='numerical', difference='complex')(x + 0j)
+
+        # the workers get the simulation through the objective's closure
+        eps_r = np.ones((20, 20))
+        eps_r[5:15, 5:15] = 4
+        source = np.zeros((20, 20))
+        source[10, 10] = 1
+        F = fdfd_ez(2 * np.pi * 200e12, 5e-8, eps_r, [5, 5])
+
+        def objective(eps_arr):
+            F.eps_r = eps_arr.reshape(eps_r.shape)
+            _, _, Ez = F.solve(source)
+            return npa.sum(npa.abs(Ez[5:8, 5])**2)
+
+        eps_arr = eps_r.flatten()
+        grad_parallel = grad_num(objective, eps_arr.astype(complex), num_workers=3)
+        np.testing.assert_allclose(grad_parallel, grad_num(objective, eps_arr.astype(complex)), atol=1e-6 * np.abs(grad_parallel).max())
+        np.testing.assert_allclose(grad_parallel.real, grad(objective)(eps_arr), rtol=1e-4, atol=1e-4 * np.abs(grad_parallel).max())
+
+
+if __name__ == '__main__':
+    unittest.main()